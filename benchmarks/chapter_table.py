@@ -0,0 +1,103 @@
+"""Compares the chapter table parser with the ComicChapterLoader path.
+
+    python -m benchmarks.chapter_table [--number N] [--write-fixtures]
+
+The detail pages are read from benchmarks/fixtures, ``--write-fixtures``
+regenerates them.
+"""
+import argparse
+import timeit
+from pathlib import Path
+
+from scrapy.http import HtmlResponse
+
+from spiderman.spiders.vol_moe import VolMoeSpider
+
+FIXTURES_DIR = Path(__file__).parent.joinpath("fixtures")
+ROW_COUNTS = (10, 100, 1000)
+HOST = "https://vol.moe.test"
+
+
+def fixture_path(rows: int) -> Path:
+    return FIXTURES_DIR.joinpath(f"vol_moe_detail_{rows}.html")
+
+
+def render_cell(n: int) -> str:
+    if n % 50 == 49:
+        # Placeholder cell at the end of a volume group, without a chapter
+        return "<td>&nbsp;</td><td></td>"
+    return (
+        f'<td><b title="由 Kox 製作">\n  第{n + 1:04d}話 &amp; 特典 </b><br>'
+        f'<font class="filesize">{10 + n % 90}.{n % 100:02d}M ({100 + n}頁)</font>'
+        f"</td>"
+        f'<td><a href="javascript:void(0)" '
+        f"onclick=\"captcha_show('/down.php?bookid=1001&amp;vol={n}','epub')\">下載</a>"
+        f' <a href="javascript:void(0)" onclick="read({n})">閱讀</a></td>'
+    )
+
+
+def render_detail_page(rows: int) -> str:
+    body = "".join(
+        f"<tr>{render_cell(2 * i)}<td></td>{render_cell(2 * i + 1)}</tr>"
+        for i in range(rows)
+    )
+    return (
+        '<html><head><meta charset="utf-8"><title>測試漫畫</title></head><body>'
+        '<table><tr><td class="author"><font>測試漫畫</font><font>作者</font>'
+        "<font>連載</font><font>2024</font><font>(Test Comic)</font></td></tr></table>"
+        '<table id="div_tabdata" class="book_list"><tbody>'
+        '<tr><td colspan="5">卷</td></tr>'
+        f"{body}</tbody></table></body></html>\n"
+    )
+
+
+def write_fixtures():
+    FIXTURES_DIR.mkdir(parents=True, exist_ok=True)
+    for rows in ROW_COUNTS:
+        fixture_path(rows).write_text(render_detail_page(rows), encoding="utf-8")
+
+
+def load_response(rows: int) -> HtmlResponse:
+    return HtmlResponse(
+        url=f"{HOST}/c/1001.htm",
+        body=fixture_path(rows).read_bytes(),
+        encoding="utf-8",
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--number", type=int, default=0, help="runs per table size")
+    parser.add_argument("--write-fixtures", action="store_true")
+    args = parser.parse_args()
+    if args.write_fixtures:
+        write_fixtures()
+
+    spider = VolMoeSpider(
+        user_name="benchmark", password="benchmark", host=HOST, download_dir="download"
+    )
+    print(f"{'rows':>6} {'loaders':>12} {'parser':>12} {'speedup':>8}")
+    for rows in ROW_COUNTS:
+        response = load_response(rows)
+        # Parse once so that lxml has built the tree before timing
+        expected = list(spider.parse_chapters_with_loaders("測試漫畫", response))
+        actual = list(spider.parse_chapters("測試漫畫", response))
+        assert actual == expected, f"Parsers disagree on the {rows} rows table"
+
+        number = args.number or max(1, 2000 // rows)
+        loaders = timeit.timeit(
+            lambda: list(spider.parse_chapters_with_loaders("測試漫畫", response)),
+            number=number,
+        )
+        parser_ = timeit.timeit(
+            lambda: list(spider.parse_chapters("測試漫畫", response)),
+            number=number,
+        )
+        print(
+            f"{rows:>6} {loaders / number * 1000:>10.2f}ms "
+            f"{parser_ / number * 1000:>10.2f}ms {loaders / parser_:>7.1f}x"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,195 @@
+"""Runs VolMoeSpider and ComicDownloadPipeline against the local stand-in.
+
+    python -m benchmarks.e2e [--comics 5] [--chapters 20] [--chapter-size 2]
+        [--bandwidth 0] [--fault-rate 0] [--set COMIC_DOWNLOAD_SEGMENTS=4] ...
+
+Nothing leaves the machine, the stand-in server runs in its own process so
+the peak RSS is the one of the crawl. Run it from the repository root so the
+project settings are picked up.
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import resource
+import shutil
+import tempfile
+import time
+import urllib.request
+from typing import Any, Dict, List
+
+from benchmarks.standin import (
+    PASSWORD,
+    USER_NAME,
+    add_arguments,
+    config_from_args,
+    serve,
+)
+
+
+def parse_pairs(pairs: List[str]) -> Dict[str, str]:
+    result = {}
+    for pair in pairs:
+        key, _, value = pair.partition("=")
+        result[key] = value
+    return result
+
+
+def fetch_stats(url: str) -> Dict[str, Any]:
+    with urllib.request.urlopen(f"{url}/__stats", timeout=10) as response:
+        return json.load(response)
+
+
+def run_crawl(url: str, work_dir: str, args: argparse.Namespace) -> Dict[str, Any]:
+    from scrapy.crawler import CrawlerProcess
+    from scrapy.utils.project import get_project_settings
+
+    from spiderman.spiders.vol_moe import VolMoeSpider
+
+    # Importing the spider loads .env, the proxies of which must not be used
+    # to reach the stand-in.
+    for name in (
+        "HTTP_PROXY",
+        "HTTPS_PROXY",
+        "ALL_PROXY",
+        "http_proxy",
+        "https_proxy",
+        "all_proxy",
+    ):
+        os.environ.pop(name, None)
+    os.environ["NO_PROXY"] = "127.0.0.1,localhost"
+
+    settings = get_project_settings()
+    settings.set("LOG_LEVEL", args.log_level)
+    settings.set("COOKIES_PERSISTENCE_DIR", os.path.join(work_dir, "cookies"))
+    settings.set("COOKIES_DEBUG", False)
+    for key, value in parse_pairs(args.set).items():
+        settings.set(key, value)
+    process = CrawlerProcess(settings, install_root_handler=args.log_level != "NONE")
+    crawler = process.create_crawler(VolMoeSpider)
+    process.crawl(
+        crawler,
+        host=url,
+        user_name=USER_NAME,
+        password=PASSWORD,
+        proxy=None,
+        download_dir=os.path.join(work_dir, "download"),
+        detail_render="always" if args.render else "fallback",
+        **parse_pairs(args.spider_arg),
+    )
+    started = time.time()
+    process.start()
+    finished = time.time()
+    return {
+        "started": started,
+        "finished": finished,
+        "stats": crawler.stats.get_stats() if crawler.stats else {},
+    }
+
+
+def downloaded_files(work_dir: str) -> int:
+    return sum(
+        1
+        for _, _, files in os.walk(os.path.join(work_dir, "download"))
+        for name in files
+        if name.endswith(".epub")
+    )
+
+
+def report(
+    args: argparse.Namespace, crawl: Dict[str, Any], server: Dict[str, Any], files: int
+) -> Dict[str, Any]:
+    elapsed = crawl["finished"] - crawl["started"]
+    first = server["first_download_byte_at"]
+    last = server["last_download_byte_at"]
+    download_elapsed = (last - first) if first and last else 0
+    requests = sum(server["requests"].values())
+    megabytes = server["download_bytes"] / 1024 / 1024
+    return {
+        "crawl_time": round(elapsed, 3),
+        "time_to_first_byte": round(first - crawl["started"], 3) if first else None,
+        "downloaded_mb": round(megabytes, 2),
+        "mb_per_second": round(megabytes / elapsed, 2) if elapsed else None,
+        "download_mb_per_second": (
+            round(megabytes / download_elapsed, 2) if download_elapsed else None
+        ),
+        # ru_maxrss is in kilobytes on Linux
+        "peak_rss_mb": round(
+            resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1
+        ),
+        "requests": requests,
+        "requests_per_comic": round(requests / args.comics, 2) if args.comics else None,
+        "requests_by_path": server["requests"],
+        "logins": server["logins"],
+        "faults": server["faults"],
+        "ranged_downloads": server["ranged_downloads"],
+        "chapters_expected": args.comics * args.chapters,
+        "chapters_downloaded": files,
+        "items_scraped": crawl["stats"].get("item_scraped_count", 0),
+        "finish_reason": crawl["stats"].get("finish_reason"),
+    }
+
+
+def print_report(result: Dict[str, Any]):
+    width = max(len(key) for key in result)
+    for key, value in result.items():
+        if isinstance(value, dict):
+            value = ", ".join(f"{k}={v}" for k, v in sorted(value.items())) or "-"
+        print(f"{key:<{width}}  {value}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    add_arguments(parser)
+    parser.add_argument(
+        "--set",
+        action="append",
+        default=[],
+        metavar="NAME=VALUE",
+        help="override a scrapy setting",
+    )
+    parser.add_argument(
+        "--spider-arg",
+        action="append",
+        default=[],
+        metavar="NAME=VALUE",
+        help="extra VolMoeSpider argument",
+    )
+    parser.add_argument(
+        "--render",
+        action="store_true",
+        help="render detail pages with Playwright, needs an installed browser",
+    )
+    parser.add_argument("--log-level", default="WARNING")
+    parser.add_argument("--json", action="store_true", help="print the report as JSON")
+    parser.add_argument(
+        "--keep", action="store_true", help="keep the download directory"
+    )
+    args = parser.parse_args()
+
+    context = multiprocessing.get_context("spawn")
+    ready = context.Queue()
+    server = context.Process(
+        target=serve, args=(config_from_args(args), 0, ready), daemon=True
+    )
+    server.start()
+    work_dir = tempfile.mkdtemp(prefix="spiderman-e2e-")
+    try:
+        url = ready.get(timeout=30)
+        crawl = run_crawl(url, work_dir, args)
+        result = report(args, crawl, fetch_stats(url), downloaded_files(work_dir))
+    finally:
+        server.terminate()
+        if args.keep:
+            print(f"Downloads kept in '{work_dir}'")
+        else:
+            shutil.rmtree(work_dir, ignore_errors=True)
+    if args.json:
+        print(json.dumps(result, ensure_ascii=False, indent=2))
+    else:
+        print_report(result)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,414 @@
+"""Local stand-in for the vol.moe site, for offline benchmarks.
+
+    python -m benchmarks.standin [--port 8765] [--comics 5] [--chapters 20] ...
+
+It serves the login pages, the follow list, detail pages in the div_tabdata
+layout and epub downloads with Range support. Downloads can be throttled and
+injected with faults, and /__stats returns what has been served so far.
+"""
+
+import argparse
+import functools
+import io
+import json
+import random
+import re
+import secrets
+import threading
+import time
+import zipfile
+from dataclasses import asdict, dataclass, field
+from http import HTTPStatus
+from http.cookies import SimpleCookie
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional, Set, Tuple
+from urllib.parse import parse_qs, urlsplit
+
+SESSION_COOKIE = "VOLSKEY"
+USER_NAME = "benchmark@example.com"
+PASSWORD = "benchmark"
+FAULTS = ("503", "reset", "stall")
+RANGE_PATTERN = re.compile(r"^bytes=(\d*)-(\d*)$")
+
+
+@dataclass
+class StandInConfig:
+    comics: int = field(default=5)
+    chapters: int = field(default=20)
+    chapter_size: int = field(default=2 * 1024 * 1024)
+    # Per connection download rate in bytes per second, 0 is unlimited
+    bandwidth: int = field(default=0)
+    # Delay before every response, in seconds
+    latency: float = field(default=0.0)
+    fault_rate: float = field(default=0.0)
+    faults: Tuple[str, ...] = field(default=FAULTS)
+    stall: float = field(default=5.0)
+    seed: int = field(default=0)
+    require_login: bool = field(default=True)
+
+
+@dataclass
+class StandInStats:
+    requests: Dict[str, int] = field(default_factory=dict)
+    faults: Dict[str, int] = field(default_factory=dict)
+    logins: int = field(default=0)
+    download_bytes: int = field(default=0)
+    downloads_completed: int = field(default=0)
+    ranged_downloads: int = field(default=0)
+    first_download_byte_at: Optional[float] = field(default=None)
+    last_download_byte_at: Optional[float] = field(default=None)
+
+
+class StandInState:
+    def __init__(self, config: StandInConfig):
+        self.config = config
+        self.stats = StandInStats()
+        self.sessions: Set[str] = set()
+        self.random = random.Random(config.seed)
+        self.lock = threading.Lock()
+
+    def count(self, route: str):
+        with self.lock:
+            self.stats.requests[route] = self.stats.requests.get(route, 0) + 1
+
+    def pick_fault(self) -> Optional[str]:
+        with self.lock:
+            if not self.config.faults or self.random.random() >= self.config.fault_rate:
+                return None
+            fault = self.random.choice(self.config.faults)
+            self.stats.faults[fault] = self.stats.faults.get(fault, 0) + 1
+            return fault
+
+    def sent(self, size: int):
+        now = time.time()
+        with self.lock:
+            if self.stats.first_download_byte_at is None:
+                self.stats.first_download_byte_at = now
+            self.stats.last_download_byte_at = now
+            self.stats.download_bytes += size
+
+
+def comic_name(comic_id: int) -> str:
+    return f"測試漫畫{comic_id:03d}"
+
+
+@functools.lru_cache(maxsize=64)
+def chapter_content(comic_id: int, vol: int, size: int) -> bytes:
+    # A stored zip like a real epub, the payload repeats one seeded block so
+    # every request of a chapter returns the same bytes.
+    block = (
+        random.Random(comic_id * 100003 + vol)
+        .getrandbits(8 * 65536)
+        .to_bytes(65536, "little")
+    )
+    payload = (block * (size // len(block) + 1))[:size]
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w", zipfile.ZIP_STORED) as epub:
+        epub.writestr("mimetype", "application/epub+zip")
+        epub.writestr(f"OEBPS/vol{vol:04d}.bin", payload)
+    return buffer.getvalue()
+
+
+def chapter_size_str(size: int) -> str:
+    return f"{size / 1024 / 1024:.2f}M ({max(1, size // 65536)}頁)"
+
+
+def render_login_page() -> str:
+    return (
+        '<html><head><meta charset="utf-8"><title>登錄</title></head><body>'
+        '<form action="login_do.php" method="post">'
+        '<input type="text" name="email"><input type="password" name="passwd">'
+        '<input type="checkbox" name="keepalive" value="on">'
+        '<input type="submit" value="登錄"></form></body></html>'
+    )
+
+
+def render_follow_page(host: str, comics: int) -> str:
+    rows = "".join(
+        f'<tr><td><a href="{host}/c/{comic_id}.htm">{comic_name(comic_id)}</a></td></tr>'
+        for comic_id in range(1, comics + 1)
+    )
+    return (
+        '<html><head><meta charset="utf-8"><title>我的訂閱</title></head><body>'
+        f"<table>{rows}</table></body></html>"
+    )
+
+
+def render_chapter_cell(comic_id: int, vol: int, size: int) -> str:
+    return (
+        f'<td><b title="由 Kox 製作">第{vol + 1:04d}話</b><br>'
+        f'<font class="filesize">{chapter_size_str(size)}</font></td>'
+        f'<td><a href="javascript:void(0)" '
+        f"onclick=\"captcha_show('/down.php?bookid={comic_id}&amp;vol={vol}','epub')\">下載</a></td>"
+    )
+
+
+def render_detail_page(comic_id: int, chapters: int, size: int) -> str:
+    cells = [render_chapter_cell(comic_id, vol, size) for vol in range(chapters)]
+    if len(cells) % 2:
+        cells.append("<td>&nbsp;</td><td></td>")
+    rows = "".join(
+        f"<tr>{cells[i]}<td></td>{cells[i + 1]}</tr>" for i in range(0, len(cells), 2)
+    )
+    return (
+        f'<html><head><meta charset="utf-8"><title>{comic_name(comic_id)}</title></head><body>'
+        f'<table><tr><td class="author"><font>{comic_name(comic_id)}</font><font>作者</font>'
+        f"<font>連載</font><font>2024</font><font>(Test Comic {comic_id})</font></td></tr></table>"
+        '<table id="div_tabdata" class="book_list"><tbody>'
+        f"{rows}</tbody></table></body></html>"
+    )
+
+
+def parse_range(value: str, size: int) -> Optional[Tuple[int, int]]:
+    match = RANGE_PATTERN.match(value.strip())
+    if not match or not any(match.groups()):
+        return None
+    start, end = match.groups()
+    if not start:
+        return max(size - int(end), 0), size - 1
+    if int(start) >= size:
+        return None
+    return int(start), min(int(end), size - 1) if end else size - 1
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server: "StandInServer"
+
+    def log_message(self, format, *args):
+        pass
+
+    @property
+    def state(self) -> StandInState:
+        return self.server.state
+
+    @property
+    def host(self) -> str:
+        return f"http://{self.headers.get('Host') or '127.0.0.1'}"
+
+    def do_GET(self):
+        self.route("GET")
+
+    def do_POST(self):
+        self.route("POST")
+
+    def route(self, method: str):
+        url = urlsplit(self.path)
+        if url.path == "/__stats":
+            return self.send_json(asdict(self.state.stats))
+        self.state.count(url.path if not url.path.startswith("/c/") else "/c/")
+        if self.state.config.latency:
+            time.sleep(self.state.config.latency)
+        if url.path == "/login.php":
+            self.read_body()
+            return self.send_html(render_login_page())
+        if url.path == "/login_do.php" and method == "POST":
+            return self.login(parse_qs(self.read_body().decode("utf-8")))
+        if not self.logged_in():
+            if url.path == "/down.php":
+                return self.send_error(HTTPStatus.FORBIDDEN)
+            return self.redirect("/login.php")
+        if url.path == "/myfollow.php":
+            return self.send_html(
+                render_follow_page(self.host, self.state.config.comics)
+            )
+        match = re.match(r"^/c/(\d+)\.htm$", url.path)
+        if match and 0 < int(match.group(1)) <= self.state.config.comics:
+            return self.send_html(
+                render_detail_page(
+                    int(match.group(1)),
+                    self.state.config.chapters,
+                    self.state.config.chapter_size,
+                )
+            )
+        if url.path == "/down.php":
+            query = parse_qs(url.query)
+            return self.download(int(query["bookid"][0]), int(query["vol"][0]))
+        self.send_error(HTTPStatus.NOT_FOUND)
+
+    def read_body(self) -> bytes:
+        return self.rfile.read(int(self.headers.get("Content-Length") or 0))
+
+    def logged_in(self) -> bool:
+        if not self.state.config.require_login:
+            return True
+        cookie = SimpleCookie(self.headers.get("Cookie") or "")
+        return (
+            SESSION_COOKIE in cookie
+            and cookie[SESSION_COOKIE].value in self.state.sessions
+        )
+
+    def login(self, form: Dict[str, List[str]]):
+        if form.get("email") != [USER_NAME] or form.get("passwd") != [PASSWORD]:
+            return self.send_html("<html><body>登錄失敗</body></html>")
+        token = secrets.token_hex(16)
+        with self.state.lock:
+            self.state.sessions.add(token)
+            self.state.stats.logins += 1
+        self.send_html(
+            "<html><body>登錄成功</body></html>",
+            headers={"Set-Cookie": f"{SESSION_COOKIE}={token}; Path=/; HttpOnly"},
+        )
+
+    def redirect(self, location: str):
+        self.send_response(HTTPStatus.FOUND)
+        self.send_header("Location", location)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def send_html(self, html: str, headers: Optional[Dict[str, str]] = None):
+        body = html.encode("utf-8")
+        self.send_response(HTTPStatus.OK)
+        self.send_header("Content-Type", "text/html; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_json(self, data):
+        body = json.dumps(data).encode("utf-8")
+        self.send_response(HTTPStatus.OK)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def download(self, comic_id: int, vol: int):
+        config = self.state.config
+        if not 0 < comic_id <= config.comics or not 0 <= vol < config.chapters:
+            return self.send_error(HTTPStatus.NOT_FOUND)
+        content = chapter_content(comic_id, vol, config.chapter_size)
+        fault = self.state.pick_fault()
+        if fault == "503":
+            return self.send_error(HTTPStatus.SERVICE_UNAVAILABLE)
+        if fault == "stall":
+            time.sleep(config.stall)
+        start, end = 0, len(content) - 1
+        requested_range = self.headers.get("Range")
+        if requested_range:
+            byte_range = parse_range(requested_range, len(content))
+            if byte_range is None:
+                self.send_response(HTTPStatus.REQUESTED_RANGE_NOT_SATISFIABLE)
+                self.send_header("Content-Range", f"bytes */{len(content)}")
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            start, end = byte_range
+            with self.state.lock:
+                self.state.stats.ranged_downloads += 1
+            self.send_response(HTTPStatus.PARTIAL_CONTENT)
+            self.send_header("Content-Range", f"bytes {start}-{end}/{len(content)}")
+        else:
+            self.send_response(HTTPStatus.OK)
+        self.send_header("Content-Type", "application/epub+zip")
+        self.send_header("Content-Length", str(end - start + 1))
+        self.send_header("Accept-Ranges", "bytes")
+        self.end_headers()
+        # A reset sends part of the body and then drops the connection
+        stop = start + (end - start + 1) // 2 if fault == "reset" else end + 1
+        self.send_body(content, start, stop)
+        if fault == "reset":
+            self.close_connection = True
+            return
+        with self.state.lock:
+            self.state.stats.downloads_completed += 1
+
+    def send_body(self, content: bytes, start: int, stop: int, chunk_size=65536):
+        bandwidth = self.state.config.bandwidth
+        started = time.monotonic()
+        sent = 0
+        for offset in range(start, stop, chunk_size):
+            chunk = content[offset : min(offset + chunk_size, stop)]
+            self.wfile.write(chunk)
+            self.state.sent(len(chunk))
+            sent += len(chunk)
+            if bandwidth:
+                delay = sent / bandwidth - (time.monotonic() - started)
+                if delay > 0:
+                    time.sleep(delay)
+
+
+class StandInServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address: Tuple[str, int], config: StandInConfig):
+        super().__init__(address, StandInHandler)
+        self.state = StandInState(config)
+
+    @property
+    def url(self) -> str:
+        host, port = self.server_address[:2]
+        if isinstance(host, bytes):
+            host = host.decode("ascii")
+        return f"http://{host}:{port}"
+
+
+def add_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument("--comics", type=int, default=5)
+    parser.add_argument("--chapters", type=int, default=20, help="chapters per comic")
+    parser.add_argument(
+        "--chapter-size", type=float, default=2.0, help="chapter size in MB"
+    )
+    parser.add_argument(
+        "--bandwidth",
+        type=float,
+        default=0.0,
+        help="download rate per connection in MB/s, 0 is unlimited",
+    )
+    parser.add_argument(
+        "--latency", type=float, default=0.0, help="response delay in seconds"
+    )
+    parser.add_argument(
+        "--fault-rate",
+        type=float,
+        default=0.0,
+        help="share of downloads that fail with one of --faults",
+    )
+    parser.add_argument(
+        "--faults", default=",".join(FAULTS), help=f"any of {', '.join(FAULTS)}"
+    )
+    parser.add_argument(
+        "--stall", type=float, default=5.0, help="seconds a stalled download waits"
+    )
+    parser.add_argument("--seed", type=int, default=0)
+
+
+def config_from_args(args: argparse.Namespace) -> StandInConfig:
+    faults = tuple(fault for fault in args.faults.split(",") if fault)
+    assert set(faults) <= set(FAULTS), f"faults must be any of {', '.join(FAULTS)}"
+    return StandInConfig(
+        comics=args.comics,
+        chapters=args.chapters,
+        chapter_size=int(args.chapter_size * 1024 * 1024),
+        bandwidth=int(args.bandwidth * 1024 * 1024),
+        latency=args.latency,
+        fault_rate=args.fault_rate,
+        faults=faults,
+        stall=args.stall,
+        seed=args.seed,
+    )
+
+
+def serve(config: StandInConfig, port: int = 0, ready=None):
+    server = StandInServer(("127.0.0.1", port), config)
+    if ready is not None:
+        ready.put(server.url)
+    server.serve_forever()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--port", type=int, default=8765)
+    add_arguments(parser)
+    args = parser.parse_args()
+    server = StandInServer(("127.0.0.1", args.port), config_from_args(args))
+    print(f"Serving on {server.url}, log in as {USER_NAME} / {PASSWORD}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
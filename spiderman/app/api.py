@@ -1,36 +1,30 @@
 from datetime import datetime
 import logging
-from typing import Annotated, List, Literal, Optional, Union
-from fastapi import APIRouter
+from typing import Annotated, Dict, List, Literal, Optional, Union
+from fastapi import APIRouter, Header, HTTPException
+from fastapi.responses import PlainTextResponse, StreamingResponse
 from pydantic import AfterValidator, BaseModel, Field, HttpUrl
 from scrapy import spiderloader
 from scrapy.utils import project
-from scrapy.crawler import CrawlerProcess
 from apscheduler.job import Job
 from cron_validator import CronValidator
-import multiprocessing
+import uuid
 from .schduler import scheduler
+from .metrics import render_metrics
+from .progress import stream_progress
+from .workers import worker_pool
 
 job_router = APIRouter(prefix="/jobs")
 spider_router = APIRouter(prefix="/spiders")
+metrics_router = APIRouter()
+download_router = APIRouter(prefix="/downloads")
 
 logger = logging.getLogger(__name__)
 
 
 def run_spider(**kwargs):
-    multiprocessing.set_start_method("spawn", force=True)
-    p = multiprocessing.Process(target=run_spider_in_process, kwargs=kwargs)
-    p.start()
-    p.join()
-
-
-def run_spider_in_process(name: str, **kwargs):
-    settings = project.get_project_settings()
-    spider_loader = spiderloader.SpiderLoader.from_settings(settings)
-    spider_class = spider_loader.load(name)
-    process = CrawlerProcess(settings)
-    process.crawl(spider_class, kwargs=kwargs)
-    process.start()
+    # Runs in an APScheduler thread, so it only hands the run to the workers
+    return worker_pool.submit(**kwargs)
 
 
 def spider_exists(name: Optional[str] = None):
@@ -86,9 +80,24 @@ def check_spider_exists(spiderName: str):
 SpiderName = Annotated[str, AfterValidator(check_spider_exists)]
 
 
+def check_comic(comic: str):
+    comic = comic.strip()
+    if not (comic.isdigit() or comic.startswith(("/", "http://", "https://"))):
+        raise ValueError(f"{comic} is neither a comic URL nor a comic ID")
+    return comic
+
+
+Comic = Annotated[str, AfterValidator(check_comic)]
+
+
 class SpiderIn(BaseModel):
     name: SpiderName
     proxy: Optional[HttpUrl] = Field(default=None)
+    # Crawls only these comics instead of the follow list
+    comics: List[Comic] = Field(default_factory=list)
+    # Splits the comics across this many workers, see WORKER_POOL_SIZE, or
+    # WORKER_SHARDS of them if unset
+    shards: Optional[int] = Field(default=None, ge=1, le=64)
 
 
 class JobOut(BaseModel):
@@ -101,13 +110,27 @@ def get_job_out(job: Job):
     return JobOut(job_id=job.id, trigger=job.kwargs, spider=job.kwargs)
 
 
+def get_job_kwargs(spider: SpiderIn, job_id: str):
+    # The job id travels with the arguments so the runs can be traced back
+    return {**spider.model_dump(mode="json"), "job_id": job_id}
+
+
+def get_run_history(job_id: Optional[str] = None, limit: int = 10):
+    if worker_pool.run_store is None:
+        return []
+    if job_id is None:
+        return worker_pool.run_store.get_runs(limit=limit)
+    return worker_pool.run_store.get_job_runs(job_id, limit=limit)
+
+
 @spider_router.post("/run")
 def run(spider: SpiderIn):
-    spider_kwargs = spider.model_dump()
+    job_id = uuid.uuid4().hex
     job = scheduler.add_job(
         run_spider,
-        kwargs=spider_kwargs,
-        next_run_time=datetime.now(),
+        id=job_id,
+        kwargs=get_job_kwargs(spider, job_id),
+        next_run_time=datetime.now(scheduler.timezone),
     )
     return {"job_id": job.id}
 
@@ -121,21 +144,48 @@ def get_jobs():
             "kwargs": job.kwargs,
             "trigger": repr(job.trigger),
             "next_run_time": job.next_run_time,
+            "runs": get_run_history(job.id, limit=5),
         }
         for job in jobs
     ]
 
 
+@job_router.get("/runs")
+def get_runs(limit: int = 50):
+    return get_run_history(limit=limit)
+
+
+@job_router.get("/{job_id}/progress")
+def get_progress(job_id: str, last_event_id: Optional[int] = Header(default=None)):
+    # Either the id of a run or of the job that submitted it, a scheduled job
+    # is streamed once it runs.
+    if worker_pool.progress.get(job_id) is None and scheduler.get_job(job_id) is None:
+        raise HTTPException(status_code=404, detail=f"No progress for job {job_id}")
+    return StreamingResponse(
+        stream_progress(
+            lambda: worker_pool.progress.get(job_id),
+            lambda: scheduler.get_job(job_id) is not None,
+            last_event_id or 0,
+        ),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
 @job_router.post("")
 def add_job(spider: SpiderIn, trigger: TriggerIn):
-    spider_kwargs = spider.model_dump()
+    job_id = uuid.uuid4().hex
     trigger_kwargs = trigger.model_dump(
         exclude={
             "triger",
         }
     )
     job = scheduler.add_job(
-        run_spider, kwargs=spider_kwargs, trigger=trigger.triger, **trigger_kwargs
+        run_spider,
+        id=job_id,
+        kwargs=get_job_kwargs(spider, job_id),
+        trigger=trigger.triger,
+        **trigger_kwargs,
     )
     return {"job_id": job.id}
 
@@ -145,3 +195,40 @@ def get():
     settings = project.get_project_settings()
     spider_loader = spiderloader.SpiderLoader.from_settings(settings)
     return spider_loader.list()
+
+
+@metrics_router.get("/metrics", response_class=PlainTextResponse)
+def metrics():
+    return PlainTextResponse(
+        render_metrics(worker_pool), media_type="text/plain; version=0.0.4"
+    )
+
+
+class BandwidthIn(BaseModel):
+    # Bytes per second, 0 lifts the limit
+    rate: Optional[int] = Field(default=None, ge=0)
+    hosts: Dict[str, Annotated[int, Field(ge=0)]] = Field(default_factory=dict)
+
+
+def get_bandwidth_out():
+    rate, hosts = worker_pool.get_bandwidth().get_rates()
+    return {"rate": rate, "hosts": hosts}
+
+
+@download_router.get("/bandwidth")
+def get_bandwidth():
+    return get_bandwidth_out()
+
+
+@download_router.put("/bandwidth")
+def set_bandwidth(bandwidth: BandwidthIn):
+    # Applies to the downloads already running in the workers
+    limiter = worker_pool.get_bandwidth()
+    try:
+        if bandwidth.rate is not None:
+            limiter.set_rate(bandwidth.rate)
+        for host, rate in bandwidth.hosts.items():
+            limiter.set_rate(rate, host)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return get_bandwidth_out()
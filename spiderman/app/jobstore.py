@@ -0,0 +1,276 @@
+import json
+import logging
+import os
+import pickle
+import sqlite3
+import threading
+from typing import Any, Dict, List, Optional
+
+from apscheduler.job import Job
+from apscheduler.jobstores.base import BaseJobStore, ConflictingIdError, JobLookupError
+from apscheduler.util import datetime_to_utc_timestamp, utc_timestamp_to_datetime
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_JOBSTORE = ".scheduler/jobs.sqlite"
+
+
+def connect(filename: str) -> sqlite3.Connection:
+    if os.path.dirname(filename):
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+    # Used from the scheduler thread, the API threads and the worker monitor
+    connection = sqlite3.connect(filename, check_same_thread=False)
+    connection.execute("PRAGMA journal_mode=WAL")
+    return connection
+
+
+class SQLiteJobStore(BaseJobStore):
+    """APScheduler job store on the standard sqlite3 module, laid out like
+    the SQLAlchemyJobStore so schedules survive restarts of the API."""
+
+    def __init__(
+        self,
+        filename: str,
+        tablename: str = "apscheduler_jobs",
+        pickle_protocol: int = pickle.HIGHEST_PROTOCOL,
+    ):
+        super().__init__()
+        self.filename = filename
+        self.tablename = tablename
+        self.pickle_protocol = pickle_protocol
+        self.connection: Optional[sqlite3.Connection] = None
+        self.lock = threading.RLock()
+
+    def start(self, scheduler, alias):
+        super().start(scheduler, alias)
+        self.execute(
+            f"""
+            CREATE TABLE IF NOT EXISTS {self.tablename} (
+                id TEXT PRIMARY KEY,
+                next_run_time REAL,
+                job_state BLOB NOT NULL
+            )
+            """
+        )
+        self.execute(
+            f"CREATE INDEX IF NOT EXISTS ix_{self.tablename}_next_run_time "
+            f"ON {self.tablename} (next_run_time)"
+        )
+
+    def execute(self, sql: str, parameters=()) -> sqlite3.Cursor:
+        with self.lock:
+            # Like disposing an engine, a shut down store connects again
+            # if the scheduler thread still looks for due jobs.
+            if self.connection is None:
+                self.connection = connect(self.filename)
+            with self.connection:
+                return self.connection.execute(sql, parameters)
+
+    def lookup_job(self, job_id):
+        row = self.execute(
+            f"SELECT job_state FROM {self.tablename} WHERE id = ?", (job_id,)
+        ).fetchone()
+        return self._reconstitute_job(row[0]) if row else None
+
+    def get_due_jobs(self, now):
+        return self._get_jobs(
+            "WHERE next_run_time <= ?", (datetime_to_utc_timestamp(now),)
+        )
+
+    def get_next_run_time(self):
+        row = self.execute(
+            f"SELECT next_run_time FROM {self.tablename} "
+            "WHERE next_run_time IS NOT NULL ORDER BY next_run_time LIMIT 1"
+        ).fetchone()
+        return utc_timestamp_to_datetime(row[0]) if row else None
+
+    def get_all_jobs(self):
+        jobs = self._get_jobs()
+        self._fix_paused_jobs_sorting(jobs)
+        return jobs
+
+    def add_job(self, job):
+        try:
+            self.execute(
+                f"INSERT INTO {self.tablename} (id, next_run_time, job_state) VALUES (?, ?, ?)",
+                (
+                    job.id,
+                    datetime_to_utc_timestamp(job.next_run_time),
+                    pickle.dumps(job.__getstate__(), self.pickle_protocol),
+                ),
+            )
+        except sqlite3.IntegrityError:
+            raise ConflictingIdError(job.id)
+
+    def update_job(self, job):
+        cursor = self.execute(
+            f"UPDATE {self.tablename} SET next_run_time = ?, job_state = ? WHERE id = ?",
+            (
+                datetime_to_utc_timestamp(job.next_run_time),
+                pickle.dumps(job.__getstate__(), self.pickle_protocol),
+                job.id,
+            ),
+        )
+        if cursor.rowcount == 0:
+            raise JobLookupError(job.id)
+
+    def remove_job(self, job_id):
+        cursor = self.execute(f"DELETE FROM {self.tablename} WHERE id = ?", (job_id,))
+        if cursor.rowcount == 0:
+            raise JobLookupError(job_id)
+
+    def remove_all_jobs(self):
+        self.execute(f"DELETE FROM {self.tablename}")
+
+    def shutdown(self):
+        with self.lock:
+            if self.connection is not None:
+                self.connection.close()
+                self.connection = None
+
+    def _reconstitute_job(self, job_state: bytes) -> Job:
+        state = pickle.loads(job_state)
+        state["jobstore"] = self
+        job = Job.__new__(Job)
+        job.__setstate__(state)
+        job._scheduler = self._scheduler
+        job._jobstore_alias = self._alias
+        return job
+
+    def _get_jobs(self, where: str = "", parameters=()) -> List[Job]:
+        jobs = []
+        failed_job_ids = []
+        rows = self.execute(
+            f"SELECT id, job_state FROM {self.tablename} {where} ORDER BY next_run_time",
+            parameters,
+        ).fetchall()
+        for job_id, job_state in rows:
+            try:
+                jobs.append(self._reconstitute_job(job_state))
+            except Exception:
+                self._logger.exception(
+                    f"Unable to restore job '{job_id}' -- removing it"
+                )
+                failed_job_ids.append(job_id)
+        for job_id in failed_job_ids:
+            self.execute(f"DELETE FROM {self.tablename} WHERE id = ?", (job_id,))
+        return jobs
+
+    def __repr__(self):
+        return f"<{self.__class__.__name__} (filename={self.filename})>"
+
+
+class CrawlRunStore:
+    """History of crawl runs, kept next to the scheduled jobs."""
+
+    COLUMNS = (
+        "run_id",
+        "job_id",
+        "run_key",
+        "name",
+        "kwargs",
+        "state",
+        "coalesced",
+        "worker_pid",
+        "submitted_at",
+        "started_at",
+        "finished_at",
+        "finish_reason",
+        "shards",
+        "stats",
+    )
+
+    def __init__(self, filename: str):
+        self.filename = filename
+        self.connection = connect(filename)
+        self.lock = threading.Lock()
+        with self.lock, self.connection:
+            self.connection.execute(
+                """
+                CREATE TABLE IF NOT EXISTS crawl_runs (
+                    run_id TEXT PRIMARY KEY,
+                    job_id TEXT,
+                    run_key TEXT NOT NULL,
+                    name TEXT NOT NULL,
+                    kwargs TEXT NOT NULL,
+                    state TEXT NOT NULL,
+                    coalesced INTEGER NOT NULL DEFAULT 0,
+                    worker_pid INTEGER,
+                    submitted_at REAL NOT NULL,
+                    started_at REAL,
+                    finished_at REAL,
+                    finish_reason TEXT,
+                    shards INTEGER NOT NULL DEFAULT 1,
+                    stats TEXT
+                )
+                """
+            )
+            # Stores created before runs had shards and kept their stats
+            columns = {
+                row[1]
+                for row in self.connection.execute("PRAGMA table_info(crawl_runs)")
+            }
+            for column, definition in (
+                ("shards", "INTEGER NOT NULL DEFAULT 1"),
+                ("stats", "TEXT"),
+            ):
+                if column not in columns:
+                    self.connection.execute(
+                        f"ALTER TABLE crawl_runs ADD COLUMN {column} {definition}"
+                    )
+            self.connection.execute(
+                "CREATE INDEX IF NOT EXISTS ix_crawl_runs_job_id ON crawl_runs (job_id, submitted_at)"
+            )
+            # Runs of a previous API process can't be running anymore
+            self.connection.execute(
+                """
+                UPDATE crawl_runs SET state = 'failed', finish_reason = 'interrupted'
+                WHERE state IN ('pending', 'queued', 'running')
+                """
+            )
+
+    def save(self, run: Dict[str, Any]):
+        values = {
+            **run,
+            "kwargs": json.dumps(run["kwargs"], default=str),
+            "stats": json.dumps(run["stats"], default=str)
+            if run.get("stats") is not None
+            else None,
+        }
+        with self.lock, self.connection:
+            self.connection.execute(
+                f"""
+                INSERT OR REPLACE INTO crawl_runs ({", ".join(self.COLUMNS)})
+                VALUES ({", ".join("?" for _ in self.COLUMNS)})
+                """,
+                tuple(values.get(column) for column in self.COLUMNS),
+            )
+
+    def query(self, where: str = "", parameters=(), limit: int = 50) -> List[Dict[str, Any]]:
+        with self.lock:
+            rows = self.connection.execute(
+                f"SELECT {', '.join(self.COLUMNS)} FROM crawl_runs {where} "
+                "ORDER BY submitted_at DESC LIMIT ?",
+                (*parameters, limit),
+            ).fetchall()
+        runs = []
+        for row in rows:
+            run = dict(zip(self.COLUMNS, row))
+            run["kwargs"] = json.loads(run["kwargs"])
+            run["stats"] = json.loads(run["stats"]) if run["stats"] else None
+            run["duration"] = (
+                run["finished_at"] - run["started_at"]
+                if run["finished_at"] is not None and run["started_at"] is not None
+                else None
+            )
+            runs.append(run)
+        return runs
+
+    def get_runs(self, limit: int = 50) -> List[Dict[str, Any]]:
+        return self.query(limit=limit)
+
+    def get_job_runs(self, job_id: str, limit: int = 10) -> List[Dict[str, Any]]:
+        return self.query("WHERE job_id = ?", (job_id,), limit=limit)
+
+    def close(self):
+        self.connection.close()
@@ -1,22 +1,70 @@
+from typing import Optional
+
 import click
 from .schduler import scheduler
 from fastapi import FastAPI
 from . import api
+from .workers import worker_pool
 
 app = FastAPI()
 app.include_router(api.job_router)
 app.include_router(api.spider_router)
+app.include_router(api.metrics_router)
+app.include_router(api.download_router)
 
 def init_scheduler():
     scheduler.start()
 
+def init_worker_pool():
+    if worker_pool.size > 0:
+        worker_pool.start()
+
 @app.on_event("startup")
 async def startup_event():
+    init_worker_pool()
     init_scheduler()
 
-@click.command()
+@app.on_event("shutdown")
+async def shutdown_event():
+    scheduler.shutdown(wait=False)
+    worker_pool.stop()
+
+@click.group(invoke_without_command=True)
 @click.option("--host", default="0.0.0.0")
 @click.option("--port", default=8000)
-def run(host: str, port: int):
+@click.option("--workers", type=int, default=None, help="Crawler worker processes, 0 starts a process per job")
+@click.pass_context
+def run(ctx: click.Context, host: str, port: int, workers: Optional[int]):
+    if ctx.invoked_subcommand is not None:
+        return
     import uvicorn
+    if workers is not None:
+        worker_pool.size = workers
     uvicorn.run(app, host=host, port=port)
+
+@run.command()
+@click.option("--concurrency", type=int, default=None, help="Chapters downloaded at the same time, COMIC_DOWNLOAD_QUEUE_CONCURRENCY by default")
+@click.option("--queue", default=None, help="Queue file, COMIC_DOWNLOAD_QUEUE by default")
+@click.option("--once", is_flag=True, help="Exit once the queue is empty instead of waiting for more chapters")
+def download(concurrency: Optional[int], queue: Optional[str], once: bool):
+    """Download the chapters queued in COMIC_DOWNLOAD_QUEUE by the crawls."""
+    import asyncio
+    import signal
+    from scrapy.utils.log import configure_logging
+    from scrapy.utils.project import get_project_settings
+    from spiderman.download_worker import DownloadWorker
+
+    settings = get_project_settings()
+    if queue:
+        settings.set("COMIC_DOWNLOAD_QUEUE", queue, priority="cmdline")
+    configure_logging(settings)
+    download_worker = DownloadWorker.from_settings(settings, concurrency=concurrency)
+
+    async def main():
+        asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, download_worker.stop)
+        await download_worker.run(once=once)
+
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,170 @@
+import threading
+import time
+from collections import defaultdict
+from dataclasses import dataclass, field
+from typing import TYPE_CHECKING, DefaultDict, Dict, List, Tuple
+
+from spiderman.metrics import (
+    CHAPTER_STATUSES,
+    DOWNLOAD_BYTES,
+    DOWNLOAD_RETRIES,
+    LOGINS,
+    RENDER_LATENCY,
+    RENDER_LATENCY_BUCKETS,
+    chapter_status_key,
+)
+
+if TYPE_CHECKING:
+    from .workers import CrawlerWorkerPool
+
+
+@dataclass
+class LiveRunMetrics:
+    spider: str
+    values: Dict[str, float] = field(default_factory=dict)
+    updated_at: float = field(default_factory=time.monotonic)
+    throughput: float = field(default=0.0)
+
+
+class CrawlMetrics:
+    """Sums the crawl stats the workers send for every run, the stats of a
+    finished run are folded into the totals."""
+
+    def __init__(self, stale_after: float = 30.0):
+        self.stale_after = stale_after
+        self.totals: DefaultDict[Tuple[str, str], float] = defaultdict(float)
+        self.live: Dict[str, LiveRunMetrics] = {}
+        self.lock = threading.Lock()
+
+    def update(self, run_id: str, spider: str, values: Dict[str, float]):
+        now = time.monotonic()
+        with self.lock:
+            run = self.live.get(run_id)
+            if run is None:
+                run = self.live[run_id] = LiveRunMetrics(spider)
+            elif now > run.updated_at:
+                run.throughput = (
+                    values.get(DOWNLOAD_BYTES, 0) - run.values.get(DOWNLOAD_BYTES, 0)
+                ) / (now - run.updated_at)
+            run.values = values
+            run.updated_at = now
+
+    def complete(self, run_id: str):
+        with self.lock:
+            run = self.live.pop(run_id, None)
+            if run is None:
+                return
+            for key, value in run.values.items():
+                self.totals[(run.spider, key)] += value
+
+    def collect(self) -> Dict[Tuple[str, str], float]:
+        with self.lock:
+            values = dict(self.totals)
+            for run in self.live.values():
+                for key, value in run.values.items():
+                    values[(run.spider, key)] = values.get((run.spider, key), 0) + value
+            return values
+
+    def throughput(self) -> Dict[str, float]:
+        now = time.monotonic()
+        result: DefaultDict[str, float] = defaultdict(float)
+        with self.lock:
+            for run in self.live.values():
+                # A run that stopped reporting isn't downloading anything
+                if now - run.updated_at <= self.stale_after:
+                    result[run.spider] += run.throughput
+        return dict(result)
+
+
+def format_labels(**labels: str) -> str:
+    if not labels:
+        return ""
+    escaped = (
+        name
+        + '="'
+        + value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        + '"'
+        for name, value in labels.items()
+    )
+    return "{" + ",".join(escaped) + "}"
+
+
+def format_value(value: float) -> str:
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+def render_metrics(pool: "CrawlerWorkerPool") -> str:
+    values = pool.metrics.collect()
+    spiders = sorted({spider for spider, _ in values} | set(pool.metrics.throughput()))
+    lines: List[str] = []
+
+    def metric(name: str, kind: str, help: str):
+        lines.append(f"# HELP {name} {help}")
+        lines.append(f"# TYPE {name} {kind}")
+
+    def sample(name: str, value: float, **labels: str):
+        lines.append(f"{name}{format_labels(**labels)} {format_value(value)}")
+
+    def counter(name: str, help: str, key: str):
+        metric(name, "counter", help)
+        for spider in spiders:
+            sample(name, values.get((spider, key), 0), spider=spider)
+
+    counter(
+        "spiderman_download_bytes_total",
+        "Bytes of chapter files downloaded.",
+        DOWNLOAD_BYTES,
+    )
+    metric(
+        "spiderman_download_throughput_bytes",
+        "gauge",
+        "Current download rate in bytes per second.",
+    )
+    throughput = pool.metrics.throughput()
+    for spider in spiders:
+        sample("spiderman_download_throughput_bytes", throughput.get(spider, 0), spider=spider)
+    metric("spiderman_chapters_total", "counter", "Chapters by download outcome.")
+    for spider in spiders:
+        for status in CHAPTER_STATUSES:
+            sample(
+                "spiderman_chapters_total",
+                values.get((spider, chapter_status_key(status)), 0),
+                spider=spider,
+                status=status,
+            )
+    counter(
+        "spiderman_download_retries_total",
+        "Retried chapter downloads.",
+        DOWNLOAD_RETRIES,
+    )
+    counter("spiderman_logins_total", "Logins performed by spiders.", LOGINS)
+    metric(
+        "spiderman_render_latency_seconds",
+        "histogram",
+        "Time to render a page with Playwright.",
+    )
+    for spider in spiders:
+        for bucket in RENDER_LATENCY_BUCKETS:
+            sample(
+                "spiderman_render_latency_seconds_bucket",
+                values.get((spider, f"{RENDER_LATENCY}/bucket/{bucket}"), 0),
+                spider=spider,
+                le=str(bucket),
+            )
+        count = values.get((spider, f"{RENDER_LATENCY}/count"), 0)
+        sample("spiderman_render_latency_seconds_bucket", count, spider=spider, le="+Inf")
+        sample(
+            "spiderman_render_latency_seconds_sum",
+            values.get((spider, f"{RENDER_LATENCY}/sum"), 0),
+            spider=spider,
+        )
+        sample("spiderman_render_latency_seconds_count", count, spider=spider)
+    metric("spiderman_jobs", "gauge", "Crawl runs by state.")
+    states = pool.count_runs()
+    for state in ("pending", "queued", "running"):
+        sample("spiderman_jobs", states.get(state, 0), state=state)
+    metric("spiderman_active_jobs", "gauge", "Crawl runs in progress.")
+    sample("spiderman_active_jobs", states.get("running", 0))
+    metric("spiderman_workers", "gauge", "Live crawler worker processes.")
+    sample("spiderman_workers", len(pool.workers))
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,129 @@
+import asyncio
+import json
+import threading
+import time
+from collections import OrderedDict, deque
+from dataclasses import dataclass, field
+from typing import Any, AsyncIterator, Callable, Deque, Dict, List, Optional, Tuple
+
+
+@dataclass
+class ProgressEvent:
+    id: int
+    type: str
+    data: Dict[str, Any]
+
+    def format(self) -> str:
+        return f"id: {self.id}\nevent: {self.type}\ndata: {json.dumps(self.data, default=str)}\n\n"
+
+
+class RunProgress:
+    """Latest progress events of a crawl run. Only the newest events are kept,
+    a slow reader skips the older ones instead of holding up the run."""
+
+    def __init__(self, run_id: str, max_events: int = 1000):
+        self.run_id = run_id
+        self.events: Deque[ProgressEvent] = deque(maxlen=max_events)
+        self.last_id = 0
+        self.closed = False
+        self.lock = threading.Lock()
+
+    def publish(self, type: str, data: Optional[Dict[str, Any]] = None, close: bool = False):
+        with self.lock:
+            if self.closed:
+                return
+            self.last_id += 1
+            self.events.append(
+                ProgressEvent(
+                    self.last_id,
+                    type,
+                    {"run_id": self.run_id, "time": time.time(), **(data or {})},
+                )
+            )
+            self.closed = close
+
+    def since(self, last_id: int) -> Tuple[List[ProgressEvent], bool]:
+        with self.lock:
+            return [event for event in self.events if event.id > last_id], self.closed
+
+
+class CrawlProgress:
+    """Progress of the recent runs, by run id and by the id of the scheduled
+    job that submitted them."""
+
+    def __init__(self, max_runs: int = 100, max_events: int = 1000):
+        self.max_runs = max_runs
+        self.max_events = max_events
+        self.runs: "OrderedDict[str, RunProgress]" = OrderedDict()
+        self.job_runs: Dict[str, str] = {}
+        self.lock = threading.Lock()
+
+    def add_run(self, run_id: str, job_id: Optional[str] = None) -> RunProgress:
+        with self.lock:
+            progress = self.runs.get(run_id)
+            if progress is None:
+                progress = self.runs[run_id] = RunProgress(run_id, self.max_events)
+                self.evict()
+            if job_id is not None:
+                self.job_runs[job_id] = run_id
+            return progress
+
+    def evict(self):
+        # Finished runs go first, oldest first
+        for run_id in [run_id for run_id, run in self.runs.items() if run.closed]:
+            if len(self.runs) <= self.max_runs:
+                break
+            del self.runs[run_id]
+        self.job_runs = {
+            job_id: run_id for job_id, run_id in self.job_runs.items() if run_id in self.runs
+        }
+
+    def publish(self, run_id: str, type: str, data: Optional[Dict[str, Any]] = None, close: bool = False):
+        with self.lock:
+            progress = self.runs.get(run_id)
+        if progress is not None:
+            progress.publish(type, data, close)
+
+    def get(self, id: str) -> Optional[RunProgress]:
+        with self.lock:
+            return self.runs.get(self.job_runs.get(id, id))
+
+
+async def stream_progress(
+    get_progress: Callable[[], Optional[RunProgress]],
+    is_scheduled: Callable[[], bool],
+    last_id: int = 0,
+    poll_interval: float = 0.5,
+    keepalive_interval: float = 15.0,
+    submit_timeout: float = 10.0,
+) -> AsyncIterator[str]:
+    # Polls instead of waking up readers from the monitor thread, which then
+    # never waits for a client.
+    idle = unscheduled = 0.0
+    progress = get_progress()
+    while progress is None:
+        # The scheduler hasn't submitted the job yet. It removes a job that
+        # runs once right before the executor submits it, so a job that is
+        # gone gets a moment to show up.
+        if not is_scheduled():
+            unscheduled += poll_interval
+            if unscheduled > submit_timeout:
+                return
+        idle += poll_interval
+        if idle >= keepalive_interval:
+            idle = 0.0
+            yield ": keepalive\n\n"
+        await asyncio.sleep(poll_interval)
+        progress = get_progress()
+    while True:
+        events, closed = progress.since(last_id)
+        for event in events:
+            last_id = event.id
+            yield event.format()
+        if closed:
+            return
+        idle = 0.0 if events else idle + poll_interval
+        if idle >= keepalive_interval:
+            idle = 0.0
+            yield ": keepalive\n\n"
+        await asyncio.sleep(poll_interval)
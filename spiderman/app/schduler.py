@@ -2,12 +2,19 @@ import logging
 
 from apscheduler.jobstores.memory import MemoryJobStore
 from apscheduler.schedulers.background import BackgroundScheduler
+from scrapy.utils import project
+
+from .jobstore import DEFAULT_JOBSTORE, SQLiteJobStore
+
+jobstore_filename = project.get_project_settings().get(
+    "SCHEDULER_JOBSTORE", DEFAULT_JOBSTORE
+)
 
 jobstores = {
-    'default': MemoryJobStore()
+    'default': SQLiteJobStore(jobstore_filename) if jobstore_filename else MemoryJobStore()
 }
 
 scheduler = BackgroundScheduler(jobstores=jobstores, timezone='Asia/Shanghai')
 
 logging.basicConfig()
-logging.getLogger('apscheduler').setLevel(logging.DEBUG)
\ No newline at end of file
+logging.getLogger('apscheduler').setLevel(logging.DEBUG)
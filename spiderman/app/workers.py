@@ -0,0 +1,572 @@
+import json
+import logging
+import multiprocessing
+import os
+import queue
+import resource
+import signal
+import threading
+import time
+import uuid
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Literal, Optional
+
+from scrapy.utils.project import get_project_settings
+
+from spiderman.bandwidth import BandwidthLimiter
+from spiderman.metrics import merge_stats
+
+from .jobstore import DEFAULT_JOBSTORE, CrawlRunStore
+from .metrics import CrawlMetrics
+from .progress import CrawlProgress
+
+logger = logging.getLogger(__name__)
+
+JobState = Literal["pending", "queued", "running", "finished", "failed"]
+
+
+@dataclass
+class CrawlJob:
+    run_id: str
+    name: str
+    kwargs: Dict[str, Any] = field(default_factory=dict)
+
+
+@dataclass
+class CrawlShard:
+    # One of the jobs a sharded run is split into
+    index: int
+    job: CrawlJob
+    state: JobState = field(default="pending")
+    worker_pid: Optional[int] = field(default=None)
+    finish_reason: Optional[str] = field(default=None)
+    stats: Dict[str, Any] = field(default_factory=dict)
+
+
+@dataclass
+class CrawlJobRun:
+    job: CrawlJob
+    # Id of the scheduled job that triggered the run
+    job_id: Optional[str] = field(default=None)
+    key: str = field(default="")
+    state: JobState = field(default="pending")
+    coalesced: int = field(default=0)
+    worker_pid: Optional[int] = field(default=None)
+    submitted_at: float = field(default_factory=time.time)
+    started_at: Optional[float] = field(default=None)
+    finished_at: Optional[float] = field(default=None)
+    finish_reason: Optional[str] = field(default=None)
+    # Final crawl stats, merged over the shards of a sharded run
+    stats: Optional[Dict[str, Any]] = field(default=None)
+    shards: List[CrawlShard] = field(default_factory=list)
+
+    @property
+    def run_id(self) -> str:
+        return self.job.run_id
+
+    def get_shard(self, run_id: str) -> Optional[CrawlShard]:
+        return next((shard for shard in self.shards if shard.job.run_id == run_id), None)
+
+    def to_record(self) -> Dict[str, Any]:
+        return {
+            "run_id": self.run_id,
+            "job_id": self.job_id,
+            "run_key": self.key,
+            "name": self.job.name,
+            "kwargs": self.job.kwargs,
+            "state": self.state,
+            "coalesced": self.coalesced,
+            "worker_pid": self.worker_pid,
+            "submitted_at": self.submitted_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+            "finish_reason": self.finish_reason,
+            "shards": len(self.shards) or 1,
+            "stats": self.stats,
+        }
+
+
+def current_rss() -> int:
+    # Resident set size in bytes, ru_maxrss is only the peak but is the best
+    # there is where /proc doesn't exist.
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def worker_main(
+    job_queue: multiprocessing.Queue,
+    event_queue: multiprocessing.Queue,
+    max_jobs: int,
+    max_memory: int,
+    bandwidth: Optional[BandwidthLimiter] = None,
+):
+    # Ctrl+C reaches the whole process group, the pool stops the workers.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    from scrapy import spiderloader
+    from scrapy.crawler import CrawlerRunner
+    from scrapy.utils import project
+    from scrapy.utils.log import configure_logging
+    from scrapy.utils.reactor import install_reactor
+
+    from spiderman import signals
+    from spiderman.metrics import snapshot
+
+    install_reactor("twisted.internet.asyncioreactor.AsyncioSelectorReactor")
+    from twisted.internet import reactor
+    from twisted.internet.task import LoopingCall
+
+    settings = project.get_project_settings()
+    configure_logging(settings)
+    if bandwidth is not None:
+        settings.set("COMIC_DOWNLOAD_BANDWIDTH_LIMITER", bandwidth)
+    spider_loader = spiderloader.SpiderLoader.from_settings(settings)
+    # Importing every spider up front is what makes the worker warm
+    spider_classes = {name: spider_loader.load(name) for name in spider_loader.list()}
+    runner = CrawlerRunner(settings)
+    metrics_interval = settings.getfloat("WORKER_METRICS_INTERVAL", 5.0)
+    pid = os.getpid()
+    progress_signals = {
+        signals.comic_discovered: "comic_discovered",
+        signals.chapter_queued: "chapter_queued",
+        signals.chapter_progress: "chapter_progress",
+        signals.chapter_status: "chapter_status",
+    }
+
+    def run_job(job: CrawlJob, done: threading.Event):
+        # A job that fails before its crawl is running still has to be
+        # reported, or its run stays running and the worker waits for good.
+        try:
+            start_job(job, done)
+        except Exception as e:
+            logger.exception(f"Job '{job.run_id}' failed to start")
+            event_queue.put(("failed", pid, job.run_id, repr(e)))
+            done.set()
+
+    def start_job(job: CrawlJob, done: threading.Event):
+        crawler = runner.create_crawler(spider_classes[job.name])
+
+        def forward_progress(signal, sender, **kwargs):
+            # The queue is unbounded and putting never blocks, chapter
+            # progress comes at most once per COMIC_DOWNLOAD_PROGRESS_INTERVAL.
+            event_queue.put(("progress", pid, job.run_id, (progress_signals[signal], kwargs)))
+
+        for progress_signal in progress_signals:
+            crawler.signals.connect(forward_progress, progress_signal, weak=False)
+        # Spider arguments left unset keep the defaults of the spider
+        deferred = runner.crawl(
+            crawler, **{key: value for key, value in job.kwargs.items() if value is not None}
+        )
+
+        def export_metrics():
+            # Putting on the queue never blocks, a feeder thread sends it
+            if crawler.stats is not None:
+                event_queue.put(
+                    ("metrics", pid, job.run_id, snapshot(crawler.stats.get_stats()))
+                )
+
+        exporter = LoopingCall(export_metrics)
+        exporter.start(metrics_interval, now=False)
+
+        def stop_exporting(result):
+            if exporter.running:
+                exporter.stop()
+            export_metrics()
+            return result
+
+        deferred.addBoth(stop_exporting)
+
+        def finished(result):
+            stats = crawler.stats.get_stats() if crawler.stats else {}
+            event_queue.put(("stats", pid, job.run_id, stats))
+            event_queue.put(
+                ("finished", pid, job.run_id, stats.get("finish_reason"))
+            )
+
+        def failed(failure):
+            logger.error(f"Job '{job.run_id}' failed: {failure.getErrorMessage()}")
+            event_queue.put(("failed", pid, job.run_id, failure.getErrorMessage()))
+
+        deferred.addCallbacks(finished, failed)
+        # Whatever happened, the worker goes on with the next job
+        deferred.addBoth(lambda _: done.set())
+
+    def take_jobs():
+        jobs = 0
+        while True:
+            job = job_queue.get()
+            if job is None:
+                break
+            event_queue.put(("started", pid, job.run_id, None))
+            if job.name not in spider_classes:
+                event_queue.put(("failed", pid, job.run_id, f"Unknown spider '{job.name}'"))
+                continue
+            done = threading.Event()
+            reactor.callFromThread(run_job, job, done)  # type: ignore
+            done.wait()
+            jobs += 1
+            if jobs >= max_jobs > 0:
+                logger.info(f"Worker {pid} ran {jobs} jobs, recycling")
+                break
+            if current_rss() >= max_memory > 0:
+                logger.info(
+                    f"Worker {pid} uses {current_rss() / 1024 / 1024:.0f} MB, recycling"
+                )
+                break
+        reactor.callFromThread(reactor.stop)  # type: ignore
+
+    threading.Thread(target=take_jobs, daemon=True).start()
+    event_queue.put(("ready", pid, None, None))
+    reactor.run(installSignalHandlers=False)  # type: ignore
+
+
+class CrawlerWorkerPool:
+    def __init__(
+        self,
+        size: int = 2,
+        max_jobs: int = 20,
+        max_memory: int = 0,
+        shards: int = 1,
+        run_store_filename: Optional[str] = None,
+        settings=None,
+    ):
+        self.size = size
+        self.max_jobs = max_jobs
+        self.max_memory = max_memory
+        self.shards = shards
+        self.run_store_filename = run_store_filename
+        self.run_store: Optional[CrawlRunStore] = None
+        self.settings = settings
+        self.context = multiprocessing.get_context("spawn")
+        self.bandwidth: Optional[BandwidthLimiter] = None
+        self.job_queue: Optional[multiprocessing.Queue] = None
+        self.event_queue: Optional[multiprocessing.Queue] = None
+        self.workers: Dict[int, Any] = {}
+        self.runs: Dict[str, CrawlJobRun] = {}
+        # The sharded run of every shard job that hasn't finished
+        self.shard_runs: Dict[str, CrawlJobRun] = {}
+        # The active and the waiting run of every spider and argument set
+        self.active_runs: Dict[str, CrawlJobRun] = {}
+        self.pending_runs: Dict[str, CrawlJobRun] = {}
+        self.metrics = CrawlMetrics()
+        self.progress = CrawlProgress()
+        self.lock = threading.RLock()
+        self.running = False
+        self._monitor: Optional[threading.Thread] = None
+
+    @classmethod
+    def from_settings(cls, settings) -> "CrawlerWorkerPool":
+        return cls(
+            size=settings.getint("WORKER_POOL_SIZE", 2),
+            max_jobs=settings.getint("WORKER_MAX_JOBS", 20),
+            max_memory=settings.getint("WORKER_MAX_MEMORY", 0) * 1024 * 1024,
+            shards=settings.getint("WORKER_SHARDS", 1),
+            run_store_filename=settings.get("SCHEDULER_JOBSTORE", DEFAULT_JOBSTORE),
+            settings=settings,
+        )
+
+    def start(self):
+        with self.lock:
+            if self.running:
+                return
+            # Opened here and not on import, workers import this module too
+            if self.run_store_filename and self.run_store is None:
+                self.run_store = CrawlRunStore(self.run_store_filename)
+            self.get_bandwidth()
+            self.job_queue = self.context.Queue()
+            self.event_queue = self.context.Queue()
+            self.running = True
+            for _ in range(self.size):
+                self.spawn_worker()
+        self._monitor = threading.Thread(target=self.monitor, daemon=True)
+        self._monitor.start()
+
+    def stop(self, timeout: float = 10.0):
+        with self.lock:
+            if not self.running:
+                return
+            self.running = False
+            workers = list(self.workers.values())
+        assert self.job_queue
+        for _ in workers:
+            self.job_queue.put(None)
+        deadline = time.monotonic() + timeout
+        for process in workers:
+            process.join(max(deadline - time.monotonic(), 0))
+            if process.is_alive():
+                process.terminate()
+        with self.lock:
+            self.workers = {}
+
+    def spawn_worker(self, max_jobs: Optional[int] = None):
+        process = self.context.Process(
+            target=worker_main,
+            args=(
+                self.job_queue,
+                self.event_queue,
+                self.max_jobs if max_jobs is None else max_jobs,
+                self.max_memory,
+                self.bandwidth,
+            ),
+            daemon=True,
+        )
+        process.start()
+        assert process.pid is not None
+        with self.lock:
+            self.workers[process.pid] = process
+        logger.info(f"Started crawler worker {process.pid}")
+
+    def get_bandwidth(self) -> BandwidthLimiter:
+        # In shared memory handed to every worker, created on first use
+        # since workers import this module too.
+        with self.lock:
+            if self.bandwidth is None:
+                self.bandwidth = (
+                    BandwidthLimiter.from_settings(self.settings, context=self.context)
+                    if self.settings is not None
+                    else BandwidthLimiter(context=self.context)
+                )
+            return self.bandwidth
+
+    @staticmethod
+    def get_run_key(name: str, kwargs: Dict[str, Any]) -> str:
+        return f"{name}:{json.dumps(kwargs, sort_keys=True, default=str)}"
+
+    def submit(
+        self,
+        name: str,
+        job_id: Optional[str] = None,
+        shards: Optional[int] = None,
+        **kwargs: Any,
+    ) -> str:
+        # Never waits for a worker. A run of the same spider and arguments
+        # that hasn't started yet absorbs the new one, while one is running
+        # a single follow-up run waits for it to finish. The shards don't
+        # count, the same comics split another way are still the same run.
+        if not self.running:
+            self.start()
+        shards = shards or self.shards
+        key = self.get_run_key(name, kwargs)
+        with self.lock:
+            waiting = self.pending_runs.get(key) or self.active_runs.get(key)
+            if waiting is not None and waiting.state in ("pending", "queued"):
+                waiting.coalesced += 1
+                logger.info(
+                    f"Spider '{name}' already has run '{waiting.run_id}' waiting, coalescing"
+                )
+                self.progress.add_run(waiting.run_id, job_id)
+                self.save_run(waiting)
+                return waiting.run_id
+            run = CrawlJobRun(
+                job=CrawlJob(run_id=uuid.uuid4().hex, name=name, kwargs=kwargs),
+                job_id=job_id,
+                key=key,
+            )
+            if shards > 1:
+                # Every shard is a job of its own that the spider is told to
+                # crawl its part of the comics in.
+                run.shards = [
+                    CrawlShard(
+                        index,
+                        CrawlJob(
+                            run_id=f"{run.run_id}-{index}",
+                            name=name,
+                            kwargs={**kwargs, "shard": index, "shards": shards},
+                        ),
+                    )
+                    for index in range(shards)
+                ]
+            self.runs[run.run_id] = run
+            self.progress.add_run(run.run_id, job_id)
+            if key in self.active_runs:
+                logger.info(
+                    f"Spider '{name}' is running as '{self.active_runs[key].run_id}', run '{run.run_id}' waits for it"
+                )
+                self.pending_runs[key] = run
+                self.save_run(run)
+                self.progress.publish(run.run_id, "job_pending", {"name": name})
+            else:
+                self.dispatch(run)
+            return run.run_id
+
+    def dispatch(self, run: CrawlJobRun):
+        assert self.job_queue
+        run.state = "queued"
+        self.active_runs[run.key] = run
+        self.save_run(run)
+        jobs = [shard.job for shard in run.shards] or [run.job]
+        for shard in run.shards:
+            shard.state = "queued"
+            self.shard_runs[shard.job.run_id] = run
+        for job in jobs:
+            self.job_queue.put(job)
+        self.progress.publish(
+            run.run_id, "job_queued", {"name": run.job.name, "shards": len(jobs)}
+        )
+        if self.size <= 0:
+            # Without a pool every run gets a worker of its own
+            for _ in jobs:
+                self.spawn_worker(max_jobs=1)
+
+    def complete(self, run: CrawlJobRun, state: JobState, finish_reason: Any):
+        if run.state not in ("queued", "running"):
+            return
+        run.state = state
+        run.finished_at = time.time()
+        run.finish_reason = finish_reason
+        self.save_run(run)
+        self.metrics.complete(run.run_id)
+        self.progress.publish(
+            run.run_id,
+            f"job_{state}",
+            {"finish_reason": finish_reason, "stats": run.stats},
+            close=True,
+        )
+        if self.run_store is not None:
+            # The store keeps the history
+            self.runs.pop(run.run_id, None)
+        if self.active_runs.get(run.key) is run:
+            del self.active_runs[run.key]
+        pending = self.pending_runs.pop(run.key, None)
+        if pending is not None and self.running:
+            self.dispatch(pending)
+
+    def complete_shard(
+        self, run: CrawlJobRun, shard: CrawlShard, state: JobState, finish_reason: Any
+    ):
+        if shard.state not in ("queued", "running"):
+            return
+        shard.state = state
+        shard.finish_reason = finish_reason
+        self.shard_runs.pop(shard.job.run_id, None)
+        self.metrics.complete(shard.job.run_id)
+        self.progress.publish(
+            run.run_id,
+            f"shard_{state}",
+            {"shard": shard.index, "finish_reason": finish_reason},
+        )
+        if any(shard.state in ("queued", "running") for shard in run.shards):
+            return
+        # The run fails with any of its shards, the others keep their part
+        reasons = {shard.finish_reason for shard in run.shards}
+        run.stats = merge_stats(shard.stats for shard in run.shards)
+        self.complete(
+            run,
+            "failed" if any(shard.state == "failed" for shard in run.shards) else "finished",
+            reasons.pop()
+            if len(reasons) == 1
+            else ", ".join(
+                f"shard {shard.index}: {shard.finish_reason}" for shard in run.shards
+            ),
+        )
+
+    def save_run(self, run: CrawlJobRun):
+        if self.run_store is not None:
+            self.run_store.save(run.to_record())
+
+    def get_runs(self) -> List[CrawlJobRun]:
+        with self.lock:
+            return list(self.runs.values())
+
+    def count_runs(self) -> Dict[str, int]:
+        with self.lock:
+            runs = [*self.active_runs.values(), *self.pending_runs.values()]
+            return {
+                state: sum(1 for run in runs if run.state == state)
+                for state in ("pending", "queued", "running")
+            }
+
+    def monitor(self):
+        while self.running:
+            try:
+                event = self.event_queue.get(timeout=1)  # type: ignore
+            except queue.Empty:
+                event = None
+            if event is not None:
+                self.handle_event(*event)
+            self.replace_exited_workers()
+
+    def handle_event(self, kind: str, pid: int, run_id: Optional[str], detail: Any):
+        with self.lock:
+            if run_id in self.shard_runs:
+                self.handle_shard_event(kind, pid, run_id, detail)
+                return
+            run = self.runs.get(run_id) if run_id else None
+            if run is None:
+                return
+            if kind == "started" and run.state == "queued":
+                run.state = "running"
+                run.worker_pid = pid
+                run.started_at = time.time()
+                self.save_run(run)
+                self.progress.publish(run.run_id, "job_started", {"worker_pid": pid})
+            elif kind == "metrics":
+                self.metrics.update(run.run_id, run.job.name, detail)
+            elif kind == "progress":
+                self.progress.publish(run.run_id, *detail)
+            elif kind == "stats":
+                run.stats = detail
+            elif kind in ("finished", "failed"):
+                self.complete(run, kind, detail)  # type: ignore
+
+    def handle_shard_event(self, kind: str, pid: int, run_id: str, detail: Any):
+        # The shards report as the run they belong to, the run starts with
+        # the first of them.
+        run = self.shard_runs[run_id]
+        shard = run.get_shard(run_id)
+        if shard is None:
+            return
+        if kind == "started" and shard.state == "queued":
+            shard.state = "running"
+            shard.worker_pid = pid
+            if run.state == "queued":
+                run.state = "running"
+                run.worker_pid = pid
+                run.started_at = time.time()
+                self.save_run(run)
+                self.progress.publish(run.run_id, "job_started", {"worker_pid": pid})
+            self.progress.publish(
+                run.run_id, "shard_started", {"shard": shard.index, "worker_pid": pid}
+            )
+        elif kind == "metrics":
+            self.metrics.update(run_id, run.job.name, detail)
+        elif kind == "progress":
+            type, data = detail
+            self.progress.publish(run.run_id, type, {**data, "shard": shard.index})
+        elif kind == "stats":
+            shard.stats = detail
+        elif kind in ("finished", "failed"):
+            self.complete_shard(run, shard, kind, detail)  # type: ignore
+
+    def replace_exited_workers(self):
+        with self.lock:
+            workers = list(self.workers.items())
+        for pid, process in workers:
+            if process.is_alive():
+                continue
+            # What the worker reported before exiting comes first
+            while True:
+                try:
+                    self.handle_event(*self.event_queue.get_nowait())  # type: ignore
+                except queue.Empty:
+                    break
+            with self.lock:
+                self.workers.pop(pid, None)
+                for run in list(self.active_runs.values()):
+                    for shard in run.shards:
+                        if shard.worker_pid == pid and shard.state == "running":
+                            self.complete_shard(
+                                run, shard, "failed", f"worker exited with {process.exitcode}"
+                            )
+                    if not run.shards and run.worker_pid == pid and run.state == "running":
+                        self.complete(
+                            run, "failed", f"worker exited with {process.exitcode}"
+                        )
+                if self.running and len(self.workers) < self.size:
+                    self.spawn_worker()
+
+
+worker_pool = CrawlerWorkerPool.from_settings(get_project_settings())
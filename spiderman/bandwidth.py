@@ -0,0 +1,134 @@
+import asyncio
+import multiprocessing
+import time
+from typing import Dict, Optional, Tuple
+
+# Layout of a bucket in the shared array
+RATE, TOKENS, UPDATED = range(3)
+BUCKET_SIZE = 3
+HOST_NAME_SIZE = 255
+
+
+class BandwidthLimiter:
+    """Token buckets for the download bandwidth in bytes per second, one for
+    all downloads and one per limited host. They live in shared memory so the
+    crawler workers of the API all draw from the same buckets, and a limit
+    changed in the API applies to the downloads already running. A rate of 0
+    is unlimited."""
+
+    def __init__(
+        self,
+        rate: int = 0,
+        hosts: Optional[Dict[str, int]] = None,
+        burst: float = 1.0,
+        max_hosts: int = 32,
+        context=None,
+    ):
+        context = context or multiprocessing.get_context()
+        # Seconds of the rate a full bucket holds
+        self.burst = burst
+        self.max_hosts = max_hosts
+        self.buckets = context.RawArray("d", (max_hosts + 1) * BUCKET_SIZE)
+        self.names = context.RawArray("c", max_hosts * HOST_NAME_SIZE)
+        self.lock = context.Lock()
+        self.set_rate(rate)
+        for host, host_rate in (hosts or {}).items():
+            self.set_rate(host_rate, host)
+
+    @classmethod
+    def from_settings(cls, settings, context=None) -> "BandwidthLimiter":
+        return cls(
+            rate=settings.getint("COMIC_DOWNLOAD_BANDWIDTH", 0),
+            hosts={
+                host: int(rate)
+                for host, rate in settings.getdict(
+                    "COMIC_DOWNLOAD_BANDWIDTH_PER_HOST"
+                ).items()
+            },
+            burst=settings.getfloat("COMIC_DOWNLOAD_BANDWIDTH_BURST", 1.0),
+            context=context,
+        )
+
+    def __deepcopy__(self, memo) -> "BandwidthLimiter":
+        # Copies of the settings must keep drawing from the same buckets
+        return self
+
+    def host_name(self, slot: int) -> str:
+        offset = (slot - 1) * HOST_NAME_SIZE
+        return self.names[offset : offset + HOST_NAME_SIZE].rstrip(b"\0").decode()
+
+    def find_slot(self, host: str) -> Optional[int]:
+        for slot in range(1, self.max_hosts + 1):
+            if self.host_name(slot) == host:
+                return slot
+        return None
+
+    def set_rate(self, rate: int, host: Optional[str] = None):
+        if rate < 0:
+            raise ValueError("Bandwidth must not be negative")
+        with self.lock:
+            slot = 0 if host is None else self.find_slot(host)
+            if slot is None:
+                if rate == 0:
+                    return
+                slot = self.find_slot("")
+                if slot is None:
+                    raise ValueError(
+                        f"Bandwidth is already limited for {self.max_hosts} hosts"
+                    )
+                name = host.encode()[:HOST_NAME_SIZE]  # type: ignore
+                offset = (slot - 1) * HOST_NAME_SIZE
+                self.names[offset : offset + len(name)] = name
+                self.buckets[slot * BUCKET_SIZE + TOKENS] = rate * self.burst
+                self.buckets[slot * BUCKET_SIZE + UPDATED] = time.monotonic()
+            elif slot > 0 and rate == 0:
+                offset = (slot - 1) * HOST_NAME_SIZE
+                self.names[offset : offset + HOST_NAME_SIZE] = b"\0" * HOST_NAME_SIZE
+            base = slot * BUCKET_SIZE
+            self.buckets[base + RATE] = rate
+            self.buckets[base + TOKENS] = min(
+                self.buckets[base + TOKENS], rate * self.burst
+            )
+
+    def get_rates(self) -> Tuple[int, Dict[str, int]]:
+        with self.lock:
+            hosts = {}
+            for slot in range(1, self.max_hosts + 1):
+                host = self.host_name(slot)
+                if host:
+                    hosts[host] = int(self.buckets[slot * BUCKET_SIZE + RATE])
+            return int(self.buckets[RATE]), hosts
+
+    def reserve(self, host: Optional[str], size: int) -> float:
+        # Takes the bytes from the buckets, going into debt if they don't
+        # hold enough, and returns how long the caller has to wait to pay
+        # the debt back.
+        delay = 0.0
+        with self.lock:
+            now = time.monotonic()
+            slots = [0]
+            if host:
+                slot = self.find_slot(host)
+                if slot is not None:
+                    slots.append(slot)
+            for slot in slots:
+                base = slot * BUCKET_SIZE
+                rate = self.buckets[base + RATE]
+                if rate <= 0:
+                    continue
+                tokens = min(
+                    self.buckets[base + TOKENS]
+                    + (now - self.buckets[base + UPDATED]) * rate,
+                    rate * self.burst,
+                )
+                tokens -= size
+                self.buckets[base + TOKENS] = tokens
+                self.buckets[base + UPDATED] = now
+                if tokens < 0:
+                    delay = max(delay, -tokens / rate)
+        return delay
+
+    async def throttle(self, host: Optional[str], size: int):
+        delay = self.reserve(host, size)
+        if delay > 0:
+            await asyncio.sleep(delay)
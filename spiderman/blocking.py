@@ -0,0 +1,126 @@
+import logging
+import re
+from typing import Dict, Iterable, Optional
+
+import urllib3.util
+from playwright.async_api import Request as PlaywrightRequest
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BLOCK_RESOURCE_TYPES = ["image", "font", "stylesheet", "media", "websocket"]
+
+DEFAULT_BLOCK_DOMAINS = [
+    "google-analytics.com",
+    "googletagmanager.com",
+    "googlesyndication.com",
+    "googleadservices.com",
+    "doubleclick.net",
+    "adservice.google.com",
+    "hm.baidu.com",
+    "cnzz.com",
+    "connect.facebook.net",
+]
+
+DEFAULT_BLOCK_URL_PATTERNS = [r"\.jpg", r"\.png"]
+
+# Typical transfer sizes used to estimate the bytes a blocked request saved,
+# the real size is unknown because the request is never sent.
+DEFAULT_BLOCK_ESTIMATED_SIZES = {
+    "image": 50 * 1024,
+    "font": 40 * 1024,
+    "stylesheet": 20 * 1024,
+    "media": 512 * 1024,
+    "script": 30 * 1024,
+    "websocket": 0,
+    "other": 5 * 1024,
+}
+
+
+class RequestBlocker:
+    def __init__(
+        self,
+        resource_types: Iterable[str] = DEFAULT_BLOCK_RESOURCE_TYPES,
+        domains: Iterable[str] = DEFAULT_BLOCK_DOMAINS,
+        url_patterns: Iterable[str] = DEFAULT_BLOCK_URL_PATTERNS,
+        allowlist: Iterable[str] = (),
+        estimated_sizes: Optional[Dict[str, int]] = None,
+        crawler=None,
+    ):
+        self.resource_types = set(resource_types)
+        self.domains = tuple(domain.lower().lstrip(".") for domain in domains)
+        self.url_pattern = self.compile(url_patterns)
+        self.allowlist_pattern = self.compile(allowlist)
+        self.estimated_sizes = {
+            **DEFAULT_BLOCK_ESTIMATED_SIZES,
+            **(estimated_sizes or {}),
+        }
+        self.crawler = crawler
+
+    @property
+    def stats(self):
+        # The stats collector of a crawler only exists once its settings are
+        # applied, after the spider has been created.
+        return self.crawler.stats if self.crawler is not None else None
+
+    @classmethod
+    def from_crawler(cls, crawler) -> "RequestBlocker":
+        settings = crawler.settings
+        return cls(
+            resource_types=settings.getlist(
+                "PLAYWRIGHT_BLOCK_RESOURCE_TYPES", DEFAULT_BLOCK_RESOURCE_TYPES
+            ),
+            domains=settings.getlist("PLAYWRIGHT_BLOCK_DOMAINS", DEFAULT_BLOCK_DOMAINS),
+            url_patterns=settings.getlist(
+                "PLAYWRIGHT_BLOCK_URL_PATTERNS", DEFAULT_BLOCK_URL_PATTERNS
+            ),
+            allowlist=settings.getlist("PLAYWRIGHT_BLOCK_ALLOWLIST", []),
+            estimated_sizes=settings.getdict("PLAYWRIGHT_BLOCK_ESTIMATED_SIZES", {}),
+            crawler=crawler,
+        )
+
+    @staticmethod
+    def compile(patterns: Iterable[str]) -> Optional["re.Pattern[str]"]:
+        patterns = list(patterns)
+        if not patterns:
+            return None
+        return re.compile("|".join(f"(?:{pattern})" for pattern in patterns))
+
+    def __call__(self, request: PlaywrightRequest) -> bool:
+        reason = self.block_reason(request.url, request.resource_type)
+        if reason is None:
+            return False
+        if self.stats is not None:
+            self.stats.inc_value("playwright_block/request_count")
+            self.stats.inc_value(f"playwright_block/request_count/{reason}")
+            self.stats.inc_value(
+                "playwright_block/estimated_bytes",
+                self.estimated_sizes.get(
+                    request.resource_type, self.estimated_sizes["other"]
+                ),
+            )
+        return True
+
+    def block_reason(self, url: str, resource_type: str) -> Optional[str]:
+        if resource_type == "document":
+            return None
+        if self.allowlist_pattern and self.allowlist_pattern.search(url):
+            return None
+        if resource_type in self.resource_types:
+            return "resource_type"
+        hostname = (urllib3.util.parse_url(url).hostname or "").lower()
+        if any(
+            hostname == domain or hostname.endswith(f".{domain}")
+            for domain in self.domains
+        ):
+            return "domain"
+        if self.url_pattern and self.url_pattern.search(url):
+            return "url_pattern"
+        return None
+
+    def log_summary(self, spider_name: str):
+        if self.stats is None:
+            return
+        logger.info(
+            f"Spider '{spider_name}' blocked {self.stats.get_value('playwright_block/request_count', 0)} browser requests, "
+            f"saving about {self.stats.get_value('playwright_block/estimated_bytes', 0) / 1024 / 1024:.2f} MB"
+        )
@@ -0,0 +1,146 @@
+import logging
+import os
+import pickle
+import time
+from collections import defaultdict
+from pathlib import Path
+from typing import Any, DefaultDict, Dict, Optional
+
+import scrapy
+from scrapy.http.cookies import CookieJar
+
+from spiderman.locks import FileLock
+
+logger = logging.getLogger(__name__)
+
+LOGIN_SUFFIX = ".login"
+LOCK_SUFFIX = ".lock"
+
+
+def get_enabled_persistence(spider: scrapy.Spider) -> bool:
+    return spider.settings.get("COOKIES_PERSISTENCE", False)
+
+
+def get_cookies_persistence_path(spider: scrapy.Spider) -> Path:
+    return Path(spider.settings.get("COOKIES_PERSISTENCE_DIR", ".cookies")).joinpath(
+        f"{spider.name}.cookies"
+    )
+
+
+class CookieStore:
+    """Cookie jars of a spider in a file, shared by the processes that crawl
+    with it. A login writes its time next to the file, so the others reload
+    its session instead of logging in again or saving over it."""
+
+    _stores: Dict[Path, "CookieStore"] = {}
+
+    def __init__(self, filename: Path, delay: float = 5.0):
+        self.filename = filename
+        self.delay = delay
+        self.changed = False
+        self._jars: Optional[DefaultDict[Any, CookieJar]] = None
+        self._delayed_save: Any = None
+        self.mtime: Optional[float] = None
+        # The jars hold the logins up to this time
+        self.loaded_at = 0.0
+
+    @classmethod
+    def from_spider(cls, spider: scrapy.Spider) -> "CookieStore":
+        filename = get_cookies_persistence_path(spider)
+        if filename not in cls._stores:
+            cls._stores[filename] = cls(
+                filename,
+                delay=spider.settings.getfloat("COOKIES_PERSISTENCE_DELAY", 5.0),
+            )
+        return cls._stores[filename]
+
+    @property
+    def jars(self) -> DefaultDict[Any, CookieJar]:
+        if self._jars is None:
+            self._jars = self.load()
+        return self._jars
+
+    def get_jar(self, key: Any) -> CookieJar:
+        return self.jars.get(key) or CookieJar()
+
+    def load(self) -> DefaultDict[Any, CookieJar]:
+        self.loaded_at = time.time()
+        if not os.path.exists(self.filename):
+            logger.info(f"File '{self.filename}' for cookie reload doesn't exist")
+            return defaultdict(CookieJar)
+        if not os.path.isfile(self.filename):
+            raise Exception(f"File '{self.filename}' is not a regular file")
+        logger.info(f"Loading cookies from file '{self.filename}'")
+        with open(self.filename, "rb") as f:
+            self.mtime = os.fstat(f.fileno()).st_mtime
+            return pickle.load(f)
+
+    def reload(self):
+        # In place, the cookie middleware keeps a reference to the jars
+        jars = self.load()
+        if self._jars is None:
+            self._jars = jars
+        else:
+            self._jars.clear()
+            self._jars.update(jars)
+        self.changed = False
+
+    def refresh(self):
+        # Picks up what other processes saved since, a worker of the API keeps
+        # the store between its jobs.
+        try:
+            mtime = os.path.getmtime(self.filename)
+        except FileNotFoundError:
+            return
+        if self._jars is not None and mtime != self.mtime:
+            self.reload()
+
+    def last_login(self) -> float:
+        try:
+            with open(f"{self.filename}{LOGIN_SUFFIX}", "r") as f:
+                return float(f.read().strip() or 0)
+        except (FileNotFoundError, ValueError):
+            return 0.0
+
+    def login_lock(self) -> FileLock:
+        return FileLock(f"{self.filename}{LOCK_SUFFIX}")
+
+    def logged_in(self):
+        # Saved right away for the other processes waiting on the login
+        self.changed = True
+        self.save()
+        now = time.time()
+        temp_filename = f"{self.filename}{LOGIN_SUFFIX}.{os.getpid()}.tmp"
+        with open(temp_filename, "w") as f:
+            f.write(repr(now))
+        os.replace(temp_filename, f"{self.filename}{LOGIN_SUFFIX}")
+        self.loaded_at = now
+
+    def mark_changed(self):
+        from twisted.internet import reactor
+
+        self.changed = True
+        if self._delayed_save is None or not self._delayed_save.active():
+            self._delayed_save = reactor.callLater(self.delay, self.save)  # type: ignore
+
+    def save(self):
+        if self._delayed_save is not None and self._delayed_save.active():
+            self._delayed_save.cancel()
+        self._delayed_save = None
+        if not self.changed or self._jars is None:
+            return
+        if self.last_login() > self.loaded_at:
+            # The session of a newer login wins over these cookies
+            logger.info(f"Cookies in '{self.filename}' are from a newer login, reloading")
+            self.reload()
+            return
+        logger.debug(f"Saving cookies to file '{self.filename}'")
+        os.makedirs(os.path.dirname(self.filename) or ".", exist_ok=True)
+        temp_filename = f"{self.filename}.{os.getpid()}.tmp"
+        with open(temp_filename, "wb") as f:
+            pickle.dump(self._jars, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_filename, self.filename)
+        self.mtime = os.path.getmtime(self.filename)
+        self.changed = False
@@ -0,0 +1,97 @@
+import os
+import re
+import time
+from dataclasses import dataclass, field
+from typing import Iterable, List, Optional, Set
+
+ORDER_PREFIX_PATTERN = re.compile(r"^\[(\d+)\]-")
+
+PARTIAL_SUFFIX = ".downloading"
+SEGMENTS_SUFFIX = ".segments"
+RESUME_SUFFIX = ".resume"
+# Held by the crawler downloading the chapter
+LOCK_SUFFIX = ".lock"
+
+
+def remove_order_prefix(name: str) -> str:
+    return ORDER_PREFIX_PATTERN.sub("", name)
+
+
+def get_order_index(name: str) -> Optional[int]:
+    match = ORDER_PREFIX_PATTERN.match(name)
+    return int(match.group(1)) if match else None
+
+
+@dataclass
+class ChapterFiles:
+    final: bool = field(default=False)
+    unprefixed: bool = field(default=False)
+    partial: bool = field(default=False)
+    segments: bool = field(default=False)
+    resume: bool = field(default=False)
+
+
+class ComicDirectoryIndex:
+    def __init__(self, directory: str, names: Iterable[str], exists: bool = True):
+        self.directory = directory
+        self.names: Set[str] = set(names)
+        self.exists = exists
+
+    @classmethod
+    def scan(cls, directory: str) -> "ComicDirectoryIndex":
+        try:
+            with os.scandir(directory) as entries:
+                return cls(directory, [entry.name for entry in entries if entry.is_file()])
+        except FileNotFoundError:
+            return cls(directory, [], exists=False)
+
+    def lookup(self, save_path: str) -> ChapterFiles:
+        # Maps the chapter of a save path to the final, unprefixed and partial
+        # files of it that are already in the directory.
+        name = os.path.basename(save_path)
+        unprefixed_name = remove_order_prefix(name)
+        return ChapterFiles(
+            final=name in self.names,
+            unprefixed=unprefixed_name != name and unprefixed_name in self.names,
+            partial=f"{name}{PARTIAL_SUFFIX}" in self.names,
+            segments=f"{name}{SEGMENTS_SUFFIX}" in self.names,
+            resume=f"{name}{RESUME_SUFFIX}" in self.names,
+        )
+
+    def expire_partials(self, ttl: float) -> List[str]:
+        # Removes partial files nothing wrote to for ttl seconds, with their
+        # sidecars, and returns their names.
+        expired = []
+        now = time.time()
+        for name in [name for name in self.names if name.endswith(PARTIAL_SUFFIX)]:
+            chapter_name = name[: -len(PARTIAL_SUFFIX)]
+            paths = [
+                os.path.join(self.directory, file_name)
+                for file_name in (
+                    name,
+                    f"{chapter_name}{RESUME_SUFFIX}",
+                    f"{chapter_name}{SEGMENTS_SUFFIX}",
+                )
+                if file_name in self.names
+            ]
+            try:
+                modified = max(os.path.getmtime(path) for path in paths)
+            except FileNotFoundError:
+                continue
+            if now - modified < ttl:
+                continue
+            for path in paths:
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                self.discard(path)
+            expired.append(name)
+        return expired
+
+    def add(self, path: str):
+        self.names.add(os.path.basename(path))
+        self.exists = True
+
+    def discard(self, path: str):
+        self.names.discard(os.path.basename(path))
@@ -0,0 +1,88 @@
+import asyncio
+import heapq
+import itertools
+import os
+import re
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, List, Literal, Optional, Tuple
+
+from spiderman.directory import get_order_index
+from spiderman.items import ComicChapterItem
+
+DownloadOrder = Literal["table", "newest", "oldest", "smallest", "largest"]
+DOWNLOAD_ORDERS = ("table", "newest", "oldest", "smallest", "largest")
+
+SIZE_PATTERN = re.compile(r"([\d.]+)\s*([KMGT]?)", re.IGNORECASE)
+SIZE_UNITS = {"": 1, "K": 1024, "M": 1024**2, "G": 1024**3, "T": 1024**4}
+
+Priority = Tuple[float, ...]
+
+
+def parse_chapter_size(size: Optional[str]) -> Optional[float]:
+    # "1.00M (16頁)" in bytes
+    match = SIZE_PATTERN.match(size or "")
+    if match is None:
+        return None
+    return float(match.group(1)) * SIZE_UNITS[match.group(2).upper()]
+
+
+def chapter_priority(order: DownloadOrder, chapter: ComicChapterItem) -> Priority:
+    """Sort key of a chapter, lower goes first. Chapters with the same key keep
+    the order they were queued in."""
+    if order in ("newest", "oldest"):
+        index = get_order_index(os.path.basename(chapter.save_path or ""))
+        if index is None:
+            return (1,)
+        return (0, -index if order == "newest" else index)
+    if order in ("smallest", "largest"):
+        size = parse_chapter_size(chapter.size)
+        if size is None:
+            return (1,)
+        return (0, size if order == "smallest" else -size)
+    return ()
+
+
+def sort_chapters(
+    order: DownloadOrder, chapters: List[ComicChapterItem]
+) -> List[ComicChapterItem]:
+    return sorted(chapters, key=lambda chapter: chapter_priority(order, chapter))
+
+
+class PrioritySemaphore:
+    """Semaphore that hands free slots to the waiter with the lowest priority
+    key instead of the one waiting longest."""
+
+    def __init__(self, value: int):
+        self.value = value
+        self.waiters: List[Tuple[Priority, int, asyncio.Future]] = []
+        self.counter = itertools.count()
+
+    async def acquire(self, priority: Priority = ()):
+        if self.value > 0 and not self.waiters:
+            self.value -= 1
+            return
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self.waiters, (priority, next(self.counter), future))
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # Got the slot but won't use it
+                self.release()
+            raise
+
+    def release(self):
+        while self.waiters:
+            _, _, future = heapq.heappop(self.waiters)
+            if not future.done():
+                future.set_result(None)
+                return
+        self.value += 1
+
+    @asynccontextmanager
+    async def slot(self, priority: Priority = ()) -> AsyncIterator[None]:
+        await self.acquire(priority)
+        try:
+            yield
+        finally:
+            self.release()
@@ -0,0 +1,231 @@
+import logging
+import os
+import sqlite3
+import time
+from dataclasses import dataclass
+from typing import Dict, Iterable, List, Literal, Optional
+
+from spiderman.directory import get_order_index
+from spiderman.download_order import DownloadOrder, parse_chapter_size
+from spiderman.items import ComicChapterItem, ComicItem
+
+logger = logging.getLogger(__name__)
+
+QueueStatus = Literal["queued", "running", "done", "failed"]
+
+ORDER_BY: Dict[str, str] = {
+    "table": "id",
+    "newest": "order_index IS NULL, order_index DESC, id",
+    "oldest": "order_index IS NULL, order_index, id",
+    "smallest": "size_bytes IS NULL, size_bytes, id",
+    "largest": "size_bytes IS NULL, size_bytes DESC, id",
+}
+
+
+@dataclass
+class QueuedChapter:
+    id: int
+    spider: str
+    comic: ComicItem
+    chapter: ComicChapterItem
+    attempts: int
+    # Hash of the chapter table the chapter was queued from, if known
+    chapters_hash: Optional[str] = None
+
+
+class DownloadQueue:
+    """Chapters waiting for the download workers, kept in SQLite so the plan
+    of a crawl survives a crash of either side. A chapter is one row, queued
+    again by a later crawl unless it is being downloaded. A worker leases the
+    chapters it downloads, the chapters of a worker that stopped renewing its
+    lease are taken over by the next claim."""
+
+    def __init__(self, filename: str):
+        self.filename = filename
+        if os.path.dirname(filename):
+            os.makedirs(os.path.dirname(filename), exist_ok=True)
+        # The crawl and the worker write at the same time
+        self.connection = sqlite3.connect(filename, timeout=30)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS downloads (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                spider TEXT NOT NULL,
+                comic_name TEXT,
+                comic_name_en TEXT,
+                comic_url TEXT,
+                chapter_name TEXT,
+                size TEXT,
+                download_url TEXT NOT NULL,
+                save_path TEXT NOT NULL UNIQUE,
+                order_index INTEGER,
+                size_bytes REAL,
+                status TEXT NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                available_at REAL NOT NULL,
+                lease_until REAL,
+                error TEXT,
+                updated_at REAL NOT NULL,
+                chapters_hash TEXT
+            );
+            CREATE INDEX IF NOT EXISTS ix_downloads_status ON downloads (status, available_at);
+            CREATE INDEX IF NOT EXISTS ix_downloads_comic ON downloads (comic_url, chapters_hash);
+            """
+        )
+        # Queues created before the chapter table hash was kept
+        columns = {
+            row[1] for row in self.connection.execute("PRAGMA table_info(downloads)")
+        }
+        if "chapters_hash" not in columns:
+            with self.connection:
+                self.connection.execute("ALTER TABLE downloads ADD COLUMN chapters_hash TEXT")
+
+    def enqueue(
+        self,
+        spider: str,
+        item: ComicItem,
+        chapters: Iterable[ComicChapterItem],
+        chapters_hash: Optional[str] = None,
+    ):
+        now = time.time()
+        with self.connection:
+            self.connection.executemany(
+                """
+                INSERT INTO downloads (
+                    spider, comic_name, comic_name_en, comic_url, chapter_name, size,
+                    download_url, save_path, order_index, size_bytes, status,
+                    available_at, updated_at, chapters_hash
+                )
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, 'queued', ?, ?, ?)
+                ON CONFLICT (save_path) DO UPDATE SET
+                    spider = excluded.spider,
+                    comic_name = excluded.comic_name,
+                    comic_name_en = excluded.comic_name_en,
+                    comic_url = excluded.comic_url,
+                    chapter_name = excluded.chapter_name,
+                    size = excluded.size,
+                    download_url = excluded.download_url,
+                    order_index = excluded.order_index,
+                    size_bytes = excluded.size_bytes,
+                    status = CASE WHEN status = 'running' THEN status ELSE 'queued' END,
+                    attempts = CASE WHEN status = 'running' THEN attempts ELSE 0 END,
+                    available_at = excluded.available_at,
+                    updated_at = excluded.updated_at,
+                    chapters_hash = excluded.chapters_hash
+                """,
+                [
+                    (
+                        spider,
+                        item.name,
+                        item.name_en,
+                        item.url,
+                        chapter.name,
+                        chapter.size,
+                        chapter.download_url,
+                        chapter.save_path,
+                        get_order_index(os.path.basename(chapter.save_path or "")),
+                        parse_chapter_size(chapter.size),
+                        now,
+                        now,
+                        chapters_hash,
+                    )
+                    for chapter in chapters
+                    if chapter.download_url and chapter.save_path
+                ],
+            )
+
+    def claim(
+        self, limit: int, lease: float, order: DownloadOrder = "table"
+    ) -> List[QueuedChapter]:
+        now = time.time()
+        with self.connection:
+            # A single statement, so two workers never claim the same chapter
+            rows = self.connection.execute(
+                f"""
+                UPDATE downloads
+                SET status = 'running', attempts = attempts + 1, lease_until = ?, updated_at = ?
+                WHERE id IN (
+                    SELECT id FROM downloads
+                    WHERE (status = 'queued' AND available_at <= ?)
+                        OR (status = 'running' AND lease_until < ?)
+                    ORDER BY {ORDER_BY[order]}
+                    LIMIT ?
+                )
+                RETURNING id, spider, comic_name, comic_name_en, comic_url, chapter_name,
+                    size, download_url, save_path, attempts, chapters_hash
+                """,
+                (now + lease, now, now, now, limit),
+            ).fetchall()
+        return [
+            QueuedChapter(
+                id=row[0],
+                spider=row[1],
+                comic=ComicItem(name=row[2], name_en=row[3], url=row[4]),
+                chapter=ComicChapterItem(
+                    name=row[5], size=row[6], download_url=row[7], save_path=row[8]
+                ),
+                attempts=row[9],
+                chapters_hash=row[10],
+            )
+            for row in rows
+        ]
+
+    def renew(self, ids: Iterable[int], lease: float):
+        now = time.time()
+        with self.connection:
+            self.connection.executemany(
+                "UPDATE downloads SET lease_until = ? WHERE id = ? AND status = 'running'",
+                [(now + lease, id) for id in ids],
+            )
+
+    def release(self, ids: Iterable[int]):
+        # Downloads cut short by a stopping worker, the partial files are
+        # still there to resume from.
+        now = time.time()
+        with self.connection:
+            self.connection.executemany(
+                """
+                UPDATE downloads
+                SET status = 'queued', attempts = MAX(attempts - 1, 0), lease_until = NULL, updated_at = ?
+                WHERE id = ? AND status = 'running'
+                """,
+                [(now, id) for id in ids],
+            )
+
+    def complete(self, id: int):
+        self.set_status(id, "done")
+
+    def fail(self, id: int, error: str, retry_after: float = 0):
+        # Queued again until the worker gives up on it
+        if retry_after > 0:
+            self.set_status(id, "queued", error, time.time() + retry_after)
+        else:
+            self.set_status(id, "failed", error)
+
+    def set_status(
+        self, id: int, status: QueueStatus, error: str = "", available_at: float = 0
+    ):
+        with self.connection:
+            self.connection.execute(
+                "UPDATE downloads SET status = ?, error = ?, available_at = ?, lease_until = NULL, updated_at = ? WHERE id = ?",
+                (status, error or None, available_at, time.time(), id),
+            )
+
+    def is_comic_done(self, comic_url: str, chapters_hash: str) -> bool:
+        # Whether every chapter queued from this chapter table is downloaded
+        row = self.connection.execute(
+            "SELECT COUNT(*) FROM downloads WHERE comic_url = ? AND chapters_hash = ? AND status != 'done'",
+            (comic_url, chapters_hash),
+        ).fetchone()
+        return row[0] == 0
+
+    def count(self) -> Dict[str, int]:
+        return dict(
+            self.connection.execute(
+                "SELECT status, COUNT(*) FROM downloads GROUP BY status"
+            ).fetchall()
+        )
+
+    def close(self):
+        self.connection.close()
@@ -0,0 +1,176 @@
+import asyncio
+import logging
+from typing import Dict, Optional, Set, Tuple
+
+import scrapy
+from scrapy import spiderloader
+from scrapy.crawler import Crawler
+from scrapy.settings import Settings
+
+from spiderman.download_order import DOWNLOAD_ORDERS, DownloadOrder
+from spiderman.download_queue import DownloadQueue, QueuedChapter
+from spiderman.items import ComicChapterDownloadItem
+from spiderman.pipelines import ComicDownloadPipeline
+
+logger = logging.getLogger(__name__)
+
+
+class DownloadWorker:
+    """Downloads the chapters the crawls put in the download queue with
+    ComicDownloadPipeline, outside of any crawl."""
+
+    def __init__(
+        self,
+        queue: DownloadQueue,
+        settings: Settings,
+        concurrency: int = 4,
+        poll_interval: float = 5.0,
+        lease: float = 60.0,
+        max_attempts: int = 3,
+        retry_delay: float = 60.0,
+        order: DownloadOrder = "table",
+    ):
+        assert order in DOWNLOAD_ORDERS, f"Order must be one of {', '.join(DOWNLOAD_ORDERS)}"
+        self.queue = queue
+        self.settings = settings
+        self.concurrency = max(concurrency, 1)
+        self.poll_interval = poll_interval
+        self.lease = max(lease, poll_interval * 3)
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.order = order
+        self.spider_loader = spiderloader.SpiderLoader.from_settings(settings)
+        self.pipelines: Dict[str, Tuple[ComicDownloadPipeline, scrapy.Spider]] = {}
+        self.active: Dict[asyncio.Future, QueuedChapter] = {}
+        self.stopping = False
+
+    @classmethod
+    def from_settings(
+        cls, settings: Settings, concurrency: Optional[int] = None
+    ) -> "DownloadWorker":
+        queue_path = settings.get("COMIC_DOWNLOAD_QUEUE")
+        assert queue_path, "COMIC_DOWNLOAD_QUEUE is required"
+        return cls(
+            DownloadQueue(queue_path),
+            settings,
+            concurrency=concurrency
+            or settings.getint("COMIC_DOWNLOAD_QUEUE_CONCURRENCY", 4),
+            poll_interval=settings.getfloat("COMIC_DOWNLOAD_QUEUE_POLL_INTERVAL", 5.0),
+            lease=settings.getfloat("COMIC_DOWNLOAD_QUEUE_LEASE", 60.0),
+            max_attempts=settings.getint("COMIC_DOWNLOAD_QUEUE_MAX_ATTEMPTS", 3),
+            retry_delay=settings.getfloat("COMIC_DOWNLOAD_QUEUE_RETRY_DELAY", 60.0),
+            order=settings.get("COMIC_DOWNLOAD_ORDER", "table"),
+        )
+
+    def get_pipeline(self, name: str) -> Tuple[ComicDownloadPipeline, scrapy.Spider]:
+        # The downloads need the settings, the cookies and the login of the
+        # spider that queued them, not a running spider.
+        if name not in self.pipelines:
+            crawler = Crawler(self.spider_loader.load(name), self.settings)
+            crawler.settings.set("COMIC_DOWNLOAD_QUEUE", None, priority="cmdline")
+            spider = self.create_spider(crawler)
+            pipeline = ComicDownloadPipeline()
+            pipeline.open_spider(spider)
+            self.pipelines[name] = (pipeline, spider)
+        return self.pipelines[name]
+
+    @staticmethod
+    def create_spider(crawler: Crawler) -> scrapy.Spider:
+        try:
+            return crawler.spidercls.from_crawler(crawler)
+        except Exception as e:
+            # Without it an expired session fails the downloads for good
+            logger.warning(
+                f"Can't create spider '{crawler.spidercls.name}', downloads won't log in again: {e!r}"
+            )
+            spider = scrapy.Spider(crawler.spidercls.name)
+            spider._set_crawler(crawler)
+            return spider
+
+    async def run(self, once: bool = False):
+        """Drains the queue, ``once`` stops when it is empty instead of
+        waiting for more chapters."""
+        counts = self.queue.count()
+        logger.info(
+            f"Download queue has {counts.get('queued', 0)} queued and {counts.get('running', 0)} running chapters"
+        )
+        try:
+            while not self.stopping:
+                free = self.concurrency - len(self.active)
+                if free > 0:
+                    for entry in self.queue.claim(free, self.lease, self.order):
+                        self.active[asyncio.ensure_future(self.download(entry))] = entry
+                if not self.active:
+                    if once:
+                        break
+                    await asyncio.sleep(self.poll_interval)
+                    continue
+                done, _ = await asyncio.wait(
+                    self.active,
+                    timeout=self.poll_interval,
+                    return_when=asyncio.FIRST_COMPLETED,
+                )
+                for task in done:
+                    del self.active[task]
+                self.queue.renew([entry.id for entry in self.active.values()], self.lease)
+        finally:
+            await self.close()
+
+    def stop(self):
+        self.stopping = True
+
+    async def download(self, entry: QueuedChapter):
+        pipeline: Optional[ComicDownloadPipeline] = None
+        error = "download failed"
+        try:
+            pipeline, spider = self.get_pipeline(entry.spider)
+            result = await pipeline.process_chapter_item(
+                ComicChapterDownloadItem(comic=entry.comic, chapter=entry.chapter),
+                spider,
+            )
+        except Exception as e:
+            logger.exception(
+                f"Failed to download chapter '{entry.comic.name} - {entry.chapter.name}'"
+            )
+            result = False
+            error = repr(e)
+        if result is True:
+            self.queue.complete(entry.id)
+            if pipeline is not None:
+                self.mark_comic(pipeline, entry)
+        elif entry.attempts < self.max_attempts:
+            self.queue.fail(
+                entry.id,
+                error,
+                retry_after=self.retry_delay * entry.attempts,
+            )
+        else:
+            logger.error(
+                f"Giving up on chapter '{entry.comic.name} - {entry.chapter.name}' after {entry.attempts} attempts"
+            )
+            self.queue.fail(entry.id, error)
+
+    def mark_comic(self, pipeline: ComicDownloadPipeline, entry: QueuedChapter):
+        # The crawl leaves the comic to the worker, its last chapter records
+        # the chapter table so the next crawl skips the comic as a whole.
+        if (
+            pipeline.manifest is None
+            or not entry.comic.url
+            or not entry.chapters_hash
+            or not self.queue.is_comic_done(entry.comic.url, entry.chapters_hash)
+        ):
+            return
+        logger.info(f"Comic '{entry.comic.name}' is completely downloaded")
+        pipeline.manifest.mark_comic(entry.comic, entry.chapters_hash)
+
+    async def close(self):
+        if self.active:
+            for task in self.active:
+                task.cancel()
+            await asyncio.gather(*self.active, return_exceptions=True)
+            self.queue.release([entry.id for entry in self.active.values()])
+            self.active = {}
+        for pipeline, _ in self.pipelines.values():
+            await pipeline.close()
+        self.pipelines = {}
+        self.queue.close()
@@ -0,0 +1,192 @@
+import hashlib
+import json
+import os
+import struct
+import time
+from dataclasses import asdict, dataclass, field
+from typing import Optional
+
+VERIFY_SUFFIX = ".verify.json"
+QUARANTINE_DIR = ".quarantine"
+ZIP_EXTENSIONS = (".epub", ".zip", ".cbz")
+EPUB_MIMETYPE = b"application/epub+zip"
+
+LOCAL_FILE_HEADER = b"PK\x03\x04"
+CENTRAL_DIRECTORY_HEADER = b"PK\x01\x02"
+END_OF_CENTRAL_DIRECTORY = b"PK\x05\x06"
+ZIP64_END_OF_CENTRAL_DIRECTORY = b"PK\x06\x06"
+ZIP64_END_OF_CENTRAL_DIRECTORY_LOCATOR = b"PK\x06\x07"
+# End of central directory record without the comment, and its largest comment
+EOCD_SIZE = 22
+EOCD_MAX_COMMENT = 0xFFFF
+HEAD_SIZE = 128
+
+
+class CorruptDownloadError(Exception):
+    """The downloaded file failed verification and was quarantined."""
+
+
+@dataclass
+class VerificationResult:
+    ok: bool
+    size: int
+    algorithm: str
+    digest: Optional[str] = field(default=None)
+    entries: Optional[int] = field(default=None)
+    error: Optional[str] = field(default=None)
+    verified_at: float = field(default_factory=time.time)
+
+    def save(self, filename: str, **extra):
+        with open(filename, "w", encoding="utf-8") as f:
+            json.dump({**asdict(self), **extra}, f, ensure_ascii=False)
+
+
+class ChapterVerifier:
+    """Checks a chapter file while it streams to disk: a digest of the bytes
+    in order, the head of the file and a window of its tail, where a zip keeps
+    its central directory. Nothing is read back once the download is done,
+    only the partial file a download resumes from is hashed when it starts."""
+
+    def __init__(
+        self,
+        algorithm: str = "sha256",
+        check_zip: bool = True,
+        check_epub: bool = False,
+        tail_size: int = 1024 * 1024,
+    ):
+        self.algorithm = algorithm
+        self.check_zip = check_zip or check_epub
+        self.check_epub = check_epub
+        self.tail_size = max(tail_size, EOCD_SIZE + EOCD_MAX_COMMENT)
+        self.hash = hashlib.new(algorithm)
+        # A digest is only known if every byte came through in order
+        self.digest_complete = True
+        self.position = 0
+        self.head = bytearray()
+        self.tail = bytearray()
+
+    def update(self, data: bytes):
+        if self.digest_complete:
+            self.hash.update(data)
+        if len(self.head) < HEAD_SIZE:
+            self.head += data[: HEAD_SIZE - len(self.head)]
+        self.tail += data[-self.tail_size :]
+        # Trimmed in batches, not for every chunk
+        if len(self.tail) > 2 * self.tail_size:
+            del self.tail[: len(self.tail) - self.tail_size]
+        self.position += len(data)
+
+    def seed(self, filename: str, size: int, read_size: int = 1024 * 1024):
+        # The part a resumed download already has on disk
+        with open(filename, "rb") as f:
+            while self.position < size:
+                data = f.read(min(read_size, size - self.position))
+                if not data:
+                    break
+                self.update(data)
+
+    def seed_ends(self, filename: str):
+        # Downloads in segments arrive out of order, only the structure of the
+        # finished file is checked and no digest is kept.
+        self.digest_complete = False
+        with open(filename, "rb") as f:
+            self.head = bytearray(f.read(HEAD_SIZE))
+            self.position = f.seek(0, os.SEEK_END)
+            f.seek(max(self.position - self.tail_size, 0))
+            self.tail = bytearray(f.read())
+
+    def verify(self, expected_size: Optional[int] = None) -> VerificationResult:
+        result = VerificationResult(
+            ok=True,
+            size=self.position,
+            algorithm=self.algorithm,
+            digest=self.hash.hexdigest() if self.digest_complete else None,
+        )
+        try:
+            if expected_size and self.position != expected_size:
+                raise ValueError(
+                    f"size is {self.position} bytes, expected {expected_size}"
+                )
+            if self.check_zip:
+                result.entries = self.verify_zip()
+            if self.check_epub and not self.verify_epub():
+                raise ValueError("first entry is not the epub mimetype")
+        except (ValueError, struct.error) as e:
+            result.ok = False
+            result.error = str(e)
+        return result
+
+    def verify_zip(self) -> Optional[int]:
+        size = self.position
+        tail = bytes(self.tail[-self.tail_size :])
+        tail_offset = size - len(tail)
+        if not self.head.startswith(LOCAL_FILE_HEADER):
+            raise ValueError("not a zip file")
+        eocd = tail.rfind(END_OF_CENTRAL_DIRECTORY, max(len(tail) - EOCD_SIZE - EOCD_MAX_COMMENT, 0))
+        if eocd < 0 or eocd + EOCD_SIZE > len(tail):
+            raise ValueError("end of central directory is missing, the file is truncated")
+        (
+            _,
+            _,
+            _,
+            _,
+            entries,
+            directory_size,
+            directory_offset,
+            comment_size,
+        ) = struct.unpack("<4sHHHHIIH", tail[eocd : eocd + EOCD_SIZE])
+        if eocd + EOCD_SIZE + comment_size != len(tail):
+            raise ValueError("end of central directory doesn't end the file")
+        directory_end = tail_offset + eocd
+        locator = eocd - 20
+        if locator >= 0 and tail[locator : locator + 4] == ZIP64_END_OF_CENTRAL_DIRECTORY_LOCATOR:
+            (record_offset,) = struct.unpack("<Q", tail[locator + 8 : locator + 16])
+            record = record_offset - tail_offset
+            if record < 0 or tail[record : record + 4] != ZIP64_END_OF_CENTRAL_DIRECTORY:
+                raise ValueError("zip64 end of central directory is missing")
+            entries, directory_size, directory_offset = struct.unpack(
+                "<QQQ", tail[record + 32 : record + 56]
+            )
+            directory_end = record_offset
+        if directory_offset + directory_size != directory_end:
+            raise ValueError("central directory doesn't end where the file says")
+        directory = directory_offset - tail_offset
+        if directory < 0:
+            # Larger than the tail window, the end record has to do
+            return entries
+        offset = directory
+        for _ in range(entries):
+            if tail[offset : offset + 4] != CENTRAL_DIRECTORY_HEADER:
+                raise ValueError("central directory is damaged")
+            (local_offset,) = struct.unpack("<I", tail[offset + 42 : offset + 46])
+            if local_offset != 0xFFFFFFFF and local_offset >= directory_offset:
+                raise ValueError("central directory points past the file data")
+            name_size, extra_size, comment_size = struct.unpack(
+                "<HHH", tail[offset + 28 : offset + 34]
+            )
+            offset += 46 + name_size + extra_size + comment_size
+        if offset != directory + directory_size:
+            raise ValueError("central directory size doesn't match its entries")
+        return entries
+
+    def verify_epub(self) -> bool:
+        # The first entry of an epub is its stored mimetype
+        name_size, extra_size = struct.unpack("<HH", self.head[26:30])
+        start = 30 + name_size + extra_size
+        return (
+            self.head[30 : 30 + name_size] == b"mimetype"
+            and self.head[start : start + len(EPUB_MIMETYPE)] == EPUB_MIMETYPE
+        )
+
+
+def create_verifier(
+    filename: str, algorithm: str = "sha256", tail_size: int = 1024 * 1024
+) -> ChapterVerifier:
+    # The structure is only known for zip based formats
+    name = filename.lower()
+    return ChapterVerifier(
+        algorithm,
+        check_zip=name.endswith(ZIP_EXTENSIONS),
+        check_epub=name.endswith(".epub"),
+        tail_size=tail_size,
+    )
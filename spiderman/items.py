@@ -34,6 +34,18 @@ class ComicItem:
     url: Optional[str] = field(default=None)
     chapters: List[ComicChapterItem] = field(default_factory=list)
 
+@dataclass
+class ComicChapterDownloadItem:
+    comic: ComicItem = field(default_factory=ComicItem)
+    chapter: ComicChapterItem = field(default_factory=ComicChapterItem)
+
+@dataclass
+class ComicChaptersEndItem:
+    # Follows the last ComicChapterDownloadItem streamed for a comic
+    comic: ComicItem = field(default_factory=ComicItem)
+    chapters: int = field(default=0)
+    chapters_hash: Optional[str] = field(default=None)
+
 class ComicChapterLoader(ItemLoader):
     default_item_class = ComicChapterItem
     default_input_processor = MapCompose(str.strip)
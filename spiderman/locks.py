@@ -0,0 +1,62 @@
+import asyncio
+import os
+from typing import Optional
+
+try:
+    import fcntl
+except ImportError:  # Windows, where only a single crawler runs at a time
+    fcntl = None  # type: ignore
+
+
+class FileLock:
+    """Lock on a file that one open file at a time holds, across processes
+    and within one. The lock goes away with a process that dies holding it,
+    the file itself is removed on release."""
+
+    def __init__(self, filename: str, poll_interval: float = 0.5):
+        self.filename = filename
+        self.poll_interval = poll_interval
+        self.fd: Optional[int] = None
+
+    def try_acquire(self) -> bool:
+        if fcntl is None:
+            return True
+        if os.path.dirname(self.filename):
+            os.makedirs(os.path.dirname(self.filename), exist_ok=True)
+        while True:
+            fd = os.open(self.filename, os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                os.close(fd)
+                return False
+            # The holder before removed the file after it was opened here,
+            # a lock on it wouldn't keep anybody out.
+            try:
+                if os.path.samestat(os.fstat(fd), os.stat(self.filename)):
+                    self.fd = fd
+                    return True
+            except FileNotFoundError:
+                pass
+            os.close(fd)
+
+    async def acquire(self):
+        while not self.try_acquire():
+            await asyncio.sleep(self.poll_interval)
+
+    def release(self):
+        if self.fd is None:
+            return
+        try:
+            os.remove(self.filename)
+        except FileNotFoundError:
+            pass
+        os.close(self.fd)
+        self.fd = None
+
+    async def __aenter__(self) -> "FileLock":
+        await self.acquire()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.release()
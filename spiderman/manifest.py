@@ -0,0 +1,149 @@
+import hashlib
+import logging
+import os
+import sqlite3
+import time
+from datetime import datetime
+from typing import Any, Callable, Dict, Iterable, Literal, Optional
+
+from spiderman.items import ComicChapterItem, ComicItem
+
+logger = logging.getLogger(__name__)
+
+ChapterStatus = Literal["complete", "failed"]
+
+# Attempts of a write that finds the database locked after the busy timeout
+LOCKED_ATTEMPTS = 5
+
+
+class CrawlManifest:
+    """Chapters and comics downloaded so far. Shared by the crawlers and
+    download workers that run at the same time, which wait for each other's
+    writes instead of failing on a locked database."""
+
+    def __init__(self, filename: str, timeout: float = 30.0):
+        self.filename = filename
+        if os.path.dirname(filename):
+            os.makedirs(os.path.dirname(filename), exist_ok=True)
+        self.connection = sqlite3.connect(filename, timeout=timeout)
+        self.retry_locked(lambda: self.connection.execute("PRAGMA journal_mode=WAL"))
+        self.retry_locked(lambda: self.connection.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS comics (
+                url TEXT PRIMARY KEY,
+                name TEXT,
+                chapters_hash TEXT,
+                crawled_at TEXT NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS chapters (
+                comic_url TEXT NOT NULL,
+                name TEXT NOT NULL,
+                download_url TEXT,
+                size TEXT,
+                save_path TEXT,
+                status TEXT NOT NULL,
+                updated_at TEXT NOT NULL,
+                PRIMARY KEY (comic_url, name)
+            );
+            """
+        ))
+
+    def retry_locked(self, write: Callable[[], Any]) -> Any:
+        # The busy timeout covers most waits, but a transaction that can't
+        # get its write lock is told right away and has to start over.
+        for attempt in range(1, LOCKED_ATTEMPTS + 1):
+            try:
+                return write()
+            except sqlite3.OperationalError as e:
+                if "locked" not in str(e) or attempt == LOCKED_ATTEMPTS:
+                    raise
+                logger.debug(f"Manifest '{self.filename}' is locked, retrying: {e}")
+                time.sleep(0.1 * attempt)
+
+    @staticmethod
+    def hash_chapters(chapters: Iterable[ComicChapterItem]) -> str:
+        digest = hashlib.sha1()
+        for chapter in chapters:
+            CrawlManifest.update_chapters_hash(digest, chapter)
+        return digest.hexdigest()
+
+    @staticmethod
+    def update_chapters_hash(digest: Any, chapter: ComicChapterItem):
+        # One chapter at a time, for chapters that are never all in a list
+        for value in (chapter.name, chapter.size, chapter.download_url):
+            digest.update((value or "").encode("utf-8"))
+            digest.update(b"\0")
+
+    def is_comic_complete(self, url: str, chapters_hash: str) -> bool:
+        row = self.connection.execute(
+            "SELECT chapters_hash FROM comics WHERE url = ?", (url,)
+        ).fetchone()
+        return row is not None and row[0] == chapters_hash
+
+    def chapter_status(self, comic_url: str, name: str) -> Optional[str]:
+        row = self.connection.execute(
+            "SELECT status FROM chapters WHERE comic_url = ? AND name = ?",
+            (comic_url, name),
+        ).fetchone()
+        return row[0] if row else None
+
+    def chapter_statuses(self, comic_url: str) -> Dict[str, str]:
+        return dict(
+            self.connection.execute(
+                "SELECT name, status FROM chapters WHERE comic_url = ?", (comic_url,)
+            ).fetchall()
+        )
+
+    def mark_chapter(
+        self, item: ComicItem, chapter: ComicChapterItem, status: ChapterStatus
+    ):
+        self.retry_locked(lambda: self.write_chapter(item, chapter, status))
+
+    def write_chapter(
+        self, item: ComicItem, chapter: ComicChapterItem, status: ChapterStatus
+    ):
+        with self.connection:
+            self.connection.execute(
+                """
+                INSERT INTO chapters
+                    (comic_url, name, download_url, size, save_path, status, updated_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT (comic_url, name) DO UPDATE SET
+                    download_url = excluded.download_url,
+                    size = excluded.size,
+                    save_path = excluded.save_path,
+                    status = excluded.status,
+                    updated_at = excluded.updated_at
+                """,
+                (
+                    item.url,
+                    chapter.name,
+                    chapter.download_url,
+                    chapter.size,
+                    chapter.save_path,
+                    status,
+                    datetime.now().isoformat(),
+                ),
+            )
+
+    def mark_comic(self, item: ComicItem, chapters_hash: Optional[str]):
+        # The hash is only stored once every chapter is complete, so an
+        # unchanged table means there is nothing left to download.
+        self.retry_locked(lambda: self.write_comic(item, chapters_hash))
+
+    def write_comic(self, item: ComicItem, chapters_hash: Optional[str]):
+        with self.connection:
+            self.connection.execute(
+                """
+                INSERT INTO comics (url, name, chapters_hash, crawled_at)
+                VALUES (?, ?, ?, ?)
+                ON CONFLICT (url) DO UPDATE SET
+                    name = excluded.name,
+                    chapters_hash = excluded.chapters_hash,
+                    crawled_at = excluded.crawled_at
+                """,
+                (item.url, item.name, chapters_hash, datetime.now().isoformat()),
+            )
+
+    def close(self):
+        self.connection.close()
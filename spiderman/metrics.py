@@ -0,0 +1,66 @@
+from datetime import datetime
+from typing import Any, Dict, Iterable, Optional
+
+# Crawl metrics are kept in the stats of the crawler, these are the keys the
+# API exports. A histogram is stored as "<key>/bucket/<le>", "<key>/sum" and
+# "<key>/count".
+DOWNLOAD_BYTES = "comic_download/bytes"
+DOWNLOAD_RETRIES = "comic_download/retries"
+CHAPTER_STATUSES = ("completed", "skipped", "resumed", "failed", "quarantined")
+LOGINS = "login/count"
+RENDER_LATENCY = "playwright_render/latency"
+RENDER_LATENCY_BUCKETS = (0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 20.0, 30.0, 60.0)
+
+METRIC_STATS_PREFIXES = ("comic_download/", "login/", "playwright_render/")
+# Stats that don't add up when the shards of a run are merged
+MAX_STATS = ("elapsed_time_seconds", "memusage/startup", "memusage/max")
+
+
+def chapter_status_key(status: str) -> str:
+    return f"comic_download/chapters/{status}"
+
+
+def inc_value(stats, key: str, count: float = 1):
+    if stats is not None:
+        stats.inc_value(key, count)
+
+
+def observe(stats, key: str, value: float, buckets: Iterable[float]):
+    if stats is None:
+        return
+    for bucket in buckets:
+        if value <= bucket:
+            stats.inc_value(f"{key}/bucket/{bucket}")
+    stats.inc_value(f"{key}/sum", value)
+    stats.inc_value(f"{key}/count")
+
+
+def snapshot(stats: Optional[Dict[str, Any]]) -> Dict[str, float]:
+    return {
+        key: value
+        for key, value in (stats or {}).items()
+        if key.startswith(METRIC_STATS_PREFIXES)
+        and isinstance(value, (int, float))
+        and not isinstance(value, bool)
+    }
+
+
+def merge_stats(stats: Iterable[Dict[str, Any]]) -> Dict[str, Any]:
+    # The stats of the shards of a run as if one crawler collected them:
+    # counts add up, the run starts with the first shard and ends with the
+    # last, anything else is taken from the first shard that has it.
+    merged: Dict[str, Any] = {}
+    for values in stats:
+        for key, value in values.items():
+            current = merged.get(key)
+            if current is None:
+                merged[key] = value
+            elif isinstance(value, datetime) and isinstance(current, datetime):
+                merged[key] = min(current, value) if key.startswith("start") else max(current, value)
+            elif (
+                isinstance(value, (int, float))
+                and isinstance(current, (int, float))
+                and not isinstance(value, bool)
+            ):
+                merged[key] = max(current, value) if key in MAX_STATS else current + value
+    return merged
@@ -5,63 +5,90 @@
 
 # useful for handling different item types with a single interface
 import logging
-import os
-import os.path
 from pathlib import Path
-import pickle
+from typing import Optional
 
 import scrapy
+from scrapy import signals
 from scrapy.downloadermiddlewares.cookies import CookiesMiddleware
 
+from spiderman.cookies import (
+    CookieStore,
+    get_cookies_persistence_path,
+    get_enabled_persistence,
+)
+
 
 class PersistenceCookiesMiddleware(CookiesMiddleware):
     def __init__(self, debug=False):
         super().__init__(debug)
         self.logger = logging.getLogger(f"{__name__}.{self.__class__.__name__}")
+        self.store: Optional[CookieStore] = None
 
-    def process_request(self, request, spider):
+    @classmethod
+    def from_crawler(cls, crawler):
+        o = super().from_crawler(crawler)
+        crawler.signals.connect(o.spider_opened, signal=signals.spider_opened)
+        crawler.signals.connect(o.spider_closed, signal=signals.spider_closed)
+        return o
+
+    def spider_opened(self, spider: scrapy.Spider):
         self.load(spider)
-        return super().process_request(request, spider)
+
+    def spider_closed(self, spider: scrapy.Spider):
+        self.save(spider)
+
+    def process_request(self, request, spider):
+        if self.store is None:
+            self.load(spider)
+        res = super().process_request(request, spider)
+        if self.store is not None and request.cookies:
+            self.store.mark_changed()
+        return res
 
     def process_response(self, request, response, spider):
         res = super().process_response(
             request, response, spider
         )
-        self.save(spider)
+        if self.store is not None and response.headers.getlist("Set-Cookie"):
+            self.store.mark_changed()
         return res
     
     @staticmethod
     def get_enabled_persistence(spider: scrapy.Spider):
-        return spider.settings.get("COOKIES_PERSISTENCE", False)
+        return get_enabled_persistence(spider)
 
     @staticmethod
-    def get_cookies_persistence_path(spider: scrapy.Spider):
-        return Path(spider.settings.get("COOKIES_PERSISTENCE_DIR", ".cookies")).joinpath(f"{spider.name}.cookies")
+    def get_cookies_persistence_path(spider: scrapy.Spider) -> Path:
+        return get_cookies_persistence_path(spider)
 
     def save(self, spider):
-        if not self.get_enabled_persistence(spider):
+        if self.store is None:
             return
         if self.debug:
             self.logger.debug("Saving cookies to disk for reuse")
-        filename = self.get_cookies_persistence_path(spider)
-        if not os.path.exists(os.path.dirname(filename)):
-            os.makedirs(os.path.dirname(filename))
-        with open(filename, "wb") as f:
-            pickle.dump(self.jars, f)
-            f.flush()
+        self.store.save()
 
     def load(self, spider):
         if not self.get_enabled_persistence(spider):
             return
-        filename = self.get_cookies_persistence_path(spider)
-        if self.debug:
-            self.logger.debug(f"Trying to load cookies from file '{filename}'")
-        if not os.path.exists(filename):
-            self.logger.info(f"File '{filename}' for cookie reload doesn't exist")
-            logging.info(f"File '{filename}' for cookie reload doesn't exist")
-            return
-        if not os.path.isfile(filename):
-            raise Exception(f"File '{filename}' is not a regular file")
+        self.store = CookieStore.from_spider(spider)
+        self.store.refresh()
+        self.jars = self.store.jars
+
 
-        with open(filename, "rb") as f:
-            self.jars = pickle.load(f)
+class PlaywrightPagePoolMiddleware:
+    def process_request(self, request, spider):
+        page_pool = getattr(spider, "page_pool", None)
+        if (
+            page_pool is None
+            or not request.meta.get("playwright")
+            or "playwright_page" in request.meta
+        ):
+            return None
+        context_name, page = page_pool.acquire()
+        request.meta["playwright_context"] = context_name
+        request.meta["playwright_page_init_callback"] = page_pool.init_page
+        if page is not None:
+            request.meta["playwright_page"] = page
+        return None
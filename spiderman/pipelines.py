@@ -6,160 +6,1165 @@
 
 # useful for handling different item types with a single interface
 import asyncio
-from datetime import datetime, timedelta
-import io
+from dataclasses import dataclass, field
 import logging
 import os
-import pickle
-import re
-from typing import DefaultDict, Literal, Optional
+import time
+from typing import Any, AsyncIterator, Dict, List, Literal, Optional
 import aiofiles
 import aiofiles.os
-import aiofiles.ospath
 from anyio import Path
 from httpx import AsyncClient
 import httpx
 import scrapy
 import urllib3
 import urllib3.util
-from spiderman.items import ComicChapterItem, ComicItem
+from spiderman.items import (
+    ComicChapterDownloadItem,
+    ComicChapterItem,
+    ComicChaptersEndItem,
+    ComicItem,
+)
 from scrapy.http.cookies import CookieJar
-from tenacity import RetryCallState, retry, retry_if_exception_type, wait_fixed
+from scrapy.utils.defer import deferred_from_coro
+from tenacity import AsyncRetrying, RetryCallState
 
-from spiderman.middlewares import PersistenceCookiesMiddleware
+from spiderman import signals
+from spiderman.bandwidth import BandwidthLimiter
+from spiderman.cookies import CookieStore, get_enabled_persistence
+from spiderman.directory import (
+    LOCK_SUFFIX,
+    PARTIAL_SUFFIX,
+    RESUME_SUFFIX,
+    SEGMENTS_SUFFIX,
+    ComicDirectoryIndex,
+    remove_order_prefix,
+)
+from spiderman.download_queue import DownloadQueue
+from spiderman.integrity import (
+    QUARANTINE_DIR,
+    VERIFY_SUFFIX,
+    ChapterVerifier,
+    CorruptDownloadError,
+    VerificationResult,
+    create_verifier,
+)
+from spiderman.download_order import (
+    DOWNLOAD_ORDERS,
+    DownloadOrder,
+    PrioritySemaphore,
+    chapter_priority,
+    sort_chapters,
+)
+from spiderman.locks import FileLock
+from spiderman.manifest import CrawlManifest
+from spiderman.metrics import (
+    DOWNLOAD_BYTES,
+    DOWNLOAD_RETRIES,
+    chapter_status_key,
+    inc_value,
+)
+from spiderman.resume import ResumeInfo, get_validator
+from spiderman.retry import (
+    CircuitBreaker,
+    IncompleteDownloadError,
+    RetryableStatusError,
+    RetryPolicy,
+    is_host_failure,
+    parse_retry_after,
+)
+from spiderman.segments import (
+    DownloadSegment,
+    SegmentedDownloadError,
+    SegmentedDownloadState,
+    parse_content_range,
+)
+from spiderman.session import SessionExpiredError, SessionManager
+from spiderman.writer import ChapterFileWriter, FsyncPolicy
 
 logger = logging.getLogger(__name__)
 
 
-def after_retry_log(retry_state: RetryCallState):
-    logger.warning(
-        f"Retrying download of chapter '{retry_state.args[0].get_chapter_full_name(retry_state.args[1], retry_state.args[2])}' after {retry_state.attempt_number} attempts (last exception: {retry_state.outcome.exception() if retry_state.outcome else ''})"
-    )
+@dataclass
+class ComicDownloadSlot:
+    semaphore: PrioritySemaphore
+    index: Optional[ComicDirectoryIndex] = field(default=None)
+    active: int = field(default=0)
+
+
+@dataclass
+class StreamedComic:
+    finished: int = field(default=0)
+    # Whether every finished chapter is downloaded
+    complete: bool = field(default=True)
+    # Known from the end of the comic's stream
+    chapters: Optional[int] = field(default=None)
+    chapters_hash: Optional[str] = field(default=None)
 
 
 class ComicDownloadPipeline:
+    def __init__(self):
+        self.download_semaphore: Optional[PrioritySemaphore] = None
+        self.download_order: DownloadOrder = "table"
+        self.bandwidth: Optional[BandwidthLimiter] = None
+        self.retry_policy = RetryPolicy()
+        self.circuit_breaker = CircuitBreaker()
+        self.concurrency_per_comic = 1
+        self.http_client: Optional[AsyncClient] = None
+        self.chunk_size = 1024 * 1024
+        self.write_buffer_size = 8 * 1024 * 1024
+        self.preallocate = True
+        self.fsync_policy: FsyncPolicy = "never"
+        self.progress_interval = 5.0
+        self.segments = 1
+        self.min_segment_size = 8 * 1024 * 1024
+        self.partial_ttl = 7 * 24 * 60 * 60.0
+        self.verify = True
+        self.verify_digest = "sha256"
+        self.manifest: Optional[CrawlManifest] = None
+        self.download_queue: Optional[DownloadQueue] = None
+        self.comic_slots: Dict[str, ComicDownloadSlot] = {}
+        # Chapters of each streamed comic that aren't recorded in the manifest
+        self.streamed_comics: Dict[str, StreamedComic] = {}
+        self.stats = None
+        self.signals = None
+
+    def open_spider(self, spider: scrapy.Spider):
+        self.stats = spider.crawler.stats if spider.crawler else None
+        self.signals = spider.crawler.signals if spider.crawler else None
+        self.http_client = self.create_http_client(spider)
+        # No more chapters at a time than the client has connections, so the
+        # chapters wait their turn here and not in the connection pool.
+        max_connections = spider.settings.getint("COMIC_DOWNLOAD_MAX_CONNECTIONS", 10)
+        concurrency = spider.settings.getint("COMIC_DOWNLOAD_CONCURRENCY", 0)
+        if concurrency > max_connections:
+            logger.warning(
+                f"COMIC_DOWNLOAD_CONCURRENCY {concurrency} is more than the {max_connections} COMIC_DOWNLOAD_MAX_CONNECTIONS, using {max_connections}"
+            )
+        if concurrency <= 0 or concurrency > max_connections:
+            concurrency = max_connections
+        self.download_semaphore = PrioritySemaphore(concurrency)
+        self.download_order = spider.settings.get(
+            "COMIC_DOWNLOAD_ORDER", self.download_order
+        )
+        assert (
+            self.download_order in DOWNLOAD_ORDERS
+        ), f"COMIC_DOWNLOAD_ORDER must be one of {', '.join(DOWNLOAD_ORDERS)}"
+        # The API workers share one limiter, a crawl of its own builds one
+        self.bandwidth = spider.settings.get(
+            "COMIC_DOWNLOAD_BANDWIDTH_LIMITER"
+        ) or BandwidthLimiter.from_settings(spider.settings)
+        self.concurrency_per_comic = max(
+            spider.settings.getint("COMIC_DOWNLOAD_CONCURRENCY_PER_COMIC", 1), 1
+        )
+        self.chunk_size = spider.settings.getint(
+            "COMIC_DOWNLOAD_CHUNK_SIZE", self.chunk_size
+        )
+        self.write_buffer_size = spider.settings.getint(
+            "COMIC_DOWNLOAD_WRITE_BUFFER_SIZE", self.write_buffer_size
+        )
+        self.preallocate = spider.settings.getbool(
+            "COMIC_DOWNLOAD_PREALLOCATE", self.preallocate
+        )
+        self.fsync_policy = spider.settings.get(
+            "COMIC_DOWNLOAD_FSYNC", self.fsync_policy
+        )
+        self.progress_interval = spider.settings.getfloat(
+            "COMIC_DOWNLOAD_PROGRESS_INTERVAL", self.progress_interval
+        )
+        self.segments = spider.settings.getint("COMIC_DOWNLOAD_SEGMENTS", self.segments)
+        self.min_segment_size = spider.settings.getint(
+            "COMIC_DOWNLOAD_MIN_SEGMENT_SIZE", self.min_segment_size
+        )
+        self.partial_ttl = spider.settings.getfloat(
+            "COMIC_DOWNLOAD_PARTIAL_TTL", self.partial_ttl
+        )
+        self.verify = spider.settings.getbool("COMIC_DOWNLOAD_VERIFY", self.verify)
+        self.verify_digest = spider.settings.get(
+            "COMIC_DOWNLOAD_VERIFY_DIGEST", self.verify_digest
+        )
+        self.retry_policy = RetryPolicy.from_settings(spider.settings)
+        self.circuit_breaker = CircuitBreaker.from_settings(spider.settings)
+        manifest_path = spider.settings.get("COMIC_DOWNLOAD_MANIFEST")
+        if manifest_path:
+            self.manifest = CrawlManifest(manifest_path)
+        queue_path = spider.settings.get("COMIC_DOWNLOAD_QUEUE")
+        if queue_path:
+            self.download_queue = DownloadQueue(queue_path)
+
+    def close_spider(self, spider: scrapy.Spider):
+        return deferred_from_coro(self.close())
+
+    async def close(self):
+        if self.manifest is not None:
+            self.manifest.close()
+            self.manifest = None
+        if self.download_queue is not None:
+            self.download_queue.close()
+            self.download_queue = None
+        if self.http_client is None:
+            return
+        http_client, self.http_client = self.http_client, None
+        await http_client.aclose()
+
+    @staticmethod
+    def create_http_client(spider: scrapy.Spider) -> AsyncClient:
+        settings = spider.settings
+        return AsyncClient(
+            proxy=os.getenv("HTTP_PROXY"),
+            http2=settings.getbool("COMIC_DOWNLOAD_HTTP2", False),
+            limits=httpx.Limits(
+                max_connections=settings.getint("COMIC_DOWNLOAD_MAX_CONNECTIONS", 10),
+                max_keepalive_connections=settings.getint(
+                    "COMIC_DOWNLOAD_MAX_KEEPALIVE_CONNECTIONS", 5
+                ),
+                keepalive_expiry=settings.getfloat(
+                    "COMIC_DOWNLOAD_KEEPALIVE_EXPIRY", 30.0
+                ),
+            ),
+            # Chapters wait for their turn at the download semaphores, range
+            # probes and segments are sent outside of them and may wait here
+            # for a free connection. That wait is back-pressure of the crawl
+            # itself and unbounded unless COMIC_DOWNLOAD_POOL_TIMEOUT is set.
+            timeout=httpx.Timeout(
+                connect=settings.getfloat("COMIC_DOWNLOAD_CONNECT_TIMEOUT", 30.0),
+                read=settings.getfloat("COMIC_DOWNLOAD_READ_TIMEOUT", 60.0),
+                write=settings.getfloat("COMIC_DOWNLOAD_WRITE_TIMEOUT", 30.0),
+                pool=settings.getfloat("COMIC_DOWNLOAD_POOL_TIMEOUT", 0) or None,
+            ),
+        )
+
+    def get_http_client(self, spider: scrapy.Spider) -> AsyncClient:
+        if self.http_client is None:
+            self.http_client = self.create_http_client(spider)
+        return self.http_client
+
     async def process_item(self, item, spider):
+        if isinstance(item, ComicChapterDownloadItem):
+            downloaded = await self.process_chapter_item(item, spider)
+            if downloaded is not None:
+                self.count_streamed_chapter(item.comic, downloaded)
+            return item
+        if isinstance(item, ComicChaptersEndItem):
+            self.end_streamed_comic(item)
+            return item
         if not item or not isinstance(item, ComicItem):
             return item
         if not item.chapters:
             return item
-        for chapter in item.chapters:
-            await self.download_chapter(item, chapter, spider)
+        chapters = item.chapters
+        chapters_hash = None
+        if self.manifest is not None and item.url:
+            chapters_hash = CrawlManifest.hash_chapters(item.chapters)
+            if self.manifest.is_comic_complete(item.url, chapters_hash):
+                logger.info(
+                    f"Comic '{item.name}' is unchanged since the last crawl, skipping"
+                )
+                for chapter in item.chapters:
+                    self.record_chapter_status(item, chapter, "skipped")
+                self.manifest.mark_comic(item, chapters_hash)
+                return item
+            statuses = self.manifest.chapter_statuses(item.url)
+            chapters = []
+            for chapter in item.chapters:
+                if statuses.get(chapter.name or "") == "complete":
+                    self.record_chapter_status(item, chapter, "skipped")
+                else:
+                    chapters.append(chapter)
+        chapters = sort_chapters(self.download_order, chapters)
+        for chapter in chapters:
+            self.send_chapter_queued(item, chapter)
+        if self.download_queue is not None and chapters:
+            # Left to the download worker, which marks them in the manifest
+            # and the comic once the last of them is done
+            self.download_queue.enqueue(spider.name, item, chapters, chapters_hash)
+            return item
+        indexes = await self.scan_comic_directories(chapters)
+        comic_semaphore = PrioritySemaphore(self.concurrency_per_comic)
+        results = await asyncio.gather(
+            *[
+                self.download_chapter_limited(
+                    item,
+                    chapter,
+                    spider,
+                    comic_semaphore,
+                    indexes.get(os.path.dirname(chapter.save_path or "")),
+                )
+                for chapter in chapters
+            ],
+            return_exceptions=True,
+        )
+        for chapter, result in zip(chapters, results):
+            self.record_chapter_result(item, chapter, result)
+        if self.manifest is not None and item.url:
+            self.manifest.mark_comic(
+                item,
+                chapters_hash if all(result is True for result in results) else None,
+            )
         return item
 
-    @retry(
-        retry=retry_if_exception_type(httpx.RemoteProtocolError),
-        wait=wait_fixed(timedelta(seconds=30)),
-        reraise=True,
-        after=after_retry_log,
-    )
-    async def download_chapter(
-        self, item: ComicItem, chapter: ComicChapterItem, spider: scrapy.Spider
+    async def process_chapter_item(
+        self, item: ComicChapterDownloadItem, spider: scrapy.Spider
+    ) -> Optional[bool]:
+        # Whether the chapter is downloaded, None if it's left to the queue
+        comic, chapter = item.comic, item.chapter
+        if (
+            self.manifest is not None
+            and comic.url
+            and chapter.name
+            and self.manifest.chapter_status(comic.url, chapter.name) == "complete"
+        ):
+            self.record_chapter_status(comic, chapter, "skipped")
+            return True
+        self.send_chapter_queued(comic, chapter)
+        if self.download_queue is not None:
+            self.download_queue.enqueue(spider.name, comic, [chapter])
+            return None
+        key = comic.url or comic.name or ""
+        slot = self.comic_slots.get(key)
+        if slot is None:
+            slot = self.comic_slots[key] = ComicDownloadSlot(
+                PrioritySemaphore(self.concurrency_per_comic)
+            )
+        slot.active += 1
+        try:
+            if slot.index is None and chapter.save_path:
+                slot.index = (await self.scan_comic_directories([chapter]))[
+                    os.path.dirname(chapter.save_path)
+                ]
+            result = await self.download_chapter_limited(
+                comic, chapter, spider, slot.semaphore, slot.index
+            )
+        except Exception as e:
+            result = e
+        finally:
+            slot.active -= 1
+            if slot.active == 0:
+                # Dropped with the last chapter in flight to keep memory flat,
+                # a later chapter of the same comic simply rescans.
+                del self.comic_slots[key]
+        self.record_chapter_result(comic, chapter, result)
+        return result is True
+
+    def count_streamed_chapter(self, comic: ComicItem, downloaded: bool):
+        if self.manifest is None or not comic.url:
+            return
+        streamed = self.streamed_comics.setdefault(comic.url, StreamedComic())
+        streamed.finished += 1
+        streamed.complete = streamed.complete and downloaded
+        self.finish_streamed_comic(comic)
+
+    def end_streamed_comic(self, item: ComicChaptersEndItem):
+        # Chapters left to the queue are the download worker's to count
+        if self.manifest is None or self.download_queue is not None or not item.comic.url:
+            return
+        if item.chapters_hash and self.manifest.is_comic_complete(
+            item.comic.url, item.chapters_hash
+        ):
+            logger.info(
+                f"Comic '{item.comic.name}' is unchanged since the last crawl, its chapters were skipped"
+            )
+        streamed = self.streamed_comics.setdefault(item.comic.url, StreamedComic())
+        streamed.chapters = item.chapters
+        streamed.chapters_hash = item.chapters_hash
+        self.finish_streamed_comic(item.comic)
+
+    def finish_streamed_comic(self, comic: ComicItem):
+        # Once with the last chapter, which can finish before or after the
+        # end of the comic's table is known.
+        assert self.manifest is not None and comic.url
+        streamed = self.streamed_comics[comic.url]
+        if streamed.chapters is None or streamed.finished < streamed.chapters:
+            return
+        del self.streamed_comics[comic.url]
+        self.manifest.mark_comic(
+            comic, streamed.chapters_hash if streamed.complete else None
+        )
+
+    def record_chapter_result(
+        self, item: ComicItem, chapter: ComicChapterItem, result: Any
+    ):
+        if isinstance(result, Exception):
+            logger.error(
+                f"Failed to download chapter '{self.get_chapter_full_name(item, chapter)}': {result!r}"
+            )
+        if result is not True:
+            self.record_chapter_status(item, chapter, "failed")
+        if self.manifest is not None and item.url and chapter.name:
+            self.manifest.mark_chapter(
+                item, chapter, "complete" if result is True else "failed"
+            )
+
+    async def scan_comic_directories(
+        self, chapters: List[ComicChapterItem]
+    ) -> Dict[str, ComicDirectoryIndex]:
+        directories = {
+            os.path.dirname(chapter.save_path) for chapter in chapters if chapter.save_path
+        }
+        loop = asyncio.get_running_loop()
+        return {
+            directory: await loop.run_in_executor(None, self.scan_directory, directory)
+            for directory in directories
+        }
+
+    def scan_directory(self, directory: str) -> ComicDirectoryIndex:
+        index = ComicDirectoryIndex.scan(directory)
+        if self.partial_ttl > 0:
+            for name in index.expire_partials(self.partial_ttl):
+                logger.info(
+                    f"Removed partial download '{os.path.join(directory, name)}' untouched for more than {self.partial_ttl:.0f} seconds"
+                )
+        return index
+
+    async def download_chapter_limited(
+        self,
+        item: ComicItem,
+        chapter: ComicChapterItem,
+        spider: scrapy.Spider,
+        comic_semaphore: PrioritySemaphore,
+        index: Optional[ComicDirectoryIndex] = None,
+    ):
+        # Take the per comic slot first so a comic waiting on its own limit
+        # doesn't hold one of the global slots. Free slots go to the chapter
+        # that comes first in COMIC_DOWNLOAD_ORDER.
+        priority = chapter_priority(self.download_order, chapter)
+        async with comic_semaphore.slot(priority):
+            if self.download_semaphore is None:
+                return await self.download_chapter_claimed(
+                    item, chapter, spider, index
+                )
+            async with self.download_semaphore.slot(priority):
+                return await self.download_chapter_claimed(
+                    item, chapter, spider, index
+                )
+
+    async def download_chapter_claimed(
+        self,
+        item: ComicItem,
+        chapter: ComicChapterItem,
+        spider: scrapy.Spider,
+        index: Optional[ComicDirectoryIndex] = None,
+    ) -> bool:
+        # Crawlers whose comics overlap, like the shards of a run, never
+        # download a chapter twice. The one that comes second waits and finds
+        # the chapter done. Claimed inside the slots, a claimed chapter is
+        # always downloading and never waits on another one.
+        if not chapter.save_path:
+            return await self.download_chapter_with_retry(item, chapter, spider, index)
+        lock = FileLock(f"{chapter.save_path}{LOCK_SUFFIX}")
+        if not lock.try_acquire():
+            logger.info(
+                f"Chapter '{self.get_chapter_full_name(item, chapter)}' is downloading in another crawler, waiting for it"
+            )
+            await lock.acquire()
+            # The index doesn't know what the other crawler left behind
+            index = None
+        try:
+            return await self.download_chapter_with_retry(item, chapter, spider, index)
+        finally:
+            lock.release()
+
+    async def download_chapter_in_session(
+        self,
+        item: ComicItem,
+        chapter: ComicChapterItem,
+        spider: scrapy.Spider,
+        index: Optional[ComicDirectoryIndex] = None,
+    ) -> bool:
+        # Downloads share the login session of the spider that crawled them
+        session: Optional[SessionManager] = getattr(spider, "session", None)
+        generation = session.generation if session is not None else None
+        try:
+            return await self.download_chapter(item, chapter, spider, index)
+        except SessionExpiredError:
+            if session is None or not await session.login(generation):
+                raise
+        logger.info(
+            f"Logged in again, retrying download of chapter '{self.get_chapter_full_name(item, chapter)}'"
+        )
+        return await self.download_chapter(item, chapter, spider, index)
+
+    async def download_chapter_with_retry(
+        self,
+        item: ComicItem,
+        chapter: ComicChapterItem,
+        spider: scrapy.Spider,
+        index: Optional[ComicDirectoryIndex] = None,
+    ) -> bool:
+        # Every attempt resumes from the partial file of the previous one
+        host = urllib3.util.parse_url(chapter.download_url or "").host or ""
+        retrying = AsyncRetrying(
+            retry=self.retry_policy.should_retry,
+            wait=self.retry_policy.backoff,
+            reraise=True,
+            after=lambda retry_state: self.log_retry(item, chapter, retry_state),
+        )
+        result = False
+        async for attempt in retrying:
+            with attempt:
+                await self.circuit_breaker.wait(host)
+                try:
+                    result = await self.download_chapter_in_session(
+                        item, chapter, spider, index
+                    )
+                except Exception as e:
+                    if is_host_failure(e):
+                        self.circuit_breaker.record_failure(host)
+                    else:
+                        self.circuit_breaker.record_success(host)
+                    raise
+                self.circuit_breaker.record_success(host)
+        return result
+
+    def log_retry(
+        self, item: ComicItem, chapter: ComicChapterItem, retry_state: RetryCallState
     ):
+        inc_value(self.stats, DOWNLOAD_RETRIES)
+        logger.warning(
+            f"Retrying download of chapter '{self.get_chapter_full_name(item, chapter)}' after {retry_state.attempt_number} attempts (last exception: {retry_state.outcome.exception() if retry_state.outcome else ''!r})"
+        )
+
+    async def download_chapter(
+        self,
+        item: ComicItem,
+        chapter: ComicChapterItem,
+        spider: scrapy.Spider,
+        index: Optional[ComicDirectoryIndex] = None,
+    ) -> bool:
         if not chapter or not isinstance(chapter, ComicChapterItem):
-            return
+            return False
         chapter_full_name = self.get_chapter_full_name(item, chapter)
         if not chapter.download_url:
             logger.warning(
                 f"Chapter '{chapter_full_name}' has no download URL"
             )
-            return
+            return False
         if not chapter.save_path:
             logger.warning(
                 f"Chapter '{chapter_full_name}' has no save path"
             )
-            return
-        if await aiofiles.ospath.exists(chapter.save_path):
+            return False
+        directory = os.path.dirname(chapter.save_path)
+        if index is None:
+            index = await asyncio.get_running_loop().run_in_executor(
+                None, self.scan_directory, directory
+            )
+        files = index.lookup(chapter.save_path)
+        if files.final:
             logger.info(
                 f"Chapter '{chapter_full_name}' already exists, skipping"
             )
-            return
-        save_path_without_order = Path(chapter.save_path).with_name(
-            re.sub(r"^\[\d+\]-", "", Path(chapter.save_path).name)
-        )
-        if await aiofiles.ospath.exists(save_path_without_order):
+            self.record_chapter_status(item, chapter, "skipped")
+            return True
+        if files.unprefixed:
+            save_path_without_order = Path(chapter.save_path).with_name(
+                remove_order_prefix(Path(chapter.save_path).name)
+            )
             logger.info(
                 f"Chapter '{chapter_full_name}' already exists (without order), renaming"
             )
             await asyncio.sleep(0.1)
             await aiofiles.os.rename(save_path_without_order, chapter.save_path)
-            return
-        if not await aiofiles.ospath.exists(os.path.dirname(chapter.save_path)):
-            await aiofiles.os.makedirs(os.path.dirname(chapter.save_path))
+            index.discard(str(save_path_without_order))
+            index.add(chapter.save_path)
+            self.record_chapter_status(item, chapter, "skipped")
+            return True
+        if not index.exists:
+            await aiofiles.os.makedirs(directory, exist_ok=True)
+            index.exists = True
         cookie_jar = await self.load_cookies(chapter.download_url, spider)
         download_size = 0
-        temp_downloading_file = f"{chapter.save_path}.downloading"
+        temp_downloading_file = f"{chapter.save_path}{PARTIAL_SUFFIX}"
+        resume_file = f"{chapter.save_path}{RESUME_SUFFIX}"
         headers = {
             "User-Agent": spider.settings.get("USER_AGENT"),
-            # "If-Range": "Wed, 15 Nov 1995 04:58:08 GMT",
         }
-        async with AsyncClient(
-            proxy=os.getenv("HTTP_PROXY"), timeout=None
-        ) as http_client:
-            if await aiofiles.ospath.exists(temp_downloading_file):
-                async with aiofiles.open(temp_downloading_file, "rb") as f:
-                    await f.seek(0, os.SEEK_END)
-                    download_size = await f.tell()
-                    if download_size > 0:
-                        logger.info(
-                            f"Resuming download of chapter '{chapter_full_name}' from {self.download_size_str(download_size)} bytes"
-                        )
-                        headers.update(
-                            {
-                                "Range": f"bytes={download_size}-",
-                            }
-                        )
-            async with http_client.stream(
-                "GET",
-                chapter.download_url,
-                follow_redirects=True,
-                cookies=cookie_jar.jar,
-                headers=headers,
-                timeout=None,
-            ) as response:
-                if not response.is_success:
-                    logger.error(
-                        f"Failed to download chapter '{chapter_full_name}'"
+        http_client = self.get_http_client(spider)
+        if self.segments > 1:
+            completed = await self.download_chapter_segmented(
+                item,
+                chapter_full_name,
+                chapter,
+                http_client,
+                cookie_jar,
+                headers,
+                temp_downloading_file,
+                index,
+            )
+            if completed is not None:
+                return completed
+        files = index.lookup(chapter.save_path)
+        resume = None
+        if files.partial and files.resume:
+            resume = await asyncio.get_running_loop().run_in_executor(
+                None, ResumeInfo.load, resume_file
+            )
+        if files.partial and (files.segments or resume is None):
+            # Segments land anywhere in the file, the end of a partial is only
+            # where to resume if a single stream wrote it.
+            logger.info(
+                f"Partial download of chapter '{chapter_full_name}' isn't from a single stream, restarting download"
+            )
+            await self.remove_files(
+                index,
+                temp_downloading_file,
+                resume_file,
+                f"{chapter.save_path}{SEGMENTS_SUFFIX}",
+            )
+            files = index.lookup(chapter.save_path)
+        if files.partial:
+            async with aiofiles.open(temp_downloading_file, "rb") as f:
+                await f.seek(0, os.SEEK_END)
+                download_size = await f.tell()
+            if resume is not None and resume.url != chapter.download_url:
+                logger.info(
+                    f"Chapter '{chapter_full_name}' moved to another URL, restarting download"
+                )
+                resume = None
+            elif download_size > 0:
+                logger.info(
+                    f"Resuming download of chapter '{chapter_full_name}' from {self.download_size_str(download_size)} bytes"
+                )
+                self.record_chapter_status(item, chapter, "resumed")
+                headers.update(
+                    {
+                        "Range": f"bytes={download_size}-",
+                    }
+                )
+                # The server sends the whole file instead if it changed
+                if resume is not None and resume.validator:
+                    headers["If-Range"] = resume.validator
+        async with http_client.stream(
+            "GET",
+            chapter.download_url,
+            follow_redirects=True,
+            cookies=cookie_jar.jar,
+            headers=headers,
+        ) as response:
+            if self.retry_policy.is_retryable_status(response.status_code):
+                raise RetryableStatusError(
+                    response.status_code,
+                    parse_retry_after(response.headers.get("Retry-After")),
+                )
+            if response.status_code in (401, 403):
+                raise SessionExpiredError(
+                    f"Server refused chapter '{chapter_full_name}' with status {response.status_code}"
+                )
+            if not response.is_success:
+                logger.error(
+                    f"Failed to download chapter '{chapter_full_name}'"
+                )
+                return False
+            content_length = (
+                int(response.headers.get("Content-Length"))
+                if response.headers.get("Content-Length")
+                else 0
+            )
+            # Size of the whole file, 0 if the server doesn't tell
+            file_size = content_length
+            content_range = parse_content_range(response.headers.get("Content-Range"))
+            open_mode: Literal["ab", "wb"] = "ab"
+            verifier = self.create_verifier(chapter.save_path)
+            if response.status_code == 206 and content_range:
+                start, _, total = content_range
+                file_size = total or (start + content_length if content_length else 0)
+                if start != download_size:
+                    await self.remove_files(index, temp_downloading_file, resume_file)
+                    raise IncompleteDownloadError(
+                        f"Asked to resume from {download_size} bytes, got a range from {start}, restarting"
                     )
-                    return
-                file_size = (
-                    int(response.headers.get("Content-Length"))
-                    if response.headers.get("Content-Length")
-                    else 0
-                )
-                content_range = response.headers.get("Content-Range")
-                open_mode: Literal["ab", "wb"] = "ab"
-                if response.status_code == 206 and content_range:
-                    file_size = max(file_size, int(content_range.split("/")[-1]))
-                    logger.debug(
-                        f"Chapter '{chapter_full_name}' download from range '{content_range}'"
+                if resume is not None and resume.size and file_size and resume.size != file_size:
+                    await self.remove_files(index, temp_downloading_file, resume_file)
+                    raise IncompleteDownloadError(
+                        f"File size changed from {resume.size} to {file_size} bytes, restarting"
                     )
-                elif response.status_code == 200:
-                    open_mode = "wb"
-                    logger.debug(
-                        f"Chapter '{chapter_full_name}' download from start"
+                logger.debug(
+                    f"Chapter '{chapter_full_name}' download from range '{response.headers.get('Content-Range')}'"
+                )
+                if verifier is not None and start > 0:
+                    await asyncio.get_running_loop().run_in_executor(
+                        None, verifier.seed, temp_downloading_file, start
                     )
-                else:
-                    logger.error(
-                        f"Failed to download chapter '{chapter_full_name}'"
+            elif response.status_code == 200:
+                open_mode = "wb"
+                if "If-Range" in headers:
+                    logger.info(
+                        f"Chapter '{chapter_full_name}' changed on the server, restarting download"
                     )
-                    return
-                async with aiofiles.open(temp_downloading_file, open_mode) as f:
-                    last_time = datetime.now()
-                    async for chunk in response.aiter_bytes(1024):
-                        await f.write(chunk)
-                        download_size = download_size + len(chunk)
-                        if (datetime.now() - last_time).total_seconds() >= 5:
-                            last_time = datetime.now()
-                            logger.debug(
-                                f"Downloading chapter '{chapter_full_name} ({self.download_size_str(download_size)}/{self.download_size_str(file_size) or chapter.size or 'unknown'})'"
-                            )
-                if download_size != file_size:
-                    logger.warning(
-                        f"Chapter '{chapter_full_name}' downloaded size ({self.download_size_str(download_size)}) doesn't match expected size ({self.download_size_str(file_size)})"
+                download_size = 0
+                logger.debug(
+                    f"Chapter '{chapter_full_name}' download from start"
+                )
+            else:
+                logger.error(
+                    f"Failed to download chapter '{chapter_full_name}'"
+                )
+                return False
+            await asyncio.get_running_loop().run_in_executor(
+                None,
+                ResumeInfo.from_headers(
+                    chapter.download_url, response.headers, file_size
+                ).save,
+                resume_file,
+            )
+            index.add(resume_file)
+            index.add(temp_downloading_file)
+            async with ChapterFileWriter(
+                temp_downloading_file,
+                open_mode,
+                buffer_size=self.write_buffer_size,
+                fsync=self.fsync_policy,
+                preallocate_size=file_size if self.preallocate else 0,
+            ) as writer:
+                progress_task = asyncio.ensure_future(
+                    self.report_progress(item, chapter, writer, file_size)
+                )
+                try:
+                    async for chunk in self.iter_chunks(response):
+                        await writer.write(chunk)
+                        if verifier is not None:
+                            verifier.update(chunk)
+                        inc_value(self.stats, DOWNLOAD_BYTES, len(chunk))
+                        await self.throttle(response, len(chunk))
+                finally:
+                    progress_task.cancel()
+            download_size = writer.position
+            if download_size < file_size:
+                raise IncompleteDownloadError(
+                    f"Got {self.download_size_str(download_size)} of {self.download_size_str(file_size)}"
+                )
+            if verifier is not None:
+                await self.verify_download(
+                    item,
+                    chapter,
+                    verifier,
+                    file_size,
+                    temp_downloading_file,
+                    index,
+                    resume_file,
+                )
+            elif file_size and download_size != file_size:
+                logger.warning(
+                    f"Chapter '{chapter_full_name}' downloaded size ({self.download_size_str(download_size)}) doesn't match expected size ({self.download_size_str(file_size)})"
+                )
+                return False
+            await aiofiles.os.rename(temp_downloading_file, chapter.save_path)
+            index.discard(temp_downloading_file)
+            index.add(chapter.save_path)
+            await self.remove_files(index, resume_file)
+            self.record_chapter_status(item, chapter, "completed")
+            return True
+
+    async def download_chapter_segmented(
+        self,
+        item: ComicItem,
+        chapter_full_name: str,
+        chapter: ComicChapterItem,
+        http_client: AsyncClient,
+        cookie_jar: CookieJar,
+        headers: Dict[str, str],
+        temp_downloading_file: str,
+        index: ComicDirectoryIndex,
+    ) -> Optional[bool]:
+        assert chapter.download_url and chapter.save_path
+        files = index.lookup(chapter.save_path)
+        state_file = f"{chapter.save_path}{SEGMENTS_SUFFIX}"
+        loop = asyncio.get_running_loop()
+        state = (
+            await loop.run_in_executor(None, SegmentedDownloadState.load, state_file)
+            if files.segments
+            else None
+        )
+        if state is None and files.segments:
+            logger.info(
+                f"Segment state of chapter '{chapter_full_name}' is broken, restarting download"
+            )
+            await self.remove_files(index, state_file, temp_downloading_file)
+            files = index.lookup(chapter.save_path)
+        if state is None and files.partial:
+            # Partial file of a single stream download, keep resuming it as is
+            return None
+        probe = await self.probe_download(
+            chapter.download_url, http_client, cookie_jar, headers
+        )
+        if probe is None and state is not None:
+            # The segments on disk are only any good with ranges, they are
+            # kept for the next attempt.
+            raise IncompleteDownloadError(
+                f"Server didn't answer the range probe of chapter '{chapter_full_name}'"
+            )
+        size = probe.size if probe is not None else None
+        validator = probe.validator if probe is not None else None
+        if state is not None and (
+            state.size != size
+            or get_validator(state.etag, state.last_modified) not in (None, validator)
+        ):
+            logger.info(
+                f"Chapter '{chapter_full_name}' changed on the server, restarting download"
+            )
+            state = None
+            await aiofiles.os.remove(state_file)
+            index.discard(state_file)
+            if files.partial:
+                await aiofiles.os.remove(temp_downloading_file)
+                index.discard(temp_downloading_file)
+        if size is None:
+            logger.debug(
+                f"Server rejects ranges for chapter '{chapter_full_name}', downloading in a single stream"
+            )
+            return None
+        if state is None:
+            count = min(self.segments, size // max(self.min_segment_size, 1))
+            if count < 2:
+                return None
+            state = SegmentedDownloadState.split(size, count)
+            if probe is not None:
+                state.etag, state.last_modified = probe.etag, probe.last_modified
+            await loop.run_in_executor(None, state.save, state_file)
+            index.add(state_file)
+            async with aiofiles.open(temp_downloading_file, "wb"):
+                pass
+            index.add(temp_downloading_file)
+            logger.debug(
+                f"Chapter '{chapter_full_name}' download in {len(state.segments)} segments"
+            )
+        else:
+            logger.info(
+                f"Resuming segmented download of chapter '{chapter_full_name}' from {self.download_size_str(state.downloaded)}"
+            )
+            self.record_chapter_status(item, chapter, "resumed")
+        stop_progress = asyncio.Event()
+        progress_task = asyncio.ensure_future(
+            self.report_segmented_progress(
+                item, chapter, state, state_file, stop_progress
+            )
+        )
+        try:
+            results = await asyncio.gather(
+                *[
+                    self.download_segment(
+                        chapter.download_url,
+                        http_client,
+                        cookie_jar,
+                        headers,
+                        temp_downloading_file,
+                        segment,
+                        get_validator(state.etag, state.last_modified),
                     )
-                    return
-                await aiofiles.os.rename(temp_downloading_file, chapter.save_path)
+                    for segment in state.segments
+                    if not segment.done
+                ],
+                return_exceptions=True,
+            )
+        finally:
+            # Stopped between two saves, a save in the executor can't be
+            # cancelled and would race the last one.
+            stop_progress.set()
+            await progress_task
+            await loop.run_in_executor(None, state.save, state_file)
+        for result in results:
+            if isinstance(result, BaseException):
+                raise result
+        if not state.done:
+            raise IncompleteDownloadError(
+                f"Got {self.download_size_str(state.downloaded)} of {self.download_size_str(state.size)} in segments"
+            )
+        verifier = self.create_verifier(chapter.save_path)
+        if verifier is not None:
+            await asyncio.get_running_loop().run_in_executor(
+                None, verifier.seed_ends, temp_downloading_file
+            )
+            await self.verify_download(
+                item,
+                chapter,
+                verifier,
+                state.size,
+                temp_downloading_file,
+                index,
+                state_file,
+            )
+        await aiofiles.os.rename(temp_downloading_file, chapter.save_path)
+        await aiofiles.os.remove(state_file)
+        index.discard(temp_downloading_file)
+        index.discard(state_file)
+        index.add(chapter.save_path)
+        self.record_chapter_status(item, chapter, "completed")
+        return True
+
+    async def probe_download(
+        self,
+        url: str,
+        http_client: AsyncClient,
+        cookie_jar: CookieJar,
+        headers: Dict[str, str],
+    ) -> Optional[ResumeInfo]:
+        async with http_client.stream(
+            "GET",
+            url,
+            follow_redirects=True,
+            cookies=cookie_jar.jar,
+            headers={**headers, "Range": "bytes=0-0"},
+        ) as response:
+            # None only if the server doesn't do ranges, a failure raises
+            if self.retry_policy.is_retryable_status(response.status_code):
+                raise RetryableStatusError(
+                    response.status_code,
+                    parse_retry_after(response.headers.get("Retry-After")),
+                )
+            if response.status_code in (401, 403):
+                raise SessionExpiredError(
+                    f"Server refused the range probe with status {response.status_code}"
+                )
+            content_range = parse_content_range(response.headers.get("Content-Range"))
+            if response.status_code != 206 or not content_range or not content_range[2]:
+                return None
+            return ResumeInfo.from_headers(url, response.headers, content_range[2])
+
+    async def download_segment(
+        self,
+        url: str,
+        http_client: AsyncClient,
+        cookie_jar: CookieJar,
+        headers: Dict[str, str],
+        temp_downloading_file: str,
+        segment: DownloadSegment,
+        validator: Optional[str] = None,
+    ):
+        range_headers = {"Range": f"bytes={segment.position}-{segment.end}"}
+        if validator:
+            range_headers["If-Range"] = validator
+        async with http_client.stream(
+            "GET",
+            url,
+            follow_redirects=True,
+            cookies=cookie_jar.jar,
+            headers={**headers, **range_headers},
+        ) as response:
+            if self.retry_policy.is_retryable_status(response.status_code):
+                raise RetryableStatusError(
+                    response.status_code,
+                    parse_retry_after(response.headers.get("Retry-After")),
+                )
+            if response.status_code in (401, 403):
+                raise SessionExpiredError(
+                    f"Server refused range {segment.position}-{segment.end} with status {response.status_code}"
+                )
+            if response.status_code == 200 and validator:
+                # The probe of the next attempt restarts the download
+                raise IncompleteDownloadError("Chapter changed on the server")
+            if response.status_code != 206:
+                raise SegmentedDownloadError(
+                    f"Expected a partial response for range {segment.position}-{segment.end}, got {response.status_code}"
+                )
+            # Written at the segment's position, any other range would go to
+            # the wrong place in the file.
+            content_range = parse_content_range(response.headers.get("Content-Range"))
+            if content_range is None or content_range[:2] != (
+                segment.position,
+                segment.end,
+            ):
+                raise SegmentedDownloadError(
+                    f"Asked for range {segment.position}-{segment.end}, got '{response.headers.get('Content-Range')}'"
+                )
+            writer = ChapterFileWriter(
+                temp_downloading_file,
+                "r+b",
+                buffer_size=self.write_buffer_size,
+                fsync=self.fsync_policy,
+                preallocate_size=segment.end + 1 if self.preallocate else 0,
+                offset=segment.position,
+            )
+            try:
+                async with writer:
+                    async for chunk in self.iter_chunks(response):
+                        remaining = segment.end + 1 - writer.position
+                        await writer.write(chunk[:remaining])
+                        inc_value(self.stats, DOWNLOAD_BYTES, min(len(chunk), remaining))
+                        segment.downloaded = writer.flushed_position - segment.start
+                        await self.throttle(response, len(chunk))
+                        if remaining <= len(chunk):
+                            break
+            finally:
+                segment.downloaded = writer.flushed_position - segment.start
+
+    async def report_segmented_progress(
+        self,
+        item: ComicItem,
+        chapter: ComicChapterItem,
+        state: SegmentedDownloadState,
+        state_file: str,
+        stop: asyncio.Event,
+    ):
+        chapter_full_name = self.get_chapter_full_name(item, chapter)
+        downloaded = state.downloaded
+        loop = asyncio.get_running_loop()
+        while True:
+            try:
+                await asyncio.wait_for(stop.wait(), self.progress_interval)
+                return
+            except asyncio.TimeoutError:
+                pass
+            await loop.run_in_executor(None, state.save, state_file)
+            logger.debug(
+                f"Downloading chapter '{chapter_full_name} ({self.download_size_str(state.downloaded)}/{self.download_size_str(state.size)} in {len(state.segments)} segments)'"
+            )
+            self.send_chapter_progress(
+                item,
+                chapter,
+                state.downloaded,
+                state.size,
+                (state.downloaded - downloaded) / self.progress_interval,
+            )
+            downloaded = state.downloaded
+
+    async def report_progress(
+        self,
+        item: ComicItem,
+        chapter: ComicChapterItem,
+        writer: ChapterFileWriter,
+        file_size: int,
+    ):
+        chapter_full_name = self.get_chapter_full_name(item, chapter)
+        position = writer.position
+        while True:
+            await asyncio.sleep(self.progress_interval)
+            logger.debug(
+                f"Downloading chapter '{chapter_full_name} ({self.download_size_str(writer.position)}/{self.download_size_str(file_size) or chapter.size or 'unknown'})'"
+            )
+            self.send_chapter_progress(
+                item,
+                chapter,
+                writer.position,
+                file_size,
+                (writer.position - position) / self.progress_interval,
+            )
+            position = writer.position
+
+    @staticmethod
+    async def remove_files(index: ComicDirectoryIndex, *paths: str):
+        for path in paths:
+            if os.path.basename(path) in index.names:
+                try:
+                    await aiofiles.os.remove(path)
+                except FileNotFoundError:
+                    pass
+                index.discard(path)
+
+    def create_verifier(self, save_path: str) -> Optional[ChapterVerifier]:
+        if not self.verify:
+            return None
+        return create_verifier(save_path, self.verify_digest)
+
+    async def verify_download(
+        self,
+        item: ComicItem,
+        chapter: ComicChapterItem,
+        verifier: ChapterVerifier,
+        expected_size: int,
+        temp_downloading_file: str,
+        index: ComicDirectoryIndex,
+        *state_files: str,
+    ):
+        assert chapter.save_path
+        loop = asyncio.get_running_loop()
+        result = verifier.verify(expected_size)
+        if result.ok:
+            await loop.run_in_executor(
+                None,
+                self.save_verification,
+                result,
+                f"{chapter.save_path}{VERIFY_SUFFIX}",
+                chapter,
+            )
+            return
+        # Moved out of the way so the next attempt downloads it from scratch
+        directory = os.path.join(os.path.dirname(chapter.save_path), QUARANTINE_DIR)
+        await aiofiles.os.makedirs(directory, exist_ok=True)
+        quarantine_path = os.path.join(
+            directory, f"{os.path.basename(chapter.save_path)}.{int(time.time())}"
+        )
+        await aiofiles.os.rename(temp_downloading_file, quarantine_path)
+        index.discard(temp_downloading_file)
+        await self.remove_files(index, *state_files)
+        await loop.run_in_executor(
+            None,
+            self.save_verification,
+            result,
+            f"{quarantine_path}{VERIFY_SUFFIX}",
+            chapter,
+        )
+        self.record_chapter_status(item, chapter, "quarantined")
+        logger.error(
+            f"Chapter '{self.get_chapter_full_name(item, chapter)}' failed verification ({result.error}), quarantined as '{quarantine_path}'"
+        )
+        raise CorruptDownloadError(result.error)
+
+    @staticmethod
+    def save_verification(
+        result: VerificationResult, filename: str, chapter: ComicChapterItem
+    ):
+        result.save(filename, download_url=chapter.download_url)
+
+    async def iter_chunks(self, response: httpx.Response) -> AsyncIterator[bytes]:
+        # Like aiter_bytes(chunk_size), which drops what it holds of an
+        # unfinished chunk when the connection breaks. Here that part is
+        # still handed out before the error, so a retry resumes after it.
+        chunk = bytearray()
+        try:
+            async for data in response.aiter_bytes():
+                chunk += data
+                if len(chunk) >= self.chunk_size:
+                    yield bytes(chunk)
+                    chunk.clear()
+        except httpx.HTTPError:
+            if chunk:
+                yield bytes(chunk)
+            raise
+        if chunk:
+            yield bytes(chunk)
+
+    async def throttle(self, response: httpx.Response, size: int):
+        if self.bandwidth is not None:
+            await self.bandwidth.throttle(response.url.host, size)
+
+    def record_chapter_status(
+        self, item: ComicItem, chapter: ComicChapterItem, status: str
+    ):
+        inc_value(self.stats, chapter_status_key(status))
+        self.send_signal(
+            signals.chapter_status, comic=item.name, chapter=chapter.name, status=status
+        )
+
+    def send_chapter_queued(self, item: ComicItem, chapter: ComicChapterItem):
+        self.send_signal(
+            signals.chapter_queued,
+            comic=item.name,
+            chapter=chapter.name,
+            size=chapter.size,
+        )
+
+    def send_chapter_progress(
+        self,
+        item: ComicItem,
+        chapter: ComicChapterItem,
+        downloaded: int,
+        total: int,
+        speed: float,
+    ):
+        self.send_signal(
+            signals.chapter_progress,
+            comic=item.name,
+            chapter=chapter.name,
+            downloaded=downloaded,
+            total=total or None,
+            speed=speed,
+            eta=(total - downloaded) / speed if total and speed > 0 else None,
+        )
+
+    def send_signal(self, signal: object, **kwargs: Any):
+        # Progress is only reported, a failing handler must not stop the download
+        if self.signals is not None:
+            self.signals.send_catch_log(signal, **kwargs)
 
     def download_size_str(self, size: Optional[int]) -> str:
         if size is None:
@@ -171,23 +1176,12 @@ class ComicDownloadPipeline:
         return f"{size / 1024 / 1024:.2f} MB"
 
     async def load_cookies(self, url: str, spider: scrapy.Spider) -> CookieJar:
-        if not PersistenceCookiesMiddleware.get_enabled_persistence(spider):
-            return CookieJar()
-        filename = PersistenceCookiesMiddleware.get_cookies_persistence_path(spider)
-        if not await aiofiles.os.path.exists(filename):
-            logger.info(f"File '{filename}' for cookie reload doesn't exist")
+        if not get_enabled_persistence(spider):
             return CookieJar()
-        logger.info(f"Loading cookies from file '{filename}'")
         hostname = urllib3.util.parse_url(url).hostname or ""
-        async with aiofiles.open(filename, "rb") as f:
-            data = await f.read()
-            with io.BytesIO() as b:
-                b.write(data)
-                b.seek(0)
-                jars: DefaultDict[str, CookieJar] = pickle.load(b)
-                jar = jars.get(hostname, CookieJar())
-                logger.info(f"Loaded {len(jar.jar)} cookies for '{hostname}'")
-                return jar
+        jar = CookieStore.from_spider(spider).get_jar(hostname)
+        logger.debug(f"Loaded {len(jar.jar)} cookies for '{hostname}'")
+        return jar
 
     def get_chapter_full_name(self, item: ComicItem, chapter: ComicChapterItem) -> str:
         return f"{item.name} - {chapter.name}"
@@ -0,0 +1,103 @@
+import logging
+from dataclasses import dataclass, field
+from typing import Callable, Dict, List, Optional, Tuple
+
+from playwright.async_api import BrowserContext, Page
+from playwright.async_api import Error as PlaywrightError
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class PooledContext:
+    name: str
+    active: int = field(default=0)
+    served: int = field(default=0)
+    idle_pages: List[Page] = field(default_factory=list)
+    context: Optional[BrowserContext] = field(default=None)
+
+
+class PlaywrightPagePool:
+    def __init__(
+        self,
+        context_prefix: str,
+        size: int,
+        max_pages_per_context: int = 50,
+        get_cookies: Optional[Callable[[], List[dict]]] = None,
+    ):
+        self.max_pages_per_context = max_pages_per_context
+        self.get_cookies = get_cookies
+        self.contexts: Dict[str, PooledContext] = {
+            name: PooledContext(name)
+            for name in (f"{context_prefix}-{i}" for i in range(size))
+        }
+
+    def acquire(self) -> Tuple[str, Optional[Page]]:
+        available = [
+            ctx
+            for ctx in self.contexts.values()
+            if ctx.served < self.max_pages_per_context
+        ] or list(self.contexts.values())
+        for ctx in available:
+            while ctx.idle_pages:
+                page = ctx.idle_pages.pop()
+                if page.is_closed():
+                    continue
+                ctx.active += 1
+                ctx.served += 1
+                return ctx.name, page
+        ctx = min(available, key=lambda c: c.active)
+        ctx.active += 1
+        ctx.served += 1
+        return ctx.name, None
+
+    async def init_page(self, page: Page, request):
+        # Runs before the first navigation of every page, new contexts get the
+        # login state of the persisted cookie jar.
+        ctx = self.contexts.get(request.meta.get("playwright_context"))
+        if ctx is None or ctx.context is page.context:
+            return
+        ctx.context = page.context
+        cookies = self.get_cookies() if self.get_cookies else []
+        if cookies:
+            await page.context.add_cookies(cookies)  # type: ignore
+
+    async def release(self, context_name: str, page: Optional[Page], healthy=True):
+        ctx = self.contexts.get(context_name)
+        if ctx is None:
+            return
+        ctx.active = max(ctx.active - 1, 0)
+        if page is None:
+            return
+        if healthy and not page.is_closed():
+            try:
+                # Also stops whatever the last page is still running
+                await page.goto("about:blank")
+            except PlaywrightError as e:
+                logger.warning(f"Page of context '{context_name}' is unhealthy: {e}")
+                healthy = False
+        else:
+            healthy = False
+        if not healthy:
+            await self.replace_context(ctx, page.context)
+            return
+        if ctx.served < self.max_pages_per_context:
+            ctx.idle_pages.append(page)
+            return
+        await page.close()
+        if ctx.active == 0:
+            logger.debug(
+                f"Context '{context_name}' served {ctx.served} pages, rotating"
+            )
+            await self.replace_context(ctx, page.context)
+
+    async def replace_context(self, ctx: PooledContext, context: BrowserContext):
+        # scrapy-playwright forgets closed contexts and creates a new one with
+        # the same name for the next request.
+        ctx.served = 0
+        ctx.idle_pages = []
+        ctx.context = None
+        try:
+            await context.close()
+        except PlaywrightError as e:
+            logger.debug(f"Failed to close context '{ctx.name}': {e}")
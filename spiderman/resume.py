@@ -0,0 +1,59 @@
+import json
+import logging
+import os
+import time
+from dataclasses import asdict, dataclass, field
+from typing import Mapping, Optional
+
+logger = logging.getLogger(__name__)
+
+
+def get_validator(etag: Optional[str], last_modified: Optional[str]) -> Optional[str]:
+    # If-Range only takes a strong ETag, a weak one falls back to the date
+    if etag and not etag.startswith("W/"):
+        return etag
+    return last_modified or None
+
+
+@dataclass
+class ResumeInfo:
+    """What a partial file was downloaded from, kept next to it so a resume
+    only appends to the same version of the same file."""
+
+    url: str
+    size: Optional[int] = field(default=None)
+    etag: Optional[str] = field(default=None)
+    last_modified: Optional[str] = field(default=None)
+    updated_at: float = field(default_factory=time.time)
+
+    @classmethod
+    def from_headers(
+        cls, url: str, headers: Mapping[str, str], size: Optional[int]
+    ) -> "ResumeInfo":
+        return cls(
+            url=url,
+            size=size or None,
+            etag=headers.get("ETag"),
+            last_modified=headers.get("Last-Modified"),
+        )
+
+    @property
+    def validator(self) -> Optional[str]:
+        return get_validator(self.etag, self.last_modified)
+
+    @classmethod
+    def load(cls, filename: str) -> Optional["ResumeInfo"]:
+        if not os.path.isfile(filename):
+            return None
+        try:
+            with open(filename, "r", encoding="utf-8") as f:
+                return cls(**json.load(f))
+        except (ValueError, TypeError) as e:
+            logger.warning(f"Ignoring broken resume file '{filename}': {e!r}")
+            return None
+
+    def save(self, filename: str):
+        temp_filename = f"{filename}.tmp"
+        with open(temp_filename, "w", encoding="utf-8") as f:
+            json.dump(asdict(self), f)
+        os.replace(temp_filename, filename)
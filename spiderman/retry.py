@@ -0,0 +1,217 @@
+import asyncio
+import email.utils
+import logging
+import random
+import time
+from dataclasses import dataclass, field
+from typing import Dict, Iterable, Optional
+
+import httpx
+from tenacity import RetryCallState
+
+from spiderman.integrity import CorruptDownloadError
+
+logger = logging.getLogger(__name__)
+
+RETRY_HTTP_CODES = (408, 429, 500, 502, 503, 504, 522, 524)
+
+
+class RetryableStatusError(Exception):
+    def __init__(self, status_code: int, retry_after: Optional[float] = None):
+        super().__init__(f"Server responded with status {status_code}")
+        self.status_code = status_code
+        self.retry_after = retry_after
+
+
+class IncompleteDownloadError(Exception):
+    """The server closed the response before the whole file arrived."""
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    if not value:
+        return None
+    if value.isdigit():
+        return float(value)
+    try:
+        date = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(date.timestamp() - time.time(), 0)
+
+
+def is_retryable(exception: BaseException) -> bool:
+    # Timeouts, refused and reset connections, broken responses, throttling,
+    # server errors and files that failed verification are worth another try,
+    # anything else is not going to change by asking again. Nor is a wait for
+    # a free connection, another try only waits in the same line.
+    if isinstance(exception, httpx.PoolTimeout):
+        return False
+    return isinstance(
+        exception,
+        (
+            httpx.TimeoutException,
+            httpx.NetworkError,
+            httpx.RemoteProtocolError,
+            RetryableStatusError,
+            IncompleteDownloadError,
+            CorruptDownloadError,
+        ),
+    )
+
+
+def is_host_failure(exception: BaseException) -> bool:
+    # What says the host is in trouble, for the circuit breaker. A cut off
+    # or broken file is about the file, the host did answer, and a wait for
+    # a free connection is about the pool of this crawler.
+    if isinstance(exception, httpx.PoolTimeout):
+        return False
+    if isinstance(exception, RetryableStatusError):
+        return exception.status_code == 429 or exception.status_code >= 500
+    return isinstance(
+        exception,
+        (httpx.TimeoutException, httpx.NetworkError, httpx.RemoteProtocolError),
+    )
+
+
+class RetryBudget:
+    """Retries left for a whole run, so a site that fails every download
+    doesn't keep a crawl busy for hours. A limit of 0 is unlimited."""
+
+    def __init__(self, limit: int = 0):
+        self.limit = limit
+        self.used = 0
+
+    def take(self) -> bool:
+        if self.limit > 0 and self.used >= self.limit:
+            return False
+        self.used += 1
+        return True
+
+
+@dataclass
+class CircuitState:
+    failures: int = field(default=0)
+    open_until: float = field(default=0.0)
+    cooldown: float = field(default=0.0)
+    probe_started: Optional[float] = field(default=None)
+
+
+class CircuitBreaker:
+    """Pauses every download from a host after ``threshold`` failures of the
+    host in a row. After the cooldown a single download probes the host
+    while the others keep waiting, a failed probe doubles the cooldown up to
+    ``max_cooldown``."""
+
+    def __init__(self, threshold: int = 5, cooldown: float = 60.0, max_cooldown: float = 600.0):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self.hosts: Dict[str, CircuitState] = {}
+
+    @classmethod
+    def from_settings(cls, settings) -> "CircuitBreaker":
+        return cls(
+            threshold=settings.getint("COMIC_DOWNLOAD_CIRCUIT_BREAKER_THRESHOLD", 5),
+            cooldown=settings.getfloat("COMIC_DOWNLOAD_CIRCUIT_BREAKER_COOLDOWN", 60.0),
+            max_cooldown=settings.getfloat(
+                "COMIC_DOWNLOAD_CIRCUIT_BREAKER_MAX_COOLDOWN", 600.0
+            ),
+        )
+
+    async def wait(self, host: str):
+        while True:
+            state = self.hosts.get(host)
+            if state is None or state.failures < self.threshold:
+                return
+            now = time.monotonic()
+            if state.open_until > now:
+                await asyncio.sleep(state.open_until - now)
+                continue
+            # A probe that never reported back doesn't block the host for good
+            if state.probe_started is None or now - state.probe_started > state.cooldown:
+                state.probe_started = now
+                return
+            await asyncio.sleep(1.0)
+
+    def record_success(self, host: str):
+        state = self.hosts.pop(host, None)
+        if state is not None and state.failures >= self.threshold:
+            logger.info(f"Host '{host}' is back, resuming downloads")
+
+    def record_failure(self, host: str):
+        if self.threshold <= 0:
+            return
+        state = self.hosts.setdefault(host, CircuitState())
+        state.failures += 1
+        now = time.monotonic()
+        # Failures of downloads that started before the circuit opened
+        if state.failures < self.threshold or state.open_until > now:
+            return
+        state.cooldown = (
+            min(state.cooldown * 2, self.max_cooldown) if state.cooldown else self.cooldown
+        )
+        state.open_until = now + state.cooldown
+        state.probe_started = None
+        logger.warning(
+            f"Host '{host}' failed {state.failures} downloads in a row, pausing its downloads for {state.cooldown:.0f} seconds"
+        )
+
+
+class RetryPolicy:
+    """Exponential backoff with full jitter between attempts of a chapter,
+    the server's Retry-After wins if it asks for longer."""
+
+    def __init__(
+        self,
+        times: int = 5,
+        backoff_base: float = 2.0,
+        backoff_max: float = 120.0,
+        http_codes: Iterable[int] = RETRY_HTTP_CODES,
+        budget: int = 0,
+    ):
+        self.times = times
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.http_codes = frozenset(http_codes)
+        self.budget = RetryBudget(budget)
+
+    @classmethod
+    def from_settings(cls, settings) -> "RetryPolicy":
+        return cls(
+            times=settings.getint("COMIC_DOWNLOAD_RETRY_TIMES", 5),
+            backoff_base=settings.getfloat("COMIC_DOWNLOAD_RETRY_BACKOFF_BASE", 2.0),
+            backoff_max=settings.getfloat("COMIC_DOWNLOAD_RETRY_BACKOFF_MAX", 120.0),
+            http_codes=[
+                int(code)
+                for code in settings.getlist(
+                    "COMIC_DOWNLOAD_RETRY_HTTP_CODES", RETRY_HTTP_CODES
+                )
+            ],
+            budget=settings.getint("COMIC_DOWNLOAD_RETRY_BUDGET", 0),
+        )
+
+    def is_retryable_status(self, status_code: int) -> bool:
+        return status_code in self.http_codes
+
+    def should_retry(self, retry_state: RetryCallState) -> bool:
+        if retry_state.outcome is None or not retry_state.outcome.failed:
+            return False
+        exception = retry_state.outcome.exception()
+        if exception is None or not is_retryable(exception):
+            return False
+        if retry_state.attempt_number > self.times:
+            return False
+        if not self.budget.take():
+            logger.warning("Download retry budget of the run is used up")
+            return False
+        return True
+
+    def backoff(self, retry_state: RetryCallState) -> float:
+        delay = random.uniform(
+            0,
+            min(self.backoff_max, self.backoff_base * 2 ** (retry_state.attempt_number - 1)),
+        )
+        exception = retry_state.outcome.exception() if retry_state.outcome else None
+        if isinstance(exception, RetryableStatusError) and exception.retry_after:
+            delay = max(delay, min(exception.retry_after, self.backoff_max))
+        return delay
@@ -0,0 +1,90 @@
+import json
+import logging
+import os
+from dataclasses import asdict, dataclass, field
+from typing import List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+class SegmentedDownloadError(Exception):
+    pass
+
+
+def parse_content_range(
+    value: Optional[str],
+) -> Optional[Tuple[int, int, Optional[int]]]:
+    # "bytes 100-199/1000" to the first and the last byte and the total size,
+    # which the server may leave out as "*"
+    if not value or not value.startswith("bytes "):
+        return None
+    range_, _, total = value[len("bytes ") :].partition("/")
+    start, _, end = (part.strip() for part in range_.partition("-"))
+    if not start.isdigit() or not end.isdigit():
+        return None
+    return int(start), int(end), int(total) if total.strip().isdigit() else None
+
+
+@dataclass
+class DownloadSegment:
+    start: int
+    end: int
+    downloaded: int = field(default=0)
+
+    @property
+    def position(self) -> int:
+        return self.start + self.downloaded
+
+    @property
+    def done(self) -> bool:
+        return self.position > self.end
+
+
+@dataclass
+class SegmentedDownloadState:
+    size: int
+    segments: List[DownloadSegment] = field(default_factory=list)
+    etag: Optional[str] = field(default=None)
+    last_modified: Optional[str] = field(default=None)
+
+    @classmethod
+    def split(cls, size: int, count: int) -> "SegmentedDownloadState":
+        segment_size = -(-size // count)
+        return cls(
+            size=size,
+            segments=[
+                DownloadSegment(start=start, end=min(start + segment_size, size) - 1)
+                for start in range(0, size, segment_size)
+            ],
+        )
+
+    @property
+    def downloaded(self) -> int:
+        return sum(segment.downloaded for segment in self.segments)
+
+    @property
+    def done(self) -> bool:
+        return all(segment.done for segment in self.segments)
+
+    @classmethod
+    def load(cls, filename: str) -> Optional["SegmentedDownloadState"]:
+        if not os.path.isfile(filename):
+            return None
+        try:
+            with open(filename, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            return cls(
+                size=data["size"],
+                segments=[DownloadSegment(**segment) for segment in data["segments"]],
+                etag=data.get("etag"),
+                last_modified=data.get("last_modified"),
+            )
+        except (ValueError, KeyError, TypeError) as e:
+            logger.warning(f"Ignoring broken segment state file '{filename}': {e!r}")
+            return None
+
+    def save(self, filename: str):
+        temp_filename = f"{filename}.tmp"
+        with open(temp_filename, "w", encoding="utf-8") as f:
+            json.dump(asdict(self), f)
+        os.replace(temp_filename, filename)
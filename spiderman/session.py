@@ -0,0 +1,84 @@
+import asyncio
+import logging
+import time
+from http.cookiejar import Cookie
+from typing import Awaitable, Callable, Iterable, List, Optional
+
+from scrapy.http.cookies import CookieJar
+
+logger = logging.getLogger(__name__)
+
+
+class SessionExpiredError(Exception):
+    """The site answered as if the request wasn't logged in."""
+
+
+class SessionManager:
+    """Login session of a spider, shared by its requests, the pages it renders
+    and the chapter downloads of the pipeline. Requests that find the session
+    expired wait for a single login instead of each logging in, a request sent
+    before the last login only has to be sent again."""
+
+    def __init__(
+        self,
+        login: Callable[[], Awaitable[bool]],
+        get_jar: Callable[[], Optional[CookieJar]],
+        cookie_names: Optional[Iterable[str]] = None,
+        expiry_margin: float = 60.0,
+    ):
+        self._do_login = login
+        self.get_jar = get_jar
+        # The cookies that make the session, all cookies of the jar if unset
+        self.cookie_names = set(cookie_names) if cookie_names else None
+        self.expiry_margin = expiry_margin
+        self.generation = 0
+        self._login: Optional[asyncio.Future] = None
+
+    def cookies(self) -> List[Cookie]:
+        jar = self.get_jar()
+        if jar is None:
+            return []
+        return [
+            cookie
+            for cookie in jar.jar
+            if self.cookie_names is None or cookie.name in self.cookie_names
+        ]
+
+    def expires_at(self) -> Optional[float]:
+        expires = [cookie.expires for cookie in self.cookies() if cookie.expires]
+        return min(expires) if expires else None
+
+    def check(self) -> Optional[bool]:
+        # Whether the persisted cookies still hold a session, without asking
+        # the site. None if they can't tell, like cookies that only last as
+        # long as the browser.
+        if self.get_jar() is None:
+            return None
+        cookies = self.cookies()
+        if not cookies:
+            return False
+        expires_at = self.expires_at()
+        if expires_at is None:
+            return None
+        return expires_at - self.expiry_margin > time.time()
+
+    def logged_in(self):
+        self.generation += 1
+
+    async def login(self, generation: Optional[int] = None) -> bool:
+        if generation is not None and generation < self.generation:
+            return True
+        if self._login is None:
+            self._login = asyncio.ensure_future(self._run_login())
+        # A caller that gets cancelled doesn't cancel the login of the others
+        return await asyncio.shield(self._login)
+
+    async def _run_login(self) -> bool:
+        try:
+            if await self._do_login():
+                self.logged_in()
+                return True
+            logger.error("Login failed")
+            return False
+        finally:
+            self._login = None
@@ -32,6 +32,11 @@ DOWNLOAD_DELAY = 3
 
 # Disable cookies (enabled by default)
 #COOKIES_ENABLED = False
+# Persist cookies of PersistenceCookiesMiddleware, changes are written to disk
+# at most once per COOKIES_PERSISTENCE_DELAY seconds
+#COOKIES_PERSISTENCE = False
+#COOKIES_PERSISTENCE_DIR = ".cookies"
+#COOKIES_PERSISTENCE_DELAY = 5.0
 
 # Disable Telnet Console (enabled by default)
 #TELNETCONSOLE_ENABLED = False
@@ -53,6 +58,15 @@ DOWNLOAD_DELAY = 3
 # DOWNLOADER_MIDDLEWARES = {
 # }
 
+# Requests of rendered pages aborted by spiderman.blocking.RequestBlocker, see
+# the module for the defaults. URLs matching PLAYWRIGHT_BLOCK_ALLOWLIST are never
+# blocked, set it in the custom_settings of a spider to allow per spider.
+#PLAYWRIGHT_BLOCK_RESOURCE_TYPES = ["image", "font", "stylesheet", "media", "websocket"]
+#PLAYWRIGHT_BLOCK_DOMAINS = ["google-analytics.com", "googletagmanager.com"]
+#PLAYWRIGHT_BLOCK_URL_PATTERNS = [r"\.jpg", r"\.png"]
+#PLAYWRIGHT_BLOCK_ALLOWLIST = []
+#PLAYWRIGHT_BLOCK_ESTIMATED_SIZES = {"image": 51200}
+
 # Enable or disable extensions
 # See https://docs.scrapy.org/en/latest/topics/extensions.html
 #EXTENSIONS = {
@@ -65,6 +79,106 @@ DOWNLOAD_DELAY = 3
 #    "spiderman.pipelines.SpidermanPipeline": 300,
 #}
 
+# Configure chapter downloads of ComicDownloadPipeline
+# Maximum chapters downloaded at the same time across all comics, at most and by
+# default (0) COMIC_DOWNLOAD_MAX_CONNECTIONS
+#COMIC_DOWNLOAD_CONCURRENCY = 0
+# Maximum chapters of a single comic downloaded at the same time
+#COMIC_DOWNLOAD_CONCURRENCY_PER_COMIC = 1
+# Connection pool of the HTTP client shared by all chapter downloads
+#COMIC_DOWNLOAD_HTTP2 = False
+#COMIC_DOWNLOAD_MAX_CONNECTIONS = 10
+#COMIC_DOWNLOAD_MAX_KEEPALIVE_CONNECTIONS = 5
+#COMIC_DOWNLOAD_KEEPALIVE_EXPIRY = 30.0
+#COMIC_DOWNLOAD_CONNECT_TIMEOUT = 30.0
+#COMIC_DOWNLOAD_READ_TIMEOUT = 60.0
+#COMIC_DOWNLOAD_WRITE_TIMEOUT = 30.0
+# Longest wait for a free connection of the pool, 0 waits as long as it takes.
+# A download that runs out of it fails without a retry.
+#COMIC_DOWNLOAD_POOL_TIMEOUT = 0
+# Write path of chapter files, FSYNC is one of "never", "close" or "flush"
+#COMIC_DOWNLOAD_CHUNK_SIZE = 1048576
+#COMIC_DOWNLOAD_WRITE_BUFFER_SIZE = 8388608
+#COMIC_DOWNLOAD_PREALLOCATE = True
+#COMIC_DOWNLOAD_FSYNC = "never"
+#COMIC_DOWNLOAD_PROGRESS_INTERVAL = 5.0
+# Split chapters into byte ranges fetched over several connections, chapters
+# smaller than two segments of COMIC_DOWNLOAD_MIN_SEGMENT_SIZE are not split
+#COMIC_DOWNLOAD_SEGMENTS = 1
+#COMIC_DOWNLOAD_MIN_SEGMENT_SIZE = 8388608
+# The ETag or Last-Modified of a partial download is kept in "<chapter>.resume"
+# and sent as If-Range when it resumes, so a chapter that changed on the server
+# starts over. Partial files untouched for PARTIAL_TTL seconds are removed when
+# their comic is crawled again, 0 keeps them forever.
+#COMIC_DOWNLOAD_PARTIAL_TTL = 604800
+# SQLite manifest of downloaded chapters, comics whose chapter table is unchanged
+# since they were completely downloaded are skipped without touching the disk
+#COMIC_DOWNLOAD_MANIFEST = ".manifest/comics.sqlite"
+# Check every chapter while it downloads: the size, a digest and for epubs the
+# zip central directory. The result is kept next to the chapter in
+# "<chapter>.verify.json", a chapter that fails is moved to the ".quarantine"
+# directory of its comic and downloaded again.
+#COMIC_DOWNLOAD_VERIFY = True
+#COMIC_DOWNLOAD_VERIFY_DIGEST = "sha256"
+# Download bandwidth in bytes per second for all downloads and per host, 0 is
+# unlimited. A bucket holds BURST seconds of its rate, a smaller CHUNK_SIZE
+# smooths the shaping. The API can change the limits of its workers at runtime
+# through PUT /downloads/bandwidth.
+#COMIC_DOWNLOAD_BANDWIDTH = 0
+#COMIC_DOWNLOAD_BANDWIDTH_PER_HOST = {"kxo.moe": 2097152}
+#COMIC_DOWNLOAD_BANDWIDTH_BURST = 1.0
+# Which waiting chapter gets the next free download slot, one of "table" (as
+# listed on the detail page), "newest", "oldest", "smallest" or "largest"
+#COMIC_DOWNLOAD_ORDER = "table"
+# Queue the chapters in this SQLite file instead of downloading them during the
+# crawl, `spiderman download` drains it with its own concurrency and resumes
+# after a restart. A failed chapter is retried after RETRY_DELAY seconds times
+# its attempts, up to MAX_ATTEMPTS. A worker holds a chapter for LEASE seconds
+# between renewals, so workers sharing a queue take over the chapters of one
+# that died.
+#COMIC_DOWNLOAD_QUEUE = ".queue/downloads.sqlite"
+#COMIC_DOWNLOAD_QUEUE_CONCURRENCY = 4
+#COMIC_DOWNLOAD_QUEUE_POLL_INTERVAL = 5.0
+#COMIC_DOWNLOAD_QUEUE_LEASE = 60.0
+#COMIC_DOWNLOAD_QUEUE_MAX_ATTEMPTS = 3
+#COMIC_DOWNLOAD_QUEUE_RETRY_DELAY = 60.0
+# Retries of a chapter after timeouts, broken connections, cut off responses and
+# the HTTP_CODES, waiting a random time up to BACKOFF_BASE * 2 ** attempt
+# seconds (at most BACKOFF_MAX) or the Retry-After of the server. Each attempt
+# resumes from the partial file. BUDGET caps the retries of a whole run, 0 is
+# unlimited.
+#COMIC_DOWNLOAD_RETRY_TIMES = 5
+#COMIC_DOWNLOAD_RETRY_BACKOFF_BASE = 2.0
+#COMIC_DOWNLOAD_RETRY_BACKOFF_MAX = 120.0
+#COMIC_DOWNLOAD_RETRY_HTTP_CODES = [408, 429, 500, 502, 503, 504, 522, 524]
+#COMIC_DOWNLOAD_RETRY_BUDGET = 0
+# Pause all downloads from a host for COOLDOWN seconds after THRESHOLD failures
+# of the host in a row (timeouts, connection errors, 429 and 5xx answers, not
+# cut off or broken files), then let a single download probe it. Every failed probe
+# doubles the pause up to MAX_COOLDOWN, a THRESHOLD of 0 disables the breaker.
+#COMIC_DOWNLOAD_CIRCUIT_BREAKER_THRESHOLD = 5
+#COMIC_DOWNLOAD_CIRCUIT_BREAKER_COOLDOWN = 60.0
+#COMIC_DOWNLOAD_CIRCUIT_BREAKER_MAX_COOLDOWN = 600.0
+
+# Long-lived crawler processes of the API that take scheduled jobs from a queue,
+# a worker is replaced after WORKER_MAX_JOBS jobs or once it uses more than
+# WORKER_MAX_MEMORY MB, 0 disables either limit. A pool size of 0 starts a new
+# process for every job.
+#WORKER_POOL_SIZE = 2
+#WORKER_MAX_JOBS = 20
+#WORKER_MAX_MEMORY = 0
+# A run with "shards" splits the comics of the spider by a hash of their URL
+# into that many jobs, which the workers run side by side. The shards share the
+# cookie file and log in once, the stats of the run add up theirs. WORKER_SHARDS
+# is the number of shards of a run that doesn't ask for any.
+#WORKER_SHARDS = 1
+
+# Seconds between the crawl stats a worker sends to the /metrics endpoint
+#WORKER_METRICS_INTERVAL = 5.0
+# SQLite file of the scheduled jobs and the history of their runs, an empty
+# value keeps the jobs in memory
+#SCHEDULER_JOBSTORE = ".scheduler/jobs.sqlite"
+
 # Enable and configure the AutoThrottle extension (disabled by default)
 # See https://docs.scrapy.org/en/latest/topics/autothrottle.html
 #AUTOTHROTTLE_ENABLED = True
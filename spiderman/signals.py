@@ -0,0 +1,11 @@
+# Progress of a crawl, the keyword arguments of every signal are plain values
+# so handlers can pass them on to other processes as they are.
+
+# comic, url, chapters
+comic_discovered = object()
+# comic, chapter, size
+chapter_queued = object()
+# comic, chapter, downloaded, total, speed, eta
+chapter_progress = object()
+# comic, chapter, status (one of metrics.CHAPTER_STATUSES)
+chapter_status = object()
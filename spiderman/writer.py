@@ -0,0 +1,123 @@
+import asyncio
+import ctypes
+import logging
+import os
+import sys
+from typing import BinaryIO, Callable, Literal, Optional, TypeVar
+
+logger = logging.getLogger(__name__)
+
+FsyncPolicy = Literal["never", "close", "flush"]
+
+FALLOC_FL_KEEP_SIZE = 0x01
+
+T = TypeVar("T")
+
+
+def _load_fallocate() -> Optional[Callable[..., int]]:
+    if not sys.platform.startswith("linux"):
+        return None
+    try:
+        fallocate = ctypes.CDLL(None, use_errno=True).fallocate
+    except (OSError, AttributeError):
+        return None
+    fallocate.argtypes = [
+        ctypes.c_int,
+        ctypes.c_int,
+        ctypes.c_longlong,
+        ctypes.c_longlong,
+    ]
+    return fallocate
+
+
+_fallocate = _load_fallocate()
+
+
+def preallocate(fd: int, offset: int, length: int) -> bool:
+    # Reserve the blocks without changing the file size, the size of a
+    # partial file is what a resumed download starts from.
+    if _fallocate is None or length <= 0:
+        return False
+    return _fallocate(fd, FALLOC_FL_KEEP_SIZE, offset, length) == 0
+
+
+class ChapterFileWriter:
+    def __init__(
+        self,
+        path: str,
+        mode: Literal["ab", "wb", "r+b"],
+        buffer_size: int = 8 * 1024 * 1024,
+        fsync: FsyncPolicy = "never",
+        preallocate_size: int = 0,
+        offset: Optional[int] = None,
+    ):
+        self.path = path
+        self.mode = mode
+        self.offset = offset
+        self.buffer_size = buffer_size
+        self.fsync = fsync
+        self.preallocate_size = preallocate_size
+        self.position = offset or 0
+        self.flushed_position = self.position
+        self._file: Optional[BinaryIO] = None
+        self._buffer = bytearray()
+
+    async def __aenter__(self) -> "ChapterFileWriter":
+        await self.open()
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close()
+
+    async def open(self):
+        self._file = await self._run(self._open)
+
+    def _open(self) -> BinaryIO:
+        f = open(self.path, self.mode, buffering=0)
+        if self.offset is None:
+            self.position = f.seek(0, os.SEEK_END)
+        else:
+            self.position = f.seek(self.offset)
+        self.flushed_position = self.position
+        if self.preallocate_size > self.position and not preallocate(
+            f.fileno(), self.position, self.preallocate_size - self.position
+        ):
+            logger.debug(f"Preallocation is not supported for file '{self.path}'")
+        return f  # type: ignore
+
+    async def write(self, data: bytes):
+        self._buffer += data
+        self.position += len(data)
+        if len(self._buffer) >= self.buffer_size:
+            await self.flush()
+
+    async def flush(self):
+        if not self._buffer:
+            return
+        data, self._buffer = self._buffer, bytearray()
+        await self._run(self._write, data, self.fsync == "flush")
+
+    def _write(self, data: bytearray, sync: bool):
+        assert self._file
+        view = memoryview(data)
+        while view:
+            written = self._file.write(view)
+            view = view[written or 0 :]
+            self.flushed_position += written or 0
+        if sync:
+            os.fsync(self._file.fileno())
+
+    async def close(self):
+        if self._file is None:
+            return
+        try:
+            await self.flush()
+            if self.fsync != "never":
+                await self._run(os.fsync, self._file.fileno())
+        finally:
+            f, self._file = self._file, None
+            await self._run(f.close)
+
+    @staticmethod
+    async def _run(func: Callable[..., T], *args) -> T:
+        return await asyncio.get_running_loop().run_in_executor(None, func, *args)
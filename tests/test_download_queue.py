@@ -0,0 +1,127 @@
+import pytest
+
+from spiderman import download_queue
+from spiderman.download_queue import DownloadQueue
+from spiderman.items import ComicChapterItem, ComicItem
+
+COMIC = ComicItem(name="comic", url="https://example.com/c/1.htm")
+
+
+def chapter(index: int, size: str = "10.0M (100頁)") -> ComicChapterItem:
+    return ComicChapterItem(
+        name=f"vol {index}",
+        size=size,
+        download_url=f"https://example.com/down.php?vol={index}",
+        save_path=f"/download/comic/[{index}]-vol {index}.epub",
+    )
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(download_queue.time, "time", clock)
+    return clock
+
+
+@pytest.fixture
+def queue(tmp_path, clock):
+    queue = DownloadQueue(str(tmp_path / "queue.sqlite"))
+    yield queue
+    queue.close()
+
+
+def test_claim_in_table_order(queue):
+    queue.enqueue("vol.moe", COMIC, [chapter(0), chapter(1), chapter(2)], "hash")
+    claimed = queue.claim(limit=2, lease=60)
+    assert [c.chapter.name for c in claimed] == ["vol 0", "vol 1"]
+    assert [c.attempts for c in claimed] == [1, 1]
+    assert claimed[0].comic == COMIC
+    assert claimed[0].chapters_hash == "hash"
+    assert [c.chapter.name for c in queue.claim(limit=2, lease=60)] == ["vol 2"]
+    assert queue.claim(limit=2, lease=60) == []
+
+
+def test_claim_by_size(queue):
+    queue.enqueue(
+        "vol.moe", COMIC, [chapter(0, "30.0M (1頁)"), chapter(1, "10.0M (1頁)")]
+    )
+    claimed = queue.claim(limit=1, lease=60, order="smallest")
+    assert [c.chapter.name for c in claimed] == ["vol 1"]
+
+
+def test_chapters_without_url_are_not_queued(queue):
+    queue.enqueue("vol.moe", COMIC, [ComicChapterItem(name="vol 0")])
+    assert queue.count() == {}
+
+
+def test_expired_lease_is_claimed_again(queue, clock):
+    queue.enqueue("vol.moe", COMIC, [chapter(0)])
+    assert len(queue.claim(limit=1, lease=60)) == 1
+    clock.now += 30
+    assert queue.claim(limit=1, lease=60) == []
+    clock.now += 31
+    claimed = queue.claim(limit=1, lease=60)
+    assert [c.attempts for c in claimed] == [2]
+
+
+def test_renewed_lease_is_kept(queue, clock):
+    queue.enqueue("vol.moe", COMIC, [chapter(0)])
+    (claimed,) = queue.claim(limit=1, lease=60)
+    clock.now += 50
+    queue.renew([claimed.id], lease=60)
+    clock.now += 50
+    assert queue.claim(limit=1, lease=60) == []
+
+
+def test_release_requeues_without_an_attempt(queue):
+    queue.enqueue("vol.moe", COMIC, [chapter(0)])
+    (claimed,) = queue.claim(limit=1, lease=60)
+    queue.release([claimed.id])
+    assert queue.count() == {"queued": 1}
+    assert [c.attempts for c in queue.claim(limit=1, lease=60)] == [1]
+
+
+def test_fail_with_retry_after_requeues_later(queue, clock):
+    queue.enqueue("vol.moe", COMIC, [chapter(0)])
+    (claimed,) = queue.claim(limit=1, lease=60)
+    queue.fail(claimed.id, "503", retry_after=30)
+    assert queue.count() == {"queued": 1}
+    assert queue.claim(limit=1, lease=60) == []
+    clock.now += 31
+    assert [c.attempts for c in queue.claim(limit=1, lease=60)] == [2]
+
+
+def test_fail_without_retry_gives_up(queue):
+    queue.enqueue("vol.moe", COMIC, [chapter(0)])
+    (claimed,) = queue.claim(limit=1, lease=60)
+    queue.fail(claimed.id, "404")
+    assert queue.count() == {"failed": 1}
+    assert queue.claim(limit=1, lease=60) == []
+
+
+def test_enqueue_again_requeues_unless_running(queue):
+    queue.enqueue("vol.moe", COMIC, [chapter(0), chapter(1)])
+    first, second = queue.claim(limit=2, lease=60)
+    queue.fail(first.id, "404")
+    queue.enqueue("vol.moe", COMIC, [chapter(0), chapter(1)])
+    assert queue.count() == {"queued": 1, "running": 1}
+    (claimed,) = queue.claim(limit=2, lease=60)
+    assert claimed.id == first.id
+    assert claimed.attempts == 1
+
+
+def test_comic_done_with_its_last_chapter(queue):
+    queue.enqueue("vol.moe", COMIC, [chapter(0), chapter(1)], "hash")
+    first, second = queue.claim(limit=2, lease=60)
+    queue.complete(first.id)
+    assert not queue.is_comic_done(COMIC.url, "hash")
+    queue.complete(second.id)
+    assert queue.is_comic_done(COMIC.url, "hash")
@@ -0,0 +1,189 @@
+import asyncio
+import io
+import os
+import threading
+import zipfile
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import List
+
+import pytest
+import scrapy
+from scrapy.settings import Settings
+
+from spiderman.items import ComicChapterItem, ComicChaptersEndItem, ComicItem
+from spiderman.manifest import CrawlManifest
+from spiderman.pipelines import ComicDownloadPipeline
+from spiderman.segments import SegmentedDownloadError, SegmentedDownloadState
+
+COMIC = ComicItem(name="comic", url="https://example.com/c/1.htm")
+CHAPTERS = [
+    ComicChapterItem(name=f"vol {i}", download_url=f"https://example.com/{i}")
+    for i in range(2)
+]
+
+
+@pytest.fixture
+def pipeline(tmp_path):
+    pipeline = ComicDownloadPipeline()
+    pipeline.manifest = CrawlManifest(str(tmp_path / "manifest.sqlite"))
+    yield pipeline
+    pipeline.manifest.close()
+
+
+def end_item() -> ComicChaptersEndItem:
+    return ComicChaptersEndItem(
+        comic=COMIC, chapters=2, chapters_hash=CrawlManifest.hash_chapters(CHAPTERS)
+    )
+
+
+def test_streamed_comic_recorded_after_its_last_chapter(pipeline):
+    pipeline.count_streamed_chapter(COMIC, True)
+    pipeline.end_streamed_comic(end_item())
+    assert not pipeline.manifest.is_comic_complete(COMIC.url, end_item().chapters_hash)
+    pipeline.count_streamed_chapter(COMIC, True)
+    assert pipeline.manifest.is_comic_complete(COMIC.url, end_item().chapters_hash)
+    assert pipeline.streamed_comics == {}
+
+
+def test_streamed_comic_recorded_at_its_end(pipeline):
+    pipeline.count_streamed_chapter(COMIC, True)
+    pipeline.count_streamed_chapter(COMIC, True)
+    pipeline.end_streamed_comic(end_item())
+    assert pipeline.manifest.is_comic_complete(COMIC.url, end_item().chapters_hash)
+    assert pipeline.streamed_comics == {}
+
+
+def test_streamed_comic_with_a_failed_chapter_has_no_hash(pipeline):
+    pipeline.end_streamed_comic(end_item())
+    pipeline.count_streamed_chapter(COMIC, False)
+    pipeline.count_streamed_chapter(COMIC, True)
+    assert not pipeline.manifest.is_comic_complete(COMIC.url, end_item().chapters_hash)
+    assert pipeline.streamed_comics == {}
+
+
+def open_pipeline(**settings) -> ComicDownloadPipeline:
+    spider = scrapy.Spider(name="test")
+    spider.settings = Settings(settings)
+    spider.crawler = None
+    pipeline = ComicDownloadPipeline()
+    pipeline.open_spider(spider)
+    assert pipeline.http_client is not None
+    asyncio.run(pipeline.http_client.aclose())
+    return pipeline
+
+
+@pytest.mark.parametrize(
+    "concurrency, expected", [(None, 10), (0, 10), (4, 4), (20, 10)]
+)
+def test_download_concurrency_is_bounded_by_the_pool(concurrency, expected):
+    settings = {"COMIC_DOWNLOAD_MAX_CONNECTIONS": 10}
+    if concurrency is not None:
+        settings["COMIC_DOWNLOAD_CONCURRENCY"] = concurrency
+    pipeline = open_pipeline(**settings)
+    assert pipeline.download_semaphore is not None
+    assert pipeline.download_semaphore.value == expected
+
+
+def make_epub() -> bytes:
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w", zipfile.ZIP_STORED) as epub:
+        epub.writestr("mimetype", "application/epub+zip")
+        epub.writestr("content.bin", os.urandom(300_000))
+    return buffer.getvalue()
+
+
+class RangeServer(ThreadingHTTPServer):
+    def __init__(self, body: bytes):
+        super().__init__(("127.0.0.1", 0), RangeHandler)
+        self.body = body
+        self.ranges: List[str] = []
+        # Answers every range from the first byte, like a broken cache
+        self.ignore_range_start = False
+
+
+class RangeHandler(BaseHTTPRequestHandler):
+    server: RangeServer
+
+    def do_GET(self):
+        body = self.server.body
+        value = self.headers.get("Range")
+        self.server.ranges.append(value or "")
+        if not value:
+            self.send_response(200)
+            self.send_header("Content-Length", str(len(body)))
+            self.send_header("ETag", '"v1"')
+            self.end_headers()
+            self.wfile.write(body)
+            return
+        start, _, end = value[len("bytes=") :].partition("-")
+        first = 0 if self.server.ignore_range_start and start != "0" else int(start)
+        last = int(end) if end else len(body) - 1
+        self.send_response(206)
+        self.send_header("Content-Length", str(last + 1 - first))
+        self.send_header("Content-Range", f"bytes {first}-{last}/{len(body)}")
+        self.send_header("ETag", '"v1"')
+        self.end_headers()
+        self.wfile.write(body[first : last + 1])
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def range_server(monkeypatch):
+    for name in ("HTTP_PROXY", "HTTPS_PROXY", "ALL_PROXY"):
+        monkeypatch.delenv(name, raising=False)
+        monkeypatch.delenv(name.lower(), raising=False)
+        monkeypatch.delenv(name, raising=False)
+    server = RangeServer(make_epub())
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def download(server: RangeServer, tmp_path) -> bool:
+    spider = scrapy.Spider(name="test")
+    spider.settings = Settings(
+        {"COMIC_DOWNLOAD_SEGMENTS": 3, "COMIC_DOWNLOAD_MIN_SEGMENT_SIZE": 50_000}
+    )
+    spider.crawler = None
+    chapter = ComicChapterItem(
+        name="vol 1",
+        download_url=f"http://127.0.0.1:{server.server_address[1]}/down.php",
+        save_path=str(tmp_path / "comic" / "[0]-vol 1.epub"),
+    )
+    os.makedirs(tmp_path / "comic")
+
+    async def run():
+        pipeline = ComicDownloadPipeline()
+        pipeline.open_spider(spider)
+        assert pipeline.http_client is not None
+        try:
+            return await pipeline.download_chapter(COMIC, chapter, spider)
+        finally:
+            await pipeline.http_client.aclose()
+
+    return asyncio.run(run())
+
+
+def test_segmented_download(range_server, tmp_path):
+    assert download(range_server, tmp_path) is True
+    assert (tmp_path / "comic" / "[0]-vol 1.epub").read_bytes() == range_server.body
+    segments = SegmentedDownloadState.split(len(range_server.body), 3).segments
+    assert sorted(range_server.ranges) == sorted(
+        ["bytes=0-0"] + [f"bytes={s.start}-{s.end}" for s in segments]
+    )
+    assert not [
+        name
+        for name in os.listdir(tmp_path / "comic")
+        if name.endswith((".segments", ".downloading"))
+    ]
+
+
+def test_segmented_download_rejects_a_misaligned_range(range_server, tmp_path):
+    range_server.ignore_range_start = True
+    with pytest.raises(SegmentedDownloadError):
+        download(range_server, tmp_path)
+    assert not (tmp_path / "comic" / "[0]-vol 1.epub").exists()
@@ -0,0 +1,155 @@
+import asyncio
+
+import httpx
+import pytest
+
+from spiderman import retry
+from spiderman.integrity import CorruptDownloadError
+from spiderman.retry import (
+    CircuitBreaker,
+    IncompleteDownloadError,
+    RetryableStatusError,
+    is_host_failure,
+    is_retryable,
+    parse_retry_after,
+)
+from spiderman.session import SessionExpiredError
+
+REQUEST = httpx.Request("GET", "https://example.com/down.php")
+
+
+@pytest.mark.parametrize(
+    "exception",
+    [
+        httpx.ConnectTimeout("timed out", request=REQUEST),
+        httpx.ReadTimeout("timed out", request=REQUEST),
+        httpx.ConnectError("refused", request=REQUEST),
+        httpx.ReadError("reset", request=REQUEST),
+        httpx.RemoteProtocolError("broken", request=REQUEST),
+        RetryableStatusError(503),
+        RetryableStatusError(429, retry_after=10),
+        IncompleteDownloadError("cut off"),
+        CorruptDownloadError("bad zip"),
+    ],
+)
+def test_retryable(exception):
+    assert is_retryable(exception)
+
+
+@pytest.mark.parametrize(
+    "exception",
+    [
+        SessionExpiredError("logged out"),
+        httpx.PoolTimeout("timed out", request=REQUEST),
+        httpx.UnsupportedProtocol("ftp", request=REQUEST),
+        ValueError("bug"),
+        OSError("disk full"),
+    ],
+)
+def test_not_retryable(exception):
+    assert not is_retryable(exception)
+
+
+@pytest.mark.parametrize(
+    "exception, expected",
+    [
+        (httpx.ConnectTimeout("timed out", request=REQUEST), True),
+        (httpx.ConnectError("refused", request=REQUEST), True),
+        (httpx.RemoteProtocolError("broken", request=REQUEST), True),
+        (RetryableStatusError(429), True),
+        (RetryableStatusError(503), True),
+        (RetryableStatusError(408), False),
+        (httpx.PoolTimeout("timed out", request=REQUEST), False),
+        (IncompleteDownloadError("cut off"), False),
+        (CorruptDownloadError("bad zip"), False),
+    ],
+)
+def test_host_failure(exception, expected):
+    assert is_host_failure(exception) is expected
+
+
+def test_parse_retry_after():
+    assert parse_retry_after("120") == 120.0
+    assert parse_retry_after(None) is None
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(retry.time, "monotonic", clock)
+    return clock
+
+
+def wait(breaker: CircuitBreaker, host: str) -> bool:
+    # Whether a download may start right away. The clock of the event loop is
+    # the patched one too, so a waiting download is only given a few turns.
+    async def run():
+        task = asyncio.ensure_future(breaker.wait(host))
+        for _ in range(5):
+            await asyncio.sleep(0)
+        if task.done():
+            return True
+        task.cancel()
+        return False
+
+    return asyncio.run(run())
+
+
+def test_breaker_opens_after_threshold(clock):
+    breaker = CircuitBreaker(threshold=2, cooldown=60.0)
+    breaker.record_failure("h")
+    assert wait(breaker, "h")
+    breaker.record_failure("h")
+    assert breaker.hosts["h"].open_until == clock.now + 60.0
+    assert not wait(breaker, "h")
+    assert wait(breaker, "other")
+
+
+def test_breaker_lets_a_single_probe_through(clock):
+    breaker = CircuitBreaker(threshold=1, cooldown=60.0)
+    breaker.record_failure("h")
+    clock.now += 61.0
+    assert wait(breaker, "h")
+    # The others wait for the probe
+    assert not wait(breaker, "h")
+
+
+def test_breaker_closes_on_probe_success(clock):
+    breaker = CircuitBreaker(threshold=1, cooldown=60.0)
+    breaker.record_failure("h")
+    clock.now += 61.0
+    assert wait(breaker, "h")
+    breaker.record_success("h")
+    assert "h" not in breaker.hosts
+    assert wait(breaker, "h")
+
+
+def test_breaker_doubles_cooldown_on_probe_failure(clock):
+    breaker = CircuitBreaker(threshold=1, cooldown=60.0, max_cooldown=100.0)
+    breaker.record_failure("h")
+    clock.now += 61.0
+    assert wait(breaker, "h")
+    breaker.record_failure("h")
+    assert breaker.hosts["h"].cooldown == 100.0
+    assert breaker.hosts["h"].open_until == clock.now + 100.0
+
+
+def test_breaker_ignores_failures_while_open(clock):
+    breaker = CircuitBreaker(threshold=1, cooldown=60.0)
+    breaker.record_failure("h")
+    breaker.record_failure("h")
+    assert breaker.hosts["h"].cooldown == 60.0
+
+
+def test_breaker_disabled():
+    breaker = CircuitBreaker(threshold=0)
+    breaker.record_failure("h")
+    assert wait(breaker, "h")
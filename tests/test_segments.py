@@ -0,0 +1,67 @@
+from spiderman.segments import (
+    DownloadSegment,
+    SegmentedDownloadState,
+    parse_content_range,
+)
+
+
+def test_split_covers_every_byte_once():
+    state = SegmentedDownloadState.split(1000, 3)
+    assert [(s.start, s.end) for s in state.segments] == [
+        (0, 333),
+        (334, 667),
+        (668, 999),
+    ]
+
+
+def test_split_of_a_small_file_has_fewer_segments():
+    state = SegmentedDownloadState.split(2, 4)
+    assert [(s.start, s.end) for s in state.segments] == [(0, 0), (1, 1)]
+
+
+def test_segment_position_and_done():
+    segment = DownloadSegment(start=100, end=199, downloaded=50)
+    assert segment.position == 150
+    assert not segment.done
+    segment.downloaded = 100
+    assert segment.done
+
+
+def test_state_progress():
+    state = SegmentedDownloadState.split(100, 2)
+    state.segments[0].downloaded = 50
+    assert state.downloaded == 50
+    assert not state.done
+    state.segments[1].downloaded = 50
+    assert state.done
+
+
+def test_state_reload(tmp_path):
+    filename = str(tmp_path / "1.epub.segments")
+    state = SegmentedDownloadState.split(1000, 2)
+    state.etag = '"v1"'
+    state.last_modified = "Wed, 21 Oct 2015 07:28:00 GMT"
+    state.segments[1].downloaded = 123
+    state.save(filename)
+    assert SegmentedDownloadState.load(filename) == state
+    assert not (tmp_path / "1.epub.segments.tmp").exists()
+
+
+def test_missing_state_loads_as_none(tmp_path):
+    assert SegmentedDownloadState.load(str(tmp_path / "missing.segments")) is None
+
+
+def test_broken_state_loads_as_none(tmp_path):
+    filename = tmp_path / "1.epub.segments"
+    filename.write_text('{"size": 1000', encoding="utf-8")
+    assert SegmentedDownloadState.load(str(filename)) is None
+    filename.write_text('{"segments": []}', encoding="utf-8")
+    assert SegmentedDownloadState.load(str(filename)) is None
+
+
+def test_parse_content_range():
+    assert parse_content_range("bytes 100-199/1000") == (100, 199, 1000)
+    assert parse_content_range("bytes 0-0/*") == (0, 0, None)
+    assert parse_content_range("bytes */1000") is None
+    assert parse_content_range("bytes 100-/1000") is None
+    assert parse_content_range(None) is None